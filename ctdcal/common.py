@@ -1,6 +1,7 @@
 """
 Classes, definitions and utilities for all ctdcal modules
 """
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 import yaml
 
@@ -90,3 +91,36 @@ def validate_file(pathname, create=False):
         raise FileExistsError("%s exists but is not a file." % str(p))
     else:
         raise FileNotFoundError("The file %s could not be found." % str(p))
+
+
+# Concurrency
+def parallel_map(func, *iterables, max_workers=None, processes=False):
+    """
+    Apply a function to every item of one or more iterables concurrently and
+    return the results as a list, in the same order as the inputs.
+
+    Threads are used by default, which suits I/O-bound work such as reading
+    files. Set processes to True for CPU-bound work; func and its arguments
+    must then be picklable.
+
+    Parameters
+    ----------
+    func : callable
+        Function to apply. Takes one argument per iterable.
+    *iterables : iterable
+        Arguments for func, zipped together as with the builtin map().
+    max_workers : int, optional
+        Maximum number of workers. A value of 1 runs everything in the calling
+        thread without an executor. Default (None) lets the executor decide.
+    processes : bool
+        If true, use a pool of processes instead of threads. Default is false.
+
+    Returns
+    -------
+    list
+    """
+    if max_workers == 1:
+        return list(map(func, *iterables))
+    executor = ProcessPoolExecutor if processes is True else ThreadPoolExecutor
+    with executor(max_workers=max_workers) as ex:
+        return list(ex.map(func, *iterables))
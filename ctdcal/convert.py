@@ -3,6 +3,7 @@ A module for handling SeaBird raw .HEX files, including the generation of bottle
 """
 
 import logging
+import threading
 from pathlib import Path
 
 import gsw
@@ -15,7 +16,7 @@ from . import process_bottle as btl
 from . import process_ctd as process_ctd
 from . import sbe_reader as sbe_rd
 from ctdcal.processors.cast_tools import Cast
-from .common import validate_dir
+from .common import parallel_map, validate_dir
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -134,6 +135,9 @@ def hex_to_ctd(ssscc_list):
     """
     Convert raw CTD data and export to .pkl files.
 
+    Bottle mean files (see make_btl_mean) are made from the converted data of each
+    cast as it is converted.
+
     Parameters
     ----------
     ssscc_list : list of str
@@ -151,10 +155,56 @@ def hex_to_ctd(ssscc_list):
             sbeReader = sbe_rd.SBEReader.from_paths(hexFile, xmlconFile)
             converted_df = convertFromSBEReader(sbeReader, ssscc)
             converted_df.to_pickle(cfg.dirs["converted"] + ssscc + ".pkl")
+            sbe_rd.save_sensor_coefs(
+                sbeReader.sensor_coefs,
+                xmlconFile,
+                cfg.dirs["converted"] + ssscc + "_coefs.json",
+            )
+
+            # average bottle stops while the converted data is in memory
+            if not Path(cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl").exists():
+                _save_btl_mean(converted_df, ssscc)
 
     return True
 
 
+def _use_cell_thermal_mass(cast_id, user_cfg):
+    """Check if the user configuration selects the cell thermal mass correction."""
+    selected = user_cfg.get("cell_thermal_mass", False)
+    if isinstance(selected, bool):
+        return selected
+
+    return str(cast_id) in {str(cast) for cast in selected}
+
+
+def cell_thermal_mass(data, sample_int=1 / 24, alpha=0.03, beta=1 / 7):
+    """
+    Correct the primary and secondary conductivity of a cast for cell thermal mass
+    (see equations_sbe.cell_therm_mass_corr) and recalculate salinity, in place.
+
+    Parameters
+    ----------
+    data : DataFrame
+        Cast data
+    sample_int : float, optional
+        CTD sample interval [seconds]
+    alpha : float, optional
+        Thermal anomaly amplitude
+    beta : float, optional
+        Thermal anomaly time constant
+    """
+    for cN, tN in [("c1", "t1"), ("c2", "t2")]:
+        c_col, t_col = cfg.column[cN], cfg.column[tN]
+        if c_col in data.columns and t_col in data.columns:
+            data[c_col] = sbe_eq.cell_therm_mass_corr(
+                data[t_col], data[c_col], sample_int=sample_int, alpha=alpha, beta=beta
+            )
+
+    sal_cols = [cfg.column[x] for x in ["sal", "c1", "t1", "p"]]
+    if all(col in data.columns for col in sal_cols):
+        data[cfg.column["sal"]] = gsw.SP_from_C(*(data[col] for col in sal_cols[1:]))
+
+
 def make_time_files(casts, datadir, user_cfg):
     """
     Make continuous time-series files from processed cast data.
@@ -162,6 +212,10 @@ def make_time_files(casts, datadir, user_cfg):
     Each cast has a smoothing filter applied. Filter parameters and columns
     to filter are from user-specified configurations.
 
+    Conductivity is corrected for cell thermal mass after filtering on the casts
+    selected by the "cell_thermal_mass" setting (true for all casts, false for none,
+    or a list of cast ids).
+
     The time on deck, the soak, and the upcast are trimmed to provide a continuous downcast.
     
     Parameters
@@ -201,6 +255,9 @@ def make_time_files(casts, datadir, user_cfg):
                         win_size=(user_cfg.filter_win * user_cfg.freq),
                         win_type=user_cfg.filter_type,
                         cols=user_cfg.filter_cols)
+            # Correct conductivity for cell thermal mass, if selected for this cast
+            if _use_cell_thermal_mass(cast_id, user_cfg):
+                cell_thermal_mass(cast.filtered, sample_int=1 / user_cfg.freq)
             # Parse the downcast from the full cast
             cast.parse_downcast(cast.filtered)
             # Trim the soak period from the downcast
@@ -237,14 +294,57 @@ def make_time_files(casts, datadir, user_cfg):
         cast_details_all.to_csv(Path(datadir, 'logs/cast_details.csv'), index=False)
         p_offsets_all.to_csv(Path(datadir, 'logs/ondeck_pressure.csv'), index=False)
 
-def make_btl_mean(ssscc_list):
+def _save_btl_mean(converted_df, ssscc):
+    """
+    Average a cast at the bottle stops, save its btl_mean.pkl file and append its
+    bottom bottle time/lat/lon details to the logs.
+    """
+    mean_df = btl.extract_bottle_stats(converted_df)
+
+    datetime_col = "nmea_datetime"
+    if datetime_col not in mean_df.columns:
+        log.debug(f"'{datetime_col}' not found in DataFrame - using 'scan_datetime'")
+        datetime_col = "scan_datetime"
+
+    bot_df = mean_df[[datetime_col, "GPSLAT", "GPSLON"]].head(1)
+    bot_df.columns = ["bottom_time", "latitude", "longitude"]
+    bot_df.insert(0, "SSSCC", ssscc)
+
+    mean_df.to_pickle(cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl")
+    _write_bottom_details(bot_df)
+
+
+def _make_cast_btl_mean(ssscc):
+    """Load a converted cast and save its btl_mean.pkl file (see _save_btl_mean)."""
+    converted_df = pd.read_pickle(cfg.dirs["converted"] + ssscc + ".pkl")
+    _save_btl_mean(converted_df, ssscc)
+
+
+# casts may be averaged concurrently, so appends to the details file are serialized
+_bottom_details_lock = threading.Lock()
+
+
+def _write_bottom_details(bot_df):
+    """Append the bottom bottle details of a newly averaged cast to the logs."""
+    fname = cfg.dirs["logs"] + "bottom_bottle_details.csv"
+    with _bottom_details_lock:
+        add_header = not Path(fname).exists()  # add header iff file doesn't exist
+        bot_df.to_csv(fname, mode="a", header=add_header, index=False)
+
+
+def make_btl_mean(ssscc_list, max_workers=None):
     """
     Create "bottle mean" files from continuous CTD data averaged at the bottle stops.
 
+    Casts converted by hex_to_ctd already have their bottle mean files; the rest are
+    averaged from their converted .pkl files, concurrently.
+
     Parameters
     ----------
     ssscc_list : list of str
         List of stations to convert
+    max_workers : int, optional
+        Maximum number of casts to average concurrently
 
     Returns
     -------
@@ -252,29 +352,12 @@ def make_btl_mean(ssscc_list):
         bottle averaging of mean has finished successfully
     """
     log.info("Generating btl_mean.pkl files")
-    for ssscc in ssscc_list:
-        if not Path(cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl").exists():
-            imported_df = pd.read_pickle(cfg.dirs["converted"] + ssscc + ".pkl")
-            bottle_df = btl.retrieveBottleData(imported_df)
-            mean_df = btl.bottle_mean(bottle_df)
-
-            # export bottom bottle time/lat/lon info
-            fname = cfg.dirs["logs"] + "bottom_bottle_details.csv"
-            datetime_col = "nmea_datetime"
-            if datetime_col not in mean_df.columns:
-                log.debug(
-                    f"'{datetime_col}' not found in DataFrame - using 'scan_datetime'"
-                )
-                datetime_col = "scan_datetime"
-
-            bot_df = mean_df[[datetime_col, "GPSLAT", "GPSLON"]].head(1)
-            bot_df.columns = ["bottom_time", "latitude", "longitude"]
-            bot_df.insert(0, "SSSCC", ssscc)
-            add_header = not Path(fname).exists()  # add header iff file doesn't exist
-            with open(fname, "a") as f:
-                bot_df.to_csv(f, mode="a", header=add_header, index=False)
-
-            mean_df.to_pickle(cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl")
+    new_casts = [
+        ssscc
+        for ssscc in ssscc_list
+        if not Path(cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl").exists()
+    ]
+    parallel_map(_make_cast_btl_mean, new_casts, max_workers=max_workers)
 
     return True
 
@@ -29,7 +29,7 @@ def _save_fig(ax, f_out):
         f_parent = Path(f_out).parent
         if not f_parent.exists():
             log.info(f"Parent folder '{f_parent.as_posix()}' doesn't exist... creating")
-            Path(f_out).parent.mkdir(parents=True)
+            Path(f_out).parent.mkdir(parents=True, exist_ok=True)
         plt.savefig(f_out)
         plt.close()
     else:
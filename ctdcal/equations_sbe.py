@@ -11,6 +11,7 @@ import logging
 
 import gsw
 import numpy as np
+from scipy.signal import lfilter
 
 from ctdcal.oxy_fitting import oxy_umolkg_to_ml
 
@@ -322,6 +323,83 @@ def sbe43_hysteresis_voltage(volts, p, coefs, sample_freq=24):
     return volts_corrected
 
 
+def cell_therm_mass_corr(
+    temp,
+    cond,
+    sample_int=1 / 24,
+    alpha=0.03,
+    beta=1 / 7,
+    state=None,
+    return_state=False,
+):
+    """Correct conductivity signal for effects of cell thermal mass.
+
+    The Lueck (1990) recursion used by SBE CellTM,
+
+        CTM[n] = -b * CTM[n-1] + a * dc_dT[n] * (T[n] - T[n-1]),
+
+    is applied exactly as a first-order recursive filter, with the temperature
+    dependent dc_dT folded into the filter input. Non-finite temperatures add no
+    correction. Long casts can be corrected in chunks by passing the state returned
+    for each chunk on to the next one.
+
+    Parameters
+    ----------
+    temp : array-like
+        CTD temperature [degC]
+    cond : array-like
+        CTD conductivity [mS/cm]
+    sample_int : float, optional
+        CTD sample interval [seconds]
+    alpha : float, optional
+        Thermal anomaly amplitude
+    beta : float, optional
+        Thermal anomaly time constant
+    state : tuple of float, optional
+        Temperature [degC] and correction [S/m] at the last sample of the previous
+        chunk of the cast, as returned with return_state
+    return_state : bool, optional
+        If true, also return the state at the last sample
+
+    Returns
+    -------
+    cond_corr : array-like
+        Corrected CTD conductivity [mS/cm]
+    state : tuple of float
+        Filter state to continue the correction with the next chunk (only returned
+        if return_state is true)
+
+    Notes
+    -----
+    See Sea-Bird Seasoft V2 manual (Section 6, page 93) for equation information.
+    Default alpha/beta values taken from Seasoft manual (page 92).
+    c.f. "Thermal Inertia of Conductivity Cells: Theory" (Lueck 1990) for more info
+    https://doi.org/10.1175/1520-0426(1990)007<0741:TIOCCT>2.0.CO;2
+    """
+    temp = np.asarray(temp, dtype=float)
+    a = 2 * alpha / (sample_int * beta + 2)
+    b = 1 - (2 * a / alpha)
+
+    if state is None:  # cast starts with no temperature change or correction
+        state = (temp[0] if temp.size else np.nan, 0.0)
+    temp_prev, CTM_prev = state
+
+    dc_dT = 0.1 * (1 + 0.006 * (temp - 20))
+    dT = np.diff(temp, prepend=temp_prev)
+    forcing = a * dc_dT * dT
+    forcing[~np.isfinite(forcing)] = 0
+
+    CTM, _ = lfilter([1.0], [1.0, b], forcing, zi=[-b * CTM_prev])  # [S/m]
+    cond_corr = cond + CTM * 10.0  # [S/m] to [mS/cm]
+
+    if return_state:
+        if temp.size:
+            state = (temp[-1], CTM[-1])
+        return cond_corr, state
+
+    return cond_corr
+
+
 def wetlabs_eco_fl(volts, coefs, decimals=4):
     """
     SBE equation for converting ECO-FL fluorometer voltage to concentration.
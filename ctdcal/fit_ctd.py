@@ -3,6 +3,7 @@ A module for fitting CTD discrete/bottle and continuous data.
 """
 
 #!/usr/bin/env python
+import itertools
 import logging
 from pathlib import Path
 
@@ -10,7 +11,6 @@ import gsw
 import numpy as np
 import pandas as pd
 import yaml
-from scipy.ndimage import shift
 
 from ctdcal.fitting.common import get_node, NodeNotFoundError
 from . import convert as convert
@@ -18,6 +18,8 @@ from . import ctd_plots as ctd_plots
 from . import flagging as flagging
 from . import get_ctdcal_config
 from . import process_ctd as process_ctd
+from .common import parallel_map
+from .equations_sbe import cell_therm_mass_corr  # noqa: F401
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -79,56 +81,231 @@ def generate_yaml(fname="fit_coefs.yaml", outdir=cfg.dirs['logs']):
     with open(outdir + fname, 'w') as file:
         yaml.dump(data, file, default_flow_style=False)
 
-def write_fit_yaml():
-    """For future use with automated fitting routine(s).
-    i.e., iterate to find best fit parameters, save to file"""
-    pass
 
+# reference parameter, reference flag and cast grouping files for each sensor
+_FIT_SENSORS = {
+    "t1": ("refT", "REFTMP_FLAG_W", "ssscc_t*.csv"),
+    "t2": ("refT", "REFTMP_FLAG_W", "ssscc_t*.csv"),
+    "c1": ("refC", "SALNTY_FLAG_W", "ssscc_c*.csv"),
+    "c2": ("refC", "SALNTY_FLAG_W", "ssscc_c*.csv"),
+}
 
-def cell_therm_mass_corr(temp, cond, sample_int=1 / 24, alpha=0.03, beta=1 / 7):
-    """Correct conductivity signal for effects of cell thermal mass.
+
+def _common_zrange(zRanges):
+    """Pressure range ("zMin:zMax") shared by all zRange strings."""
+    limits = np.array([zRange.split(":") for zRange in zRanges], dtype=int)
+    zMin, zMax = limits[:, 0].max(), limits[:, 1].min()
+    if zMin >= zMax:
+        raise ValueError(f"zRanges {list(zRanges)} do not overlap")
+
+    return f"{zMin}:{zMax}"
+
+
+def _design_matrix(df, fit_vars, terms):
+    """Build the polynomial fit matrix (one column per term) from DataFrame columns."""
+    X = np.ones((len(df), len(terms)))
+    for j, (v, n, _) in enumerate(terms):
+        if v is not None:
+            X[:, j] = df[fit_vars[v][0]].to_numpy(dtype=float) ** n
+
+    return X
+
+
+def _score_fit_orders(df, param, ref, fit_vars, zRanges, max_order=2, n_folds=5):
+    """
+    Cross-validate every combination of fit orders (up to max_order) and zRange for
+    one sensor and group of casts.
+
+    Bottles are split into n_folds folds. Fits are trained on the zRange data outside
+    each fold and scored on the fold's bottles within the pressure range common to all
+    zRanges, so that scores are comparable between candidates. The Gram matrix of each
+    zRange design is formed once and downdated for each fold; candidate fit orders
+    solve the matching sub-block.
+
+    Returns
+    -------
+    scores : DataFrame
+        zRange, fit orders, number of bottles fit and cross-validated RMS residual of
+        each candidate
+    """
+    df = df.reset_index(drop=True)
+    order_keys = [key for _, key, _ in fit_vars]
+    terms = _poly_terms(fit_vars, [max_order] * len(fit_vars))
+    folds = np.random.default_rng(0).permutation(len(df)) % n_folds
+
+    df_eval, _ = _prepare_fit_data(df, param, ref, zRange=_common_zrange(zRanges))
+    X_eval = _design_matrix(df_eval, fit_vars, terms)
+    y_eval = df_eval["Diff"].to_numpy()
+    eval_folds = folds[df_eval.index]
+
+    candidates = list(itertools.product(range(max_order + 1), repeat=len(fit_vars)))
+    scores = []
+    for zRange in zRanges:
+        df_fit, _ = _prepare_fit_data(df, param, ref, zRange=zRange)
+        X = _design_matrix(df_fit, fit_vars, terms)
+        y = df_fit["Diff"].to_numpy()
+        fit_folds = folds[df_fit.index]
+
+        # scale columns to keep the normal equations well conditioned
+        scale = np.abs(X).max(axis=0, initial=0)
+        scale[scale == 0] = 1
+        X, Xe = X / scale, X_eval / scale
+
+        gram, moment = X.T @ X, X.T @ y
+        train = []
+        for k in range(n_folds):
+            in_fold = fit_folds == k
+            train.append(
+                (
+                    gram - X[in_fold].T @ X[in_fold],
+                    moment - X[in_fold].T @ y[in_fold],
+                )
+            )
+
+        for orders in candidates:
+            cols = [
+                j for j, (v, n, _) in enumerate(terms) if v is None or n <= orders[v]
+            ]
+            sq_resid = 0.0
+            for k, (gram_k, moment_k) in enumerate(train):
+                test = eval_folds == k
+                if not test.any():
+                    continue
+                coefs = np.linalg.lstsq(
+                    gram_k[np.ix_(cols, cols)], moment_k[cols], rcond=None
+                )[0]
+                sq_resid += np.sum((y_eval[test] - Xe[test][:, cols] @ coefs) ** 2)
+
+            scores.append(
+                {
+                    "zRange": zRange,
+                    **dict(zip(order_keys, orders)),
+                    "n_fit": len(df_fit),
+                    "cv_rmse": (
+                        np.sqrt(sq_resid / len(y_eval)) if len(y_eval) else np.nan
+                    ),
+                }
+            )
+
+    return pd.DataFrame(scores)
+
+
+def _select_fit_orders(scores, order_keys, rtol=0.01):
+    """
+    Pick the candidate with the fewest fit terms among those scoring within rtol of
+    the best cross-validated RMS residual.
+    """
+    best = scores["cv_rmse"].min()
+    close = scores[scores["cv_rmse"] <= best * (1 + rtol)]
+    n_terms = close[order_keys].sum(axis=1)
+
+    return close.assign(n_terms=n_terms).sort_values(["n_terms", "cv_rmse"]).index[0]
+
+
+def write_fit_yaml(
+    btl_df,
+    zRanges=("500:6000", "1000:6000", "1500:6000"),
+    max_order=2,
+    n_folds=5,
+    max_workers=None,
+    fname=f"{cfg.dirs['logs']}fit_coefs.yaml",
+):
+    """
+    Find polynomial fit orders and zRange for each sensor and group of casts by k-fold
+    cross-validation against the bottle data, and save the best to the fit
+    coefficients .yaml file.
+
+    Candidates are all combinations of P_order, T_order (and C_order for conductivity)
+    from 0 to max_order for each zRange. Among the candidates scoring within 1% of the
+    lowest cross-validated RMS residual, the one with the fewest fit terms is chosen.
+    Scores of every candidate are written to fit_order_scores.csv in the logs folder.
+
+    Sensors without reference data in btl_df (e.g. BTLCOND, which is calculated in
+    calibrate_cond) are skipped, and their existing .yaml entries are kept.
 
     Parameters
     ----------
-    temp : array-like
-        CTD temperature [degC]
-    cond : array-like
-        CTD conductivity [mS/cm]
-    sample_int : float, optional
-        CTD sample interval [seconds]
-    alpha : float, optional
-        Thermal anomaly amplitude
-    beta : float, optional
-        Thermal anomaly time constant
+    btl_df : DataFrame
+        CTD data at bottle stops, with reference data
+    zRanges : list of str, optional
+        Candidate pressure ranges ("zMin:zMax") of bottles to fit
+    max_order : int, optional
+        Highest polynomial order to try for each dependent variable
+    n_folds : int, optional
+        Number of cross-validation folds
+    max_workers : int, optional
+        Maximum number of sensor/cast group searches to run concurrently
+    fname : str, optional
+        Path and filename of the fit coefficients .yaml file
 
     Returns
     -------
-    cond_corr : array-like
-        Corrected CTD conductivity [mS/cm]
-
-    Notes
-    -----
-    See Sea-Bird Seasoft V2 manual (Section 6, page 93) for equation information.
-    Default alpha/beta values taken from Seasoft manual (page 92).
-    c.f. "Thermal Inertia of Conductivity Cells: Theory" (Lueck 1990) for more info
-    https://doi.org/10.1175/1520-0426(1990)007<0741:TIOCCT>2.0.CO;2
+    fit_yaml : dict
+        Fit orders and zRange for each sensor and group of casts, as saved
     """
-    a = 2 * alpha / (sample_int * beta + 2)
-    b = 1 - (2 * a / alpha)
-    dc_dT = 0.1 * (1 + 0.006 * (temp - 20))
-    dT = np.insert(np.diff(temp), 0, 0)  # forward diff reduces len by 1
+    cast_index = process_ctd.get_cast_index(btl_df)
+    jobs, keys = [], []
+    for sN, (ref_key, ref_flag, pattern) in _FIT_SENSORS.items():
+        param, ref = cfg.column[sN], cfg.column[ref_key]
+        if ref not in btl_df.columns:
+            log.warning(f"No {ref} data found, skipping {sN} fit order search")
+            continue
+
+        groups = _load_fit_groups(sorted(Path(cfg.dirs["ssscc"]).glob(pattern)))
+        if not groups:  # same default group as calibrate_temp/calibrate_cond
+            all_casts = btl_df["SSSCC"].unique().tolist()
+            groups = [(pattern.replace("*.csv", "1"), all_casts)]
+
+        good_rows = btl_df[ref_flag] == 2 if ref_flag in btl_df.columns else True
+        for f_stem, ssscc_sublist in groups:
+            rows = process_ctd.get_cast_rows(cast_index, ssscc_sublist, len(btl_df))
+            jobs.append(
+                (
+                    btl_df[rows & good_rows],
+                    param,
+                    ref,
+                    _fit_vars(sN),
+                    zRanges,
+                    max_order,
+                    n_folds,
+                )
+            )
+            keys.append((sN, f_stem))
 
-    def calculate_CTM(b, CTM_0, a, dc_dT, dT):
-        """Return CTM in units of [S/m]"""
-        CTM = -1.0 * b * CTM_0 + a * (dc_dT) * dT
-        return CTM
+    results = parallel_map(
+        lambda job: _score_fit_orders(*job), jobs, max_workers=max_workers
+    )
 
-    CTM = calculate_CTM(b, 0, a, dc_dT, dT)
-    CTM = calculate_CTM(b, shift(CTM, 1, order=0), a, dc_dT, dT)
-    CTM = np.nan_to_num(CTM) * 10.0  # [S/m] to [mS/cm]
-    cond_corr = cond + CTM
+    fit_yaml = {}
+    if Path(fname).exists():
+        with open(fname, "r") as f:
+            fit_yaml = yaml.safe_load(f) or {}
+
+    reports = []
+    for (sN, f_stem), scores in zip(keys, results):
+        order_keys = [key for _, key, _ in _fit_vars(sN)]
+        scores.insert(0, "group", f_stem)
+        scores.insert(0, "sensor", sN)
+        scores["selected"] = False
+        if scores["cv_rmse"].notna().any():
+            best = _select_fit_orders(scores, order_keys)
+            scores.loc[best, "selected"] = True
+            fit_yaml.setdefault(sN, {})[f_stem] = {
+                **{key: int(scores.loc[best, key]) for key in order_keys},
+                "zRange": scores.loc[best, "zRange"],
+            }
+        else:
+            log.warning(f"No {sN} data to cross-validate for {f_stem}, skipping")
+        reports.append(scores)
+
+    with open(fname, "w") as f:
+        yaml.dump(fit_yaml, f, default_flow_style=False)
+    if reports:
+        pd.concat(reports).to_csv(
+            f"{cfg.dirs['logs']}fit_order_scores.csv", index=False
+        )
 
-    return cond_corr
+    return fit_yaml
 
 
 def _flag_btl_data(
@@ -303,7 +480,26 @@ def multivariate_fit(y, *args, coef_names=None, const_name="c0"):
     return dict(zip(names, coefs)) if to_dict else coefs
 
 
-def apply_polyfit(y, y_coefs, *args):
+def _horner_add(out, x, coefs, buf, where=True):
+    """
+    Add coef1 * x + coef2 * x ** 2 + ... to out in place using Horner's method.
+
+    Coefficients can be scalars or arrays matching x (e.g. gathered per row). buf is
+    scratch space the size of out.
+    """
+    if len(coefs) == 0:
+        return out
+
+    np.multiply(x, coefs[-1], out=buf)
+    for coef in coefs[-2::-1]:
+        buf += coef
+        buf *= x
+    np.add(out, buf, out=out, where=where)
+
+    return out
+
+
+def apply_polyfit(y, y_coefs, *args, out=None):
     """
     Apply a polynomial correction to series of data. Coefficients should be provided in
     increasing order (i.e., a0, a1, a2 for y_fit = y + a2 * y ** 2 + a1 * y + a0)
@@ -320,6 +516,8 @@ def apply_polyfit(y, y_coefs, *args):
         Independent variable fit coefficients (i.e., (coef0, ..., coefN))
     args : tuple of (array-like, (float, float, ...))
         Dependent variable data and fit coefficients (i.e., (data, (coef1, ..., coefN)))
+    out : ndarray, optional
+        Array to store the result in. Must not overlap y or the dependent variables.
 
     Returns
     -------
@@ -345,151 +543,363 @@ def apply_polyfit(y, y_coefs, *args):
 
     where fitted_y = y + y0 + (x1 * x) + (x2 * x ** 2)
     """
-    fitted_y = np.copy(y).astype(float)
-    for n, coef in enumerate(y_coefs):
-        fitted_y += coef * np.power(y, n)
-
     for arg in args:
         if type(arg) is not tuple:
             raise TypeError(f"Positional args must be tuples, not {type(arg)}")
 
-        series, coefs = arg
-        for n, coef in enumerate(coefs):
-            fitted_y += coef * np.power(series, n + 1)
+    # y + y0 + (y1 * y) + ... is one polynomial in y, evaluated with Horner's method
+    y = np.asarray(y, dtype=float)
+    poly = list(y_coefs) + [0] * (2 - len(y_coefs))
+    poly[1] += 1
+    fitted_y = np.empty(y.shape) if out is None else out
+    fitted_y.fill(poly[-1])
+    for coef in poly[-2::-1]:
+        fitted_y *= y
+        fitted_y += coef
+
+    buf = np.empty_like(fitted_y) if args else None
+    for series, coefs in args:
+        _horner_add(fitted_y, np.asarray(series, dtype=float), coefs, buf)
 
     return fitted_y
 
 
-def calibrate_temp(btl_df, time_df):
+def _load_fit_groups(ssscc_subsets):
+    """Read each cast grouping file once, as (file stem, list of SSSCC) pairs."""
+    return [
+        (f.stem, pd.read_csv(f, header=None, dtype="str").squeeze(axis=1).to_list())
+        for f in ssscc_subsets
+    ]
+
+
+def _group_ids(cast_index, groups, n_rows):
     """
-    Least-squares fit CTD temperature data against reference data.
+    Label each row with the position of its cast group in groups (-1 for rows not
+    belonging to any group).
+    """
+    group_ids = np.full(n_rows, -1)
+    for g, (_, ssscc_sublist) in enumerate(groups):
+        for ssscc in ssscc_sublist:
+            rows = cast_index[ssscc]
+            if (group_ids[rows] != -1).any():
+                raise ValueError(f"Cast {ssscc} is in more than one fit group")
+            group_ids[rows] = g
+
+    return group_ids
+
+
+def _fit_vars(sN):
+    """Dependent variables (column, order key, coef root) used to calibrate a sensor."""
+    fit_vars = [
+        (cfg.column["p"], "P_order", "cp"),
+        (cfg.column[f"t{sN[-1]}"], "T_order", "ct"),
+    ]
+    if sN.startswith("c"):
+        fit_vars.append((cfg.column[sN], "C_order", "cc"))
+
+    return fit_vars
+
+
+def _poly_terms(fit_vars, orders):
+    """
+    List the (dependent variable position, power, coef name) of each polynomial term,
+    in multivariate_fit order, followed by the constant offset term (None, 0, "c0").
+    """
+    terms = [
+        (v, n, f"{root}{n}")
+        for v, ((_, _, root), order) in enumerate(zip(fit_vars, orders))
+        for n in range(order, 0, -1)
+    ]
+    terms.append((None, 0, "c0"))
+
+    return terms
+
+
+def _batch_multivariate_fit(fit_frames, fit_params, fit_vars):
+    """
+    Least-squares fit the residual ("Diff") of every group of casts in one batch.
+
+    Each group keeps its own polynomial orders. Design matrices are padded with zero
+    rows and columns up to the largest group size and fit orders, which leaves each
+    group's (minimum-norm) least-squares solution unchanged, and solved together.
 
     Parameters
-    -----------
-    btl_df : DataFrame
-        CTD data at bottle stops
-    time_df : DataFrame
-        Continuous CTD data
+    ----------
+    fit_frames : list of DataFrame
+        Data to fit for each group, as returned by _prepare_fit_data
+    fit_params : list of dict
+        Fit orders for each group (e.g. {"P_order": 1, "T_order": 0})
+    fit_vars : list of tuple
+        (column, order key, coef root) for each dependent variable
 
     Returns
-    --------
+    -------
+    terms : list of tuple
+        (dependent variable position, power, coef name) for each fit term, in
+        multivariate_fit order; the constant offset term has no variable (None)
+    coef_table : ndarray
+        Fit coefficients with one row per group and one column per term, plus a
+        final row of zeros for data not belonging to any group
+    used : ndarray
+        Boolean table (same shape as coef_table) of the terms fit in each group
+    """
+    max_orders = [max(params[key] for params in fit_params) for _, key, _ in fit_vars]
+    terms = _poly_terms(fit_vars, max_orders)
+
+    n_groups = len(fit_frames)
+    used = np.zeros((n_groups + 1, len(terms)), dtype=bool)
+    for g, params in enumerate(fit_params):
+        used[g] = [v is None or n <= params[fit_vars[v][1]] for v, n, _ in terms]
+
+    n_rows = max([len(df) for df in fit_frames] + [1])
+    design = np.zeros((n_groups, n_rows, len(terms)))
+    diff = np.zeros((n_groups, n_rows, 1))
+    for g, df in enumerate(fit_frames):
+        for j, (v, n, _) in enumerate(terms):
+            if used[g, j]:
+                design[g, : len(df), j] = 1 if v is None else df[fit_vars[v][0]] ** n
+        diff[g, : len(df), 0] = df["Diff"]
+
+    coef_table = np.zeros((n_groups + 1, len(terms)))
+    if n_groups:
+        coef_table[:-1] = (np.linalg.pinv(design) @ diff)[..., 0]
+
+    return terms, coef_table, used
+
 
+def _apply_batch_polyfit(y, data, terms, coef_table, used, group_ids):
     """
-    log.info("Calibrating temperature")
-    ssscc_subsets = sorted(Path(cfg.dirs["ssscc"]).glob("ssscc_t*.csv"))
-    if not ssscc_subsets:  # if no t-segments exists, write one from full list
-        log.debug(
-            "No CTDTMP grouping file found... creating ssscc_t1.csv with all casts"
-        )
-        if not Path(cfg.dirs["ssscc"]).exists():
-            Path(cfg.dirs["ssscc"]).mkdir()
-        ssscc_list = process_ctd.get_ssscc_list()
-        ssscc_subsets = [Path(cfg.dirs["ssscc"] + "ssscc_t1.csv")]
-        pd.Series(ssscc_list).to_csv(ssscc_subsets[0], header=None, index=False)
+    Apply the polynomial correction of each group to its rows in a single pass.
 
-    fit_yaml = load_fit_yaml()  # load fit polynomial order
-    for tN in ["t1", "t2"]:
-        T_flag, T_fit_coefs = pd.DataFrame(), pd.DataFrame()
-        for f in ssscc_subsets:
-            # 0) load ssscc subset to be fit together
-            ssscc_sublist = (
-                pd.read_csv(f, header=None, dtype="str").squeeze(axis=1).to_list()
+    Parameters
+    ----------
+    y : array-like
+        Independent variable data to be corrected
+    data : list of array-like
+        Dependent variable data, in fit_vars order
+    terms, coef_table, used
+        Fit terms and coefficients, as returned by _batch_multivariate_fit
+    group_ids : array-like of int
+        Group of each row (-1 for rows left uncorrected)
+
+    Returns
+    -------
+    fitted_y : ndarray
+        Independent variable data with polynomial fit corrections applied
+    """
+    fitted_y = np.array(y, dtype=float)
+    fitted_y += coef_table[group_ids, -1]  # constant offset (zero outside groups)
+
+    buf = np.empty_like(fitted_y)
+    for v, x in enumerate(data):
+        cols = [j for j, (var, _, _) in enumerate(terms) if var == v]
+        if cols:
+            _horner_add(
+                fitted_y,
+                np.asarray(x, dtype=float),
+                [coef_table[group_ids, j] for j in reversed(cols)],
+                buf,
+                where=used[group_ids, cols[-1]],  # groups fitting this variable
             )
-            btl_rows = btl_df["SSSCC"].isin(ssscc_sublist).values
-            good_rows = btl_rows & (btl_df["REFTMP_FLAG_W"] == 2)
-            time_rows = time_df["SSSCC"].isin(ssscc_sublist).values
 
-            # 1) plot pre-fit residual
-            f_stem = f.stem  # get "ssscc_t*" from path
+    return fitted_y
+
+
+def _fit_sensor(fit_frames, fit_params, param, ref, fit_vars, btl_data, time_data):
+    """
+    Fit all cast groups for one sensor and compute corrected btl/time data.
+
+    btl_data and time_data are (y, dependent variable data, group ids) tuples.
+    """
+    fit_data = [
+        _prepare_fit_data(df, param, ref, zRange=params["zRange"])[0]
+        for df, params in zip(fit_frames, fit_params)
+    ]
+    terms, coef_table, used = _batch_multivariate_fit(fit_data, fit_params, fit_vars)
+    coef_dicts = [
+        {name: coefs[j] for j, (_, _, name) in enumerate(terms) if group_used[j]}
+        for coefs, group_used in zip(coef_table[:-1], used[:-1])
+    ]
+    btl_fit = _apply_batch_polyfit(
+        btl_data[0], btl_data[1], terms, coef_table, used, btl_data[2]
+    )
+    time_fit = _apply_batch_polyfit(
+        time_data[0], time_data[1], terms, coef_table, used, time_data[2]
+    )
+
+    return btl_fit, time_fit, fit_data, coef_dicts
+
+
+def _calibrate_groups(
+    btl_df, time_df, groups, sensors, ref, ref_flag, units, coef_names
+):
+    """
+    Fit, apply, flag and export polynomial corrections for each sensor and each
+    group of casts.
+
+    Groups are assigned once for all sensors and every group of a sensor is fit in
+    one batch. The sensors (e.g. primary and secondary) are fit concurrently; plots
+    and exports are made afterwards in the calling thread.
+
+    Parameters
+    ----------
+    btl_df : DataFrame
+        CTD data at bottle stops
+    time_df : DataFrame
+        Continuous CTD data
+    groups : list of tuple
+        (file stem, list of SSSCC) for each group of casts fit together
+    sensors : dict
+        Fit variables for each sensor to calibrate, keyed by name (e.g. "t1"), as
+        lists of (column, order key, coef root); the sensor's own column included
+    ref : str
+        Name of reference parameter (e.g. "T90", "BTLCOND")
+    ref_flag : str
+        Name of reference parameter flag column
+    units : str
+        Residual units for plot labels
+    coef_names : list of str
+        Coefficients always written to the fit_coef_*.csv exports
+    """
+    fit_yaml = load_fit_yaml()  # load fit polynomial order
+    btl_groups = _group_ids(process_ctd.get_cast_index(btl_df), groups, len(btl_df))
+    time_groups = _group_ids(process_ctd.get_cast_index(time_df), groups, len(time_df))
+    prs = cfg.column["p"]
+
+    jobs = []
+    for sN, fit_vars in sensors.items():
+        param = cfg.column[sN]
+        fit_frames = []
+        for g, (f_stem, _) in enumerate(groups):
+            btl_rows = btl_groups == g
+
+            # plot pre-fit residual
             ctd_plots._intermediate_residual_plot(
-                btl_df.loc[btl_rows, cfg.column["refT"]]
-                - btl_df.loc[btl_rows, cfg.column[tN]],
-                btl_df.loc[btl_rows, cfg.column["p"]],
+                btl_df.loc[btl_rows, ref] - btl_df.loc[btl_rows, param],
+                btl_df.loc[btl_rows, prs],
                 btl_df.loc[btl_rows, "SSSCC"],
-                xlabel=f"{tN.upper()} Residual (T90 C)",
-                f_out=f"{cfg.fig_dirs[tN]}residual_{f_stem}_prefit.pdf",
+                xlabel=f"{sN.upper()} Residual ({units})",
+                f_out=f"{cfg.fig_dirs[sN]}residual_{f_stem}_prefit.pdf",
             )
-
-            # 2) prepare data for fitting
-            # NOTE: df_bad will be overwritten during post-fit data flagging but is
-            # left here for future debugging (if necessary)
-            df_good, df_bad = _prepare_fit_data(
-                btl_df[good_rows],
-                cfg.column[tN],
-                cfg.column["refT"],
-                zRange=fit_yaml[tN][f_stem]["zRange"],
-            )
-            ctd_plots._intermediate_residual_plot(
-                df_good["Diff"],
-                df_good[cfg.column["p"]],
-                df_good["SSSCC"],
-                xlabel=f"{tN.upper()} Residual (T90 C)",
-                f_out=f"{cfg.fig_dirs[tN]}residual_{f_stem}_fit_data.pdf",
+            fit_frames.append(btl_df[btl_rows & (btl_df[ref_flag] == 2)])
+
+        columns = [col for col, _, _ in fit_vars]
+        jobs.append(
+            (
+                fit_frames,
+                [fit_yaml[sN][f_stem] for f_stem, _ in groups],
+                param,
+                ref,
+                fit_vars,
+                (
+                    btl_df[param].to_numpy(),
+                    [btl_df[col].to_numpy() for col in columns],
+                    btl_groups,
+                ),
+                (
+                    time_df[param].to_numpy(),
+                    [time_df[col].to_numpy() for col in columns],
+                    time_groups,
+                ),
             )
+        )
 
-            # 3) calculate fit coefs
-            P_order = fit_yaml[tN][f_stem]["P_order"]
-            T_order = fit_yaml[tN][f_stem]["T_order"]
-            coef_dict = multivariate_fit(
-                df_good["Diff"],
-                (df_good[cfg.column["p"]], P_order),
-                (df_good[cfg.column[tN]], T_order),
-                coef_names=["cp", "ct"],
-            )
+    results = parallel_map(lambda job: _fit_sensor(*job), jobs, max_workers=2)
 
-            # 4) apply fit
-            P_coefs = tuple(coef_dict[f"cp{n}"] for n in np.arange(1, P_order + 1))
-            T_coefs = tuple(coef_dict[f"ct{n}"] for n in np.arange(1, T_order + 1))
-            btl_df.loc[btl_rows, cfg.column[tN]] = apply_polyfit(
-                btl_df.loc[btl_rows, cfg.column[tN]],
-                (coef_dict["c0"],) + T_coefs,
-                (btl_df.loc[btl_rows, cfg.column["p"]], P_coefs),
-            )
-            time_df.loc[time_rows, cfg.column[tN]] = apply_polyfit(
-                time_df.loc[time_rows, cfg.column[tN]],
-                (coef_dict["c0"],) + T_coefs,
-                (time_df.loc[time_rows, cfg.column["p"]], P_coefs),
+    for sN, (btl_fit, time_fit, fit_data, coef_dicts) in zip(sensors, results):
+        param = cfg.column[sN]
+        xlabel = f"{sN.upper()} Residual ({units})"
+        btl_df[param] = btl_fit
+        time_df[param] = time_fit
+
+        flags, fit_coefs = [pd.DataFrame()], [pd.DataFrame()]
+        for g, (f_stem, ssscc_sublist) in enumerate(groups):
+            ctd_plots._intermediate_residual_plot(
+                fit_data[g]["Diff"],
+                fit_data[g][prs],
+                fit_data[g]["SSSCC"],
+                xlabel=xlabel,
+                f_out=f"{cfg.fig_dirs[sN]}residual_{f_stem}_fit_data.pdf",
             )
 
-            # 4.5) flag CTDTMP and make residual plots
+            # flag data and make residual plots
             df_ques, df_bad = _flag_btl_data(
-                btl_df[btl_rows],
-                param=cfg.column[tN],
-                ref=cfg.column["refT"],
-                f_out=f"{cfg.fig_dirs[tN]}residual_{f_stem}.pdf",
+                btl_df[btl_groups == g],
+                param=param,
+                ref=ref,
+                f_out=f"{cfg.fig_dirs[sN]}residual_{f_stem}.pdf",
             )
+            flags.extend([df_bad, df_ques])
 
-            # 5) handle quality flags
-            T_flag = pd.concat([T_flag, df_bad, df_ques])
-
-            # 6) handle fit params
+            # handle fit params
             coef_df = pd.DataFrame()
             coef_df["SSSCC"] = ssscc_sublist
-            coef_names = ["cp2", "cp1", "ct2", "ct1", "c0"]
             coef_df[coef_names] = 0.0
-            for k, v in coef_dict.items():
+            for k, v in coef_dicts[g].items():
                 coef_df[k] = v
-
-            T_fit_coefs = pd.concat([T_fit_coefs, coef_df])
+            fit_coefs.append(coef_df)
 
         # one more fig with all cuts
         ctd_plots._intermediate_residual_plot(
-            btl_df[cfg.column["refT"]] - btl_df[cfg.column[tN]],
-            btl_df[cfg.column["p"]],
+            btl_df[ref] - btl_df[param],
+            btl_df[prs],
             btl_df["SSSCC"],
-            xlabel=f"{tN.upper()} Residual (T90 C)",
+            xlabel=xlabel,
             show_thresh=True,
-            f_out=f"{cfg.fig_dirs[tN]}residual_all_postfit.pdf",
+            f_out=f"{cfg.fig_dirs[sN]}residual_all_postfit.pdf",
         )
 
-        # export temp quality flags
-        T_flag.sort_index().to_csv(f"{cfg.dirs['logs']}qual_flag_{tN}.csv", index=False)
+        # export quality flags
+        flag_df = pd.concat(flags)
+        flag_df.sort_index().to_csv(
+            f"{cfg.dirs['logs']}qual_flag_{sN}.csv", index=False
+        )
 
-        # export temp fit params (formated to 5 sig figs, scientific notation)
-        T_fit_coefs[coef_names] = T_fit_coefs[coef_names].applymap(
+        # export fit params (formated to 5 sig figs, scientific notation)
+        fit_coef_df = pd.concat(fit_coefs)
+        fit_coef_df[coef_names] = fit_coef_df[coef_names].applymap(
             lambda x: np.format_float_scientific(x, precision=4, exp_digits=1)
         )
-        T_fit_coefs.to_csv(cfg.dirs["logs"] + f"fit_coef_{tN}.csv", index=False)
+        fit_coef_df.to_csv(cfg.dirs["logs"] + f"fit_coef_{sN}.csv", index=False)
+
+
+def calibrate_temp(btl_df, time_df):
+    """
+    Least-squares fit CTD temperature data against reference data.
+
+    Parameters
+    -----------
+    btl_df : DataFrame
+        CTD data at bottle stops
+    time_df : DataFrame
+        Continuous CTD data
+
+    Returns
+    --------
+
+    """
+    log.info("Calibrating temperature")
+    ssscc_subsets = sorted(Path(cfg.dirs["ssscc"]).glob("ssscc_t*.csv"))
+    if not ssscc_subsets:  # if no t-segments exists, write one from full list
+        log.debug(
+            "No CTDTMP grouping file found... creating ssscc_t1.csv with all casts"
+        )
+        if not Path(cfg.dirs["ssscc"]).exists():
+            Path(cfg.dirs["ssscc"]).mkdir()
+        ssscc_list = process_ctd.get_ssscc_list()
+        ssscc_subsets = [Path(cfg.dirs["ssscc"] + "ssscc_t1.csv")]
+        pd.Series(ssscc_list).to_csv(ssscc_subsets[0], header=None, index=False)
+
+    _calibrate_groups(
+        btl_df,
+        time_df,
+        _load_fit_groups(ssscc_subsets),
+        {tN: _fit_vars(tN) for tN in ["t1", "t2"]},
+        ref=cfg.column["refT"],
+        ref_flag="REFTMP_FLAG_W",
+        units="T90 C",
+        coef_names=["cp2", "cp1", "ct2", "ct1", "c0"],
+    )
 
     # flag temperature data
     time_df["CTDTMP_FLAG_W"] = 2
@@ -558,114 +968,16 @@ def calibrate_cond(btl_df, time_df, user_cfg, ref_node):
         ssscc_subsets = [Path(cfg.dirs["ssscc"] + "ssscc_c1.csv")]
         pd.Series(ssscc_list).to_csv(ssscc_subsets[0], header=None, index=False)
 
-    fit_yaml = load_fit_yaml()  # load fit polynomial order
-    for cN, tN in zip(["c1", "c2"], ["t1", "t2"]):
-        C_flag, C_fit_coefs = pd.DataFrame(), pd.DataFrame()
-        for f in ssscc_subsets:
-            # 0) grab ssscc chunk to fit
-            ssscc_sublist = (
-                pd.read_csv(f, header=None, dtype="str").squeeze(axis=1).to_list()
-            )
-            btl_rows = btl_df["SSSCC"].isin(ssscc_sublist).values
-            good_rows = btl_rows & (btl_df["SALNTY_FLAG_W"] == 2)
-            time_rows = time_df["SSSCC"].isin(ssscc_sublist).values
-
-            # 1) plot pre-fit residual
-            f_stem = f.stem  # get "ssscc_c*" from path
-            ctd_plots._intermediate_residual_plot(
-                btl_df.loc[btl_rows, cfg.column["refC"]]
-                - btl_df.loc[btl_rows, cfg.column[cN]],
-                btl_df.loc[btl_rows, cfg.column["p"]],
-                btl_df.loc[btl_rows, "SSSCC"],
-                xlabel=f"{cN.upper()} Residual (mS/cm)",
-                f_out=f"{cfg.fig_dirs[cN]}residual_{f_stem}_prefit.pdf",
-            )
-
-            # 2) prepare data for fitting
-            # NOTE: df_bad will be overwritten during post-fit data flagging
-            # but is left here for future debugging (if necessary)
-            df_good, df_bad = _prepare_fit_data(
-                btl_df[good_rows],
-                cfg.column[cN],
-                cfg.column["refC"],
-                zRange=fit_yaml[cN][f_stem]["zRange"],
-            )
-            ctd_plots._intermediate_residual_plot(
-                df_good["Diff"],
-                df_good[cfg.column["p"]],
-                df_good["SSSCC"],
-                xlabel=f"{cN.upper()} Residual (mS/cm)",
-                f_out=f"{cfg.fig_dirs[cN]}residual_{f_stem}_fit_data.pdf",
-            )
-
-            # 3) calculate fit coefs
-            P_order = fit_yaml[cN][f_stem]["P_order"]
-            T_order = fit_yaml[cN][f_stem]["T_order"]
-            C_order = fit_yaml[cN][f_stem]["C_order"]
-            coef_dict = multivariate_fit(
-                df_good["Diff"],
-                (df_good[cfg.column["p"]], P_order),
-                (df_good[cfg.column[tN]], T_order),
-                (df_good[cfg.column[cN]], C_order),
-                coef_names=["cp", "ct", "cc"],
-            )
-
-            # 4) apply fit
-            P_coefs = tuple(coef_dict[f"cp{n}"] for n in np.arange(1, P_order + 1))
-            T_coefs = tuple(coef_dict[f"ct{n}"] for n in np.arange(1, T_order + 1))
-            C_coefs = tuple(coef_dict[f"cc{n}"] for n in np.arange(1, C_order + 1))
-            btl_df.loc[btl_rows, cfg.column[cN]] = apply_polyfit(
-                btl_df.loc[btl_rows, cfg.column[cN]],
-                (coef_dict["c0"],) + C_coefs,
-                (btl_df.loc[btl_rows, cfg.column["p"]], P_coefs),
-                (btl_df.loc[btl_rows, cfg.column[tN]], T_coefs),
-            )
-            time_df.loc[time_rows, cfg.column[cN]] = apply_polyfit(
-                time_df.loc[time_rows, cfg.column[cN]],
-                (coef_dict["c0"],) + C_coefs,
-                (time_df.loc[time_rows, cfg.column["p"]], P_coefs),
-                (time_df.loc[time_rows, cfg.column[tN]], T_coefs),
-            )
-
-            # 4.5) flag CTDCOND and make residual plots
-            df_ques, df_bad = _flag_btl_data(
-                btl_df[btl_rows],
-                param=cfg.column[cN],
-                ref=cfg.column["refC"],
-                f_out=f"{cfg.fig_dirs[cN]}residual_{f_stem}.pdf",
-            )
-
-            # 5) handle quality flags
-            C_flag = pd.concat([C_flag, df_bad, df_ques])
-
-            # 6) handle fit params
-            coef_df = pd.DataFrame()
-            coef_df["SSSCC"] = ssscc_sublist
-            coef_names = ["cp2", "cp1", "ct2", "ct1", "cc2", "cc1", "c0"]
-            coef_df[coef_names] = 0.0
-            for k, v in coef_dict.items():
-                coef_df[k] = v
-
-            C_fit_coefs = pd.concat([C_fit_coefs, coef_df])
-
-        # one more fig with all cuts
-        ctd_plots._intermediate_residual_plot(
-            btl_df[cfg.column["refC"]] - btl_df[cfg.column[cN]],
-            btl_df[cfg.column["p"]],
-            btl_df["SSSCC"],
-            xlabel=f"{cN.upper()} Residual (mS/cm)",
-            show_thresh=True,
-            f_out=f"{cfg.fig_dirs[cN]}residual_all_postfit.pdf",
-        )
-
-        # export cond quality flags
-        C_flag.sort_index().to_csv(f"{cfg.dirs['logs']}qual_flag_{cN}.csv", index=False)
-
-        # export cond fit params
-        C_fit_coefs[coef_names] = C_fit_coefs[coef_names].applymap(
-            lambda x: np.format_float_scientific(x, precision=4, exp_digits=1)
-        )
-        C_fit_coefs.to_csv(cfg.dirs["logs"] + f"fit_coef_{cN}.csv", index=False)
+    _calibrate_groups(
+        btl_df,
+        time_df,
+        _load_fit_groups(ssscc_subsets),
+        {cN: _fit_vars(cN) for cN in ["c1", "c2"]},
+        ref=cfg.column["refC"],
+        ref_flag="SALNTY_FLAG_W",
+        units="mS/cm",
+        coef_names=["cp2", "cp1", "ct2", "ct1", "cc2", "cc1", "c0"],
+    )
 
     # recalculate salinity with calibrated C/T
     time_df[cfg.column["sal"]] = gsw.SP_from_C(
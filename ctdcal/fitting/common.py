@@ -2,9 +2,21 @@
 Classes, definitions and utilities for use across ctdcal fitting modules.
 """
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
 
+import numpy as np
+import pandas as pd
+import scipy
 from munch import Munch
 
+log = logging.getLogger(__name__)
+
 
 class BottleFlags(Munch):
     """
@@ -64,6 +76,138 @@ class NodeNotFoundError(Exception):
     pass
 
 
+class FlagStore:
+    """
+    Bottle flags stored in an SQLite database, indexed on node, cast and bottle
+    number. An alternative to BottleFlags files for large or frequently updated
+    flag sets: rows are upserted in place instead of rewriting the whole file,
+    and nodes are returned as DataFrames.
+
+    Flag nodes have the keys "cast_id", "bottle_num", "value" and "notes".
+
+    Parameters
+    ----------
+    fname : str or Path-like
+        Name of the database file. Created if it does not exist.
+    """
+    KEYS = ["cast_id", "bottle_num", "value", "notes"]
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.con = sqlite3.connect(fname)
+        with self.con:
+            self.con.execute(
+                "CREATE TABLE IF NOT EXISTS flags ("
+                "node TEXT NOT NULL, cast_id TEXT NOT NULL, "
+                "bottle_num INTEGER NOT NULL, value INTEGER, notes TEXT, "
+                "PRIMARY KEY (node, cast_id, bottle_num))"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def nodes(self):
+        """Return the names of all nodes in the store."""
+        rows = self.con.execute("SELECT DISTINCT node FROM flags ORDER BY node")
+        return [node for (node,) in rows]
+
+    def upsert(self, label, node):
+        """
+        Add or update flags in a node, in a single transaction. Existing flags
+        for the same cast and bottle are replaced.
+
+        Parameters
+        ----------
+        label : str
+            Name of the node.
+        node : DataFrame, BottleFlags or dict of lists
+            Flag data with the keys "cast_id", "bottle_num", "value" and
+            (optionally) "notes".
+        """
+        df = pd.DataFrame(node).reindex(columns=self.KEYS)
+        df = df.astype(object).where(df.notna(), None)
+        rows = zip(
+            [label] * len(df),
+            df["cast_id"].map(str),
+            df["bottle_num"].map(int),
+            df["value"].map(lambda v: None if v is None else int(v)),
+            df["notes"],
+        )
+        with self.con:
+            self.con.executemany(
+                "INSERT INTO flags VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (node, cast_id, bottle_num) "
+                "DO UPDATE SET value = excluded.value, notes = excluded.notes",
+                rows,
+            )
+
+    def get_node(self, label, cast_id=None):
+        """
+        Return a node as a DataFrame, in the order flags were first added.
+
+        Parameters
+        ----------
+        label : str
+            Name of the node to return.
+        cast_id : list of str, optional
+            Only return flags for these casts.
+
+        Returns
+        -------
+        DataFrame
+        """
+        query = "SELECT cast_id, bottle_num, value, notes FROM flags WHERE node = ?"
+        params = [label]
+        if cast_id is not None:
+            cast_id = [str(c) for c in cast_id]
+            query += " AND cast_id IN (%s)" % ", ".join("?" * len(cast_id))
+            params += cast_id
+        df = pd.read_sql_query(query + " ORDER BY rowid", self.con, params=params)
+        if df.empty and label not in self.nodes():
+            raise NodeNotFoundError(
+                "The node '%s' was not found in %s" % (label, self.fname)
+            )
+        return df
+
+    def import_json(self, fname):
+        """
+        Upsert every node of a BottleFlags file into the store.
+
+        Parameters
+        ----------
+        fname : str or Path-like
+            Name of the BottleFlags file.
+        """
+        with open(fname, 'r') as f:
+            buf = f.read()
+        flags = json.loads(buf) if buf != '' else {}
+        for label, node in flags.items():
+            self.upsert(label, node)
+
+    def export_json(self, fname):
+        """
+        Write every node of the store to a BottleFlags file. Existing contents of
+        the file will be overwritten.
+
+        Parameters
+        ----------
+        fname : str or Path-like
+            Name of the BottleFlags file.
+        """
+        flags = BottleFlags()
+        for label in self.nodes():
+            df = self.get_node(label)
+            df = df.astype(object).where(df.notna(), None)
+            flags[label] = df_node_to_BottleFlags(df)
+        flags.save(fname)
+
+
 # Function definitions
 # --------------------
 
@@ -90,7 +234,8 @@ def df_node_to_BottleFlags(df):
 
 def get_node(fname, label):
     """
-    Return a node from a BottleFlags file.
+    Return a node from a BottleFlags file, including any flags appended to its
+    journal which have not yet been compacted into the file.
 
     Parameters
     ----------
@@ -103,18 +248,25 @@ def get_node(fname, label):
     -------
     BottleFlags object
     """
+    # journal read first: entries compacted in the meantime are simply reapplied
+    entries = [e for e in _read_flag_journal(fname) if e["node"] == label]
     with open(fname, 'r') as f:
-        flags = json.load(f)
-        if label in flags:
-            return BottleFlags(flags[label])
-        else:
-            raise NodeNotFoundError
+        buf = f.read()
+    flags = json.loads(buf) if buf != '' else {}
+    if label in flags:
+        return BottleFlags(_merge_flag_entries(flags[label], entries))
+    elif entries:
+        return BottleFlags(_merge_flag_entries({}, entries))
+    else:
+        raise NodeNotFoundError
 
 
 def save_node(fname, node, label, create_new=False):
     """
     Save an updated node to a BottleFlags file. The file must already exist.
-    Optionally create a new node if the named node does not exist.
+    Optionally create a new node if the named node does not exist. Flags pending in
+    the file's journal are compacted into the file first, so the saved node
+    replaces them.
 
     Parameters
     ----------
@@ -128,15 +280,417 @@ def save_node(fname, node, label, create_new=False):
         If true, create a new node if it does not exist. Default is false.
 
     """
+    # pending journal entries are merged in first, so this write wins over them
+    with _lock_file(Path(str(fname) + ".lock")):
+        flags, compacting = _load_compacted(fname)
+        if label in flags or create_new is True:
+            flags[label] = node
+        else:
+            raise NodeNotFoundError(
+                "The node '%s' was not found in %s" % (label, fname)
+            )
+        _save_compacted(fname, flags, compacting)
+
+
+# BottleFlag journal
+# Flags appended with append_flags() are written as one JSON object per line to
+# "<fname>.journal". compact_flags() merges the journal into the BottleFlags file.
+def _journal_files(fname):
+    """Return the (compacting, current) journal files of a BottleFlags file."""
+    journal = Path(str(fname) + ".journal")
+    return journal.with_name(journal.name + ".compacting"), journal
+
+
+def _read_journal_file(journal):
+    """Return the entries of one journal file, skipping incomplete lines."""
+    entries = []
+    if not journal.exists():
+        return entries
+    with open(journal, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                log.warning("Skipping incomplete flag entry in %s" % journal)
+    return entries
+
+
+def _read_flag_journal(fname):
+    """Return the entries of all journals of a BottleFlags file, oldest first."""
+    compacting, journal = _journal_files(fname)
+    # current journal read first, in case it is moved for compaction meanwhile
+    entries = _read_journal_file(journal)
+    return _read_journal_file(compacting) + entries
+
+
+# locks older than this (in seconds) are assumed to be left by a crashed process
+STALE_LOCK_AGE = 600
+
+
+def _break_stale_lock(lock, stale_age):
+    """
+    Remove a lock file older than stale_age seconds. The lock is moved aside
+    atomically and only deleted if it is still the file that was judged stale, so
+    a lock just taken by another waiter is never removed.
+    """
+    try:
+        stale = os.stat(lock)
+    except FileNotFoundError:
+        return
+    age = time.time() - stale.st_mtime
+    if age <= stale_age:
+        return
+
+    aside = Path("%s.%d.%d.stale" % (lock, os.getpid(), threading.get_ident()))
+    try:
+        os.rename(lock, aside)
+    except FileNotFoundError:
+        return  # already broken by another waiter
+    moved = os.stat(aside)
+    if (moved.st_ino, moved.st_mtime_ns) == (stale.st_ino, stale.st_mtime_ns):
+        log.warning("Removing stale lock %s (%.0f s old)" % (lock, age))
+        os.remove(aside)
+        return
+
+    # another waiter broke the stale lock and took a fresh one first; put it back
+    try:
+        os.link(aside, lock)
+    except FileExistsError:
+        log.warning(
+            "Lost track of lock %s while removing a stale lock; if flags were being "
+            "written at the time, check the flag file" % lock
+        )
+    os.remove(aside)
+
+
+def _try_lock(lock, stale_age=STALE_LOCK_AGE):
+    """
+    Create a lock file holding this process's PID, breaking it first if it is
+    older than stale_age seconds. Returns True if the lock was acquired.
+    """
+    _break_stale_lock(lock, stale_age)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def _lock_owner(lock):
+    """Return the PID written to a lock file, or "unknown" if it can't be read."""
+    try:
+        with open(lock, 'r') as f:
+            return f.read().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+@contextmanager
+def _lock_file(lock, timeout=10):
+    """
+    Hold a lock file, waiting up to timeout seconds for it to be released. The
+    wait between attempts doubles from 1 ms up to 100 ms.
+    """
+    start = time.monotonic()
+    delay = 0.001
+    while not _try_lock(lock):
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(
+                "Timed out waiting for %s (held by PID %s), remove it if no "
+                "other process is using the flag file" % (lock, _lock_owner(lock))
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+    try:
+        yield
+    finally:
+        os.remove(lock)
+
+
+def _merge_flag_entries(node, entries):
+    """
+    Upsert journal entries into a node (dict of lists), matching existing rows
+    on cast_id and bottle_num. The node is modified in place and returned.
+    """
+    if not entries:
+        return node
+    n_rows = len(next(iter(node.values()), []))
+    keys = zip(node.get("cast_id", []), node.get("bottle_num", []))
+    rows = {key: i for i, key in enumerate(keys)}
+    for entry in entries:
+        for k in entry:
+            if k != "node" and k not in node:
+                node[k] = [None] * n_rows
+        i = rows.get((entry["cast_id"], entry["bottle_num"]))
+        if i is None:
+            rows[(entry["cast_id"], entry["bottle_num"])] = n_rows
+            n_rows += 1
+            for k, v in node.items():
+                v.append(entry.get(k))
+        else:
+            for k, v in node.items():
+                v[i] = entry.get(k)
+    return node
+
+
+def append_flags(fname, node, label, compact_size=2**20):
+    """
+    Add or update flags in a node of a BottleFlags file by appending them to the
+    file's journal. The cost of appending depends only on the number of flags
+    given, and concurrent writers do not overwrite each other's flags. Flags are
+    matched to existing flags on cast_id and bottle_num, with the latest winning.
+
+    Parameters
+    ----------
+    fname : str or Path-like
+        Name of the BottleFlags file.
+    node : DataFrame, BottleFlags or dict of lists
+        Flag data with at least the keys "cast_id" and "bottle_num".
+    label : str
+        Name of the node to update. Created if it does not exist.
+    compact_size : int, optional
+        Compact the journal into the file once it reaches this size in bytes.
+        Use None to never compact automatically.
+    """
+    df = pd.DataFrame(node)
+    df = df.astype(object).where(df.notna(), None)
+    lines = "".join(
+        json.dumps({"node": label, **entry}, default=lambda x: x.item()) + "\n"
+        for entry in df.to_dict(orient="records")
+    )
+
+    # the lock is only held for the append, and keeps the journal from being
+    # moved for compaction part way through
+    _, journal = _journal_files(fname)
+    with _lock_file(Path(str(journal) + ".lock")):
+        with open(journal, 'a') as f:
+            f.write(lines)
+            journal_size = f.tell()
+
+    if compact_size is not None and journal_size >= compact_size:
+        compact_flags(fname)
+
+
+def _load_compacted(fname):
+    """
+    Load a BottleFlags file with its journal merged in, holding the file's lock.
+    The journal is moved aside to be merged, and is returned so it can be removed
+    once the merged flags are saved with _save_compacted.
+    """
+    compacting, journal = _journal_files(fname)
+    # new flags are appended to a fresh journal while this one is merged;
+    # a journal left over from an interrupted compaction is merged first
+    if not compacting.exists():
+        with _lock_file(Path(str(journal) + ".lock")):
+            if journal.exists():
+                os.replace(journal, compacting)
+    entries = _read_journal_file(compacting)
+
     with open(fname, 'r') as f:
         buf = f.read()
-    if buf == '':
-        # File exists but is empty
-        flags = BottleFlags()
+    flags = BottleFlags() if buf == '' else BottleFlags.fromJSON(buf)
+    for label in dict.fromkeys(e["node"] for e in entries):
+        node = flags.get(label, BottleFlags())
+        flags[label] = BottleFlags(
+            _merge_flag_entries(node, [e for e in entries if e["node"] == label])
+        )
+    return flags, compacting
+
+
+def _save_compacted(fname, flags, compacting):
+    """Replace a BottleFlags file with merged flags and drop the merged journal."""
+    tmp = Path(str(fname) + ".tmp")
+    flags.save(tmp)
+    os.replace(tmp, fname)
+    if compacting.exists():
+        compacting.unlink()
+
+
+def compact_flags(fname):
+    """
+    Merge the journal of a BottleFlags file into the file. Only one process
+    compacts at a time; others return without compacting. A lock left behind by a
+    crashed process is removed once it is older than STALE_LOCK_AGE seconds.
+
+    Parameters
+    ----------
+    fname : str or Path-like
+        Name of the BottleFlags file.
+
+    Returns
+    -------
+    bool
+        True if the journal was compacted.
+    """
+    lock = Path(str(fname) + ".lock")
+    if not _try_lock(lock):
+        log.warning(
+            "%s is being compacted by PID %s; if that process is no longer "
+            "running, remove %s" % (fname, _lock_owner(lock), lock)
+        )
+        return False
+
+    try:
+        flags, compacting = _load_compacted(fname)
+        if compacting.exists():
+            _save_compacted(fname, flags, compacting)
+    finally:
+        lock.unlink()
+    return True
+
+
+# Curve fitting
+def weighted_least_squares(
+    model, coefs0, inputs, ref, jac=None, weights=None, bounds=(-np.inf, np.inf)
+):
+    """
+    Fit model coefficients by (weighted) nonlinear least squares.
+
+    Minimizes sum(weights * (ref - model(coefs, inputs))**2).
+
+    Parameters
+    ----------
+    model : callable
+        Model function, model(coefs, inputs) -> array
+    coefs0 : array-like
+        Initial coefficient guess. Values outside of bounds are clipped.
+    inputs : tuple of array-like
+        Model input variables
+    ref : array-like
+        Reference values to fit against
+    jac : callable, optional
+        Jacobian of the model, jac(coefs, inputs) -> array of shape
+        (len(ref), len(coefs)). Estimated by finite differences if not given.
+    weights : array-like, optional
+        Weight for each data point. Default weights all points equally.
+    bounds : tuple of array-like, optional
+        Lower and upper bounds of each coefficient
+
+    Returns
+    -------
+    coefs : ndarray
+        Fitted coefficients
+    """
+    inputs = tuple(np.asarray(x, dtype=float) for x in inputs)
+    ref = np.asarray(ref, dtype=float)
+    if weights is None:
+        sqrt_w = np.ones_like(ref)
     else:
-        flags = BottleFlags.fromJSON(buf)
-    if label in flags or create_new is True:
-        flags[label] = node
+        sqrt_w = np.sqrt(np.asarray(weights, dtype=float))
+    lower, upper = (np.broadcast_to(b, np.shape(coefs0)) for b in bounds)
+    coefs0 = np.clip(np.asarray(coefs0, dtype=float), lower, upper)
+
+    def residual(coefs):
+        return sqrt_w * (ref - model(coefs, inputs))
+
+    if jac is None:
+        residual_jac = "2-point"
     else:
-        raise NodeNotFoundError("The node '%s' was not found in %s" % (label, fname))
-    flags.save(fname)
+        def residual_jac(coefs):
+            return -sqrt_w[:, np.newaxis] * jac(coefs, inputs)
+
+    res = scipy.optimize.least_squares(
+        residual, coefs0, jac=residual_jac, bounds=(lower, upper), x_scale="jac"
+    )
+
+    return res.x
+
+
+def robust_fit(
+    model,
+    coefs0,
+    inputs,
+    ref,
+    jac=None,
+    weights=None,
+    bounds=(-np.inf, np.inf),
+    n_sigma=2.8,
+    max_iter=50,
+    keep=None,
+):
+    """
+    Iteratively fit a model, rejecting outliers after each pass.
+
+    After each fit, points with residuals more than n_sigma standard deviations
+    (of the residuals of the points fit) are excluded and the model is refit,
+    starting from the previous coefficients, until no more points are rejected.
+    Points with non-finite inputs or reference values are never fit.
+
+    Parameters
+    ----------
+    model : callable
+        Model function, model(coefs, inputs) -> array
+    coefs0 : array-like
+        Initial coefficient guess
+    inputs : tuple of array-like
+        Model input variables
+    ref : array-like
+        Reference values to fit against
+    jac : callable, optional
+        Jacobian of the model, jac(coefs, inputs) -> array
+    weights : array-like, optional
+        Weight for each data point
+    bounds : tuple of array-like, optional
+        Lower and upper bounds of each coefficient
+    n_sigma : float, optional
+        Rejection threshold, in standard deviations of the residuals
+    max_iter : int, optional
+        Maximum number of fit/reject passes
+    keep : array-like of bool, optional
+        Points to consider for fitting. Default considers all points.
+
+    Returns
+    -------
+    coefs : ndarray
+        Fitted coefficients
+    keep : ndarray of bool
+        Points used in the final fit
+    diagnostics : DataFrame
+        Number of points fit and rejected, rejection cutoff, RMS residual and
+        coefficients for each pass
+    """
+    inputs = tuple(np.asarray(x, dtype=float) for x in inputs)
+    ref = np.asarray(ref, dtype=float)
+    weights = np.ones_like(ref) if weights is None else np.asarray(weights, float)
+
+    finite = np.isfinite(ref) & np.isfinite(weights)
+    for x in inputs:
+        finite &= np.isfinite(x)
+    keep = finite if keep is None else finite & np.asarray(keep, dtype=bool)
+
+    coefs = np.asarray(coefs0, dtype=float)
+    history = []
+    for n_iter in range(max_iter):
+        if not keep.any():
+            break
+        coefs = weighted_least_squares(
+            model,
+            coefs,
+            tuple(x[keep] for x in inputs),
+            ref[keep],
+            jac=jac,
+            weights=weights[keep],
+            bounds=bounds,
+        )
+        resid = np.full(ref.shape, np.nan)
+        resid[finite] = ref[finite] - model(coefs, tuple(x[finite] for x in inputs))
+        cutoff = n_sigma * np.std(resid[keep])
+        rejected = keep & (np.abs(resid) > cutoff)
+        history.append(
+            {
+                "n_fit": keep.sum(),
+                "n_rejected": rejected.sum(),
+                "cutoff": cutoff,
+                "rms": np.sqrt(np.mean(resid[keep] ** 2)),
+                "coefs": coefs,
+            }
+        )
+        if not rejected.any():
+            break
+        keep = keep & ~rejected
+    else:
+        log.warning(f"Outlier rejection stopped after {max_iter} passes")
+
+    return coefs, keep, pd.DataFrame(history)
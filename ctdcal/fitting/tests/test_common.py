@@ -1,10 +1,13 @@
 import json
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pytest
 
 from ctdcal.fitting.common import BottleFlags, df_node_to_BottleFlags, get_node, save_node, NodeNotFoundError
+from ctdcal.fitting.common import FlagStore, append_flags, compact_flags
+from ctdcal.fitting.common import robust_fit, weighted_least_squares
 
 
 class TestBottleFlags:
@@ -105,3 +108,210 @@ class TestBottleFlagWrangling:
         with open(empty_fname, 'r') as f:
             flags = BottleFlags.fromJSON(f.read())
         assert 'spam' in flags
+
+
+class TestFlagStore:
+    @pytest.fixture
+    def sample_data(self, tmp_path):
+        fname = tmp_path / 'flags.json'
+        salt = {
+            'cast_id': ['00101', '00101', '00201'],
+            'bottle_num': [1, 5, 3],
+            'value': [3, 4, 3],
+            'notes': ['bubbles', None, 'Auto-flagged'],
+        }
+        with open(fname, 'w') as f:
+            json.dump({'salt': salt, 'oxygen': {k: v[:1] for k, v in salt.items()}}, f)
+        return fname
+
+    def test_import_export(self, sample_data, tmp_path):
+        with FlagStore(tmp_path / 'flags.db') as store:
+            store.import_json(sample_data)
+            assert store.nodes() == ['oxygen', 'salt']
+            fname = tmp_path / 'export.json'
+            store.export_json(fname)
+        with open(sample_data, 'r') as f, open(fname, 'r') as g:
+            assert json.load(f) == json.load(g)
+        assert get_node(fname, 'salt').notes[1] is None
+
+    def test_upsert(self, sample_data, tmp_path):
+        with FlagStore(tmp_path / 'flags.db') as store:
+            store.import_json(sample_data)
+            new = pd.DataFrame(
+                {'cast_id': ['00201', '00301'], 'bottle_num': [3, 2], 'value': [2, 3]}
+            )
+            store.upsert('salt', new)
+            salt = store.get_node('salt')
+            assert salt['cast_id'].tolist() == ['00101', '00101', '00201', '00301']
+            assert salt['value'].tolist() == [3, 4, 2, 3]
+            assert salt['notes'].isna().tolist() == [False, True, True, True]
+
+            # filter by cast
+            salt = store.get_node('salt', cast_id=['00101'])
+            assert salt['bottle_num'].tolist() == [1, 5]
+            assert store.get_node('salt', cast_id=['00501']).empty
+            with pytest.raises(NodeNotFoundError):
+                store.get_node('cheese')
+
+        # changes persist
+        with FlagStore(tmp_path / 'flags.db') as store:
+            assert len(store.get_node('salt')) == 4
+
+
+class TestFlagJournal:
+    @pytest.fixture
+    def sample_data(self, tmp_path):
+        fname = tmp_path / 'flags.json'
+        salt = {'cast_id': ['00101', '00201'], 'bottle_num': [1, 3], 'value': [3, 4]}
+        with open(fname, 'w') as f:
+            json.dump({'salt': salt}, f)
+        return fname
+
+    def test_append_flags(self, sample_data):
+        new = pd.DataFrame(
+            {'cast_id': ['00201', '00301'], 'bottle_num': [3, 2], 'value': [2, 3]}
+        )
+        append_flags(sample_data, new, 'salt')
+        append_flags(sample_data, new.iloc[:1], 'oxygen')
+        with open(sample_data, 'r') as f:
+            assert json.load(f)['salt']['value'] == [3, 4]  # file untouched
+
+        # pending flags are returned with the node
+        salt = get_node(sample_data, 'salt')
+        assert salt.cast_id == ['00101', '00201', '00301']
+        assert salt.value == [3, 2, 3]
+        assert get_node(sample_data, 'oxygen').value == [2]
+
+        # compacting gives the same flags
+        assert compact_flags(sample_data)
+        assert not Path(str(sample_data) + '.journal').exists()
+        with open(sample_data, 'r') as f:
+            flags = json.load(f)
+        assert flags['salt'] == salt
+        assert flags['oxygen']['value'] == [2]
+
+        # automatic compaction once the journal is large enough
+        append_flags(sample_data, new.iloc[1:].assign(value=4), 'salt', compact_size=1)
+        with open(sample_data, 'r') as f:
+            assert json.load(f)['salt']['value'] == [3, 2, 4]
+
+    def test_save_node_after_append(self, sample_data):
+        flags = {'cast_id': ['00101'], 'bottle_num': [1], 'value': [2]}
+        append_flags(sample_data, flags, 'salt')
+        append_flags(sample_data, {'cast_id': ['00101'], 'bottle_num': [1]}, 'oxygen')
+
+        # the saved node replaces older pending flags, other nodes are kept
+        salt = get_node(sample_data, 'salt')
+        salt.value = [4, 4]
+        save_node(sample_data, salt, 'salt')
+        assert not Path(str(sample_data) + '.journal').exists()
+        assert get_node(sample_data, 'salt').value == [4, 4]
+        assert get_node(sample_data, 'oxygen').cast_id == ['00101']
+        assert compact_flags(sample_data)
+        assert get_node(sample_data, 'salt').value == [4, 4]
+
+    def test_compact_lock(self, sample_data, caplog):
+        import logging
+        import os
+
+        append_flags(sample_data, {'cast_id': ['00301'], 'bottle_num': [1]}, 'salt')
+        lock = Path(str(sample_data) + '.lock')
+        lock.write_text('12345')
+
+        # another process is compacting
+        with caplog.at_level(logging.WARNING):
+            assert not compact_flags(sample_data)
+        assert 'PID 12345' in caplog.text and str(lock) in caplog.text
+        assert Path(str(sample_data) + '.journal').exists()
+
+        # stale locks are removed
+        os.utime(lock, (0, 0))
+        assert compact_flags(sample_data)
+        assert not lock.exists()
+        with open(sample_data, 'r') as f:
+            assert json.load(f)['salt']['cast_id'] == ['00101', '00201', '00301']
+
+    def test_stale_lock_race(self, tmp_path, monkeypatch):
+        import os
+
+        from ctdcal.fitting import common
+
+        lock = tmp_path / 'flags.json.lock'
+        lock.write_text('12345')
+        os.utime(lock, (0, 0))
+
+        # another waiter breaks the stale lock and takes it just before this one
+        rename = os.rename
+
+        def take_lock_first(src, dst):
+            os.remove(src)
+            Path(src).write_text('999')
+            rename(src, dst)
+
+        monkeypatch.setattr(common.os, 'rename', take_lock_first)
+        assert not common._try_lock(lock)
+        assert lock.read_text() == '999'
+        assert list(tmp_path.iterdir()) == [lock]
+
+    def test_concurrent_append(self, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+
+        fname = tmp_path / 'flags.json'
+        fname.touch()
+
+        def append(n):
+            flags = {'cast_id': ['00101'], 'bottle_num': [n], 'value': [3]}
+            append_flags(fname, flags, 'salt', compact_size=200)
+
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            list(ex.map(append, range(100)))
+        compact_flags(fname)
+        assert sorted(get_node(fname, 'salt').bottle_num) == list(range(100))
+
+
+def _line(coefs, inputs):
+    (x,) = inputs
+    return coefs[0] + coefs[1] * x
+
+
+def _line_jac(coefs, inputs):
+    (x,) = inputs
+    return np.column_stack((np.ones_like(x), x))
+
+
+class TestRobustFit:
+    @pytest.fixture
+    def line_data(self):
+        rng = np.random.default_rng(0)
+        x = np.linspace(0, 10, 100)
+        y = 1 + 2 * x + rng.normal(0, 0.1, x.size)
+        y[[10, 50, 90]] += [5, -8, 6]  # outliers
+        x[20] = np.nan  # missing input
+        return x, y
+
+    def test_weighted_least_squares(self, line_data):
+        x, y = line_data
+        good = np.isfinite(x)
+        coefs = weighted_least_squares(_line, [0, 0], (x[good],), y[good], jac=_line_jac)
+        np.testing.assert_allclose(coefs, np.polyfit(x[good], y[good], 1)[::-1])
+
+        # finite differences without a Jacobian, and bounds
+        coefs = weighted_least_squares(
+            _line, [0, 1], (x[good],), y[good], bounds=([-np.inf, 0], [0.5, np.inf])
+        )
+        assert coefs[0] == pytest.approx(0.5)
+
+    def test_robust_fit(self, line_data):
+        x, y = line_data
+        coefs, keep, diagnostics = robust_fit(_line, [0, 0], (x,), y, jac=_line_jac)
+        np.testing.assert_allclose(coefs, [1, 2], atol=0.05)
+        assert not keep[[10, 20, 50, 90]].any()
+        assert diagnostics["n_rejected"].iloc[-1] == 0
+        assert diagnostics["n_fit"].iloc[0] == 99
+        assert (np.diff(diagnostics["n_fit"]) <= 0).all()
+
+        # initial mask and max_iter guard
+        start = np.arange(x.size) < 50
+        _, keep, diagnostics = robust_fit(_line, coefs, (x,), y, keep=start, max_iter=1)
+        assert not keep[50:].any()
+        assert len(diagnostics) == 1
@@ -2,7 +2,10 @@
 A module for handling ODF input-output files related to CTDCAL.
 """
 
+import hashlib
+import json
 import logging
+import os
 from io import BufferedIOBase, BytesIO, StringIO
 from pathlib import Path
 from typing import Union
@@ -12,20 +15,166 @@ from zipimport import ZipImportError
 import pandas as pd
 import requests
 
+from ctdcal.common import parallel_map
+
 log = logging.getLogger(__name__)
 
 
-def load_cnv(cnv_file: Union[str, Path]) -> pd.DataFrame:
+class HTTPCache:
+    """
+    A local cache of files downloaded over HTTP (e.g., from cchdo.ucsd.edu).
+
+    Files are stored in cache_dir, keyed by URL, along with their ETag and
+    Last-Modified headers. Cached files are revalidated with a conditional
+    request, so unchanged files are not downloaded again. The least recently
+    used files are removed once the cache exceeds max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Directory to store cached files in. Created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of cached files. Default is 1 GB.
+    offline : bool, optional
+        If true, never make requests; only cached files can be loaded.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30, offline=False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf8")).hexdigest()
+        return self.cache_dir / key, self.cache_dir / f"{key}.json"
+
+    def get(self, url):
+        """
+        Return the contents of url, from the cache if it is still current.
+
+        Parameters
+        ----------
+        url : str
+            URL of the file
+
+        Returns
+        -------
+        bytes
+        """
+        body, meta = self._paths(url)
+        cached = body.exists() and meta.exists()
+        if self.offline:
+            if not cached:
+                raise FileNotFoundError(f"{url} is not cached, cannot load offline")
+            log.info(f"Loading {url} from cache (offline)")
+            return self._hit(body)
+
+        headers = {}
+        if cached:
+            info = json.loads(meta.read_text())
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+
+        try:
+            response = requests.get(url, headers=headers)
+        except requests.ConnectionError:
+            if not cached:
+                raise
+            log.warning(f"Could not connect to revalidate {url}, using cached copy")
+            return self._hit(body)
+
+        if response.status_code == 304 and cached:
+            log.info(f"Loading {url} from cache (not modified)")
+            return self._hit(body)
+        response.raise_for_status()
+
+        # write the file before its metadata, so a partial entry is never used
+        content = response.content
+        info = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        self._write(body, content)
+        self._write(meta, json.dumps(info).encode("utf8"))
+        self._evict()
+        return content
+
+    def _write(self, path, data):
+        """Write a cache file atomically."""
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _hit(self, body):
+        """Read a cached file, marking it as recently used."""
+        os.utime(body)
+        return body.read_bytes()
+
+    def _evict(self):
+        """Remove least recently used files until the cache fits in max_bytes."""
+        bodies = [
+            f for f in self.cache_dir.iterdir() if f.suffix == "" and f.is_file()
+        ]
+        stats = {f: f.stat() for f in bodies}
+        total = sum(st.st_size for st in stats.values())
+        for f in sorted(bodies, key=lambda f: stats[f].st_mtime_ns):
+            if total <= self.max_bytes:
+                break
+            total -= stats[f].st_size
+            f.with_suffix(".json").unlink(missing_ok=True)
+            f.unlink(missing_ok=True)
+            log.debug(f"Removed {f.name} from HTTP cache")
+
+
+def _get_url(url, cache=None):
+    """Return the contents of url, through cache if one is given."""
+    if cache is not None:
+        return cache.get(url)
+    return requests.get(url).content
+
+
+def load_cnv(cnv_file: Union[str, Path], usecols=None, dtype=None) -> pd.DataFrame:
     """
     Load Sea-Bird converted (.cnv) cast file into DataFrame
+
+    The file is read once; the header is parsed up to the "*END*" line and the
+    data block is parsed in bulk by the pandas C parser.
+
+    Parameters
+    ----------
+    cnv_file : str or Path
+        Name of file to be loaded
+    usecols : list of str, optional
+        Names of columns to load. Default loads all columns.
+    dtype : type or dict, optional
+        Data type of all columns, or of each named column. Default infers the
+        type of each column.
+
+    Returns
+    -------
+    df : DataFrame
+        Loaded cast data
     """
-    with open(cnv_file) as f:
-        file = f.readlines()
+    with open(cnv_file, "rb") as f:
+        raw = f.read()
+
+    # find last row before data begins
+    if raw.startswith(b"*END*"):
+        end = 0
+    else:
+        end = raw.find(b"\n*END*") + 1
+        if end == 0:
+            raise ValueError(f"No *END* line found in {cnv_file}")
+    data_start = raw.find(b"\n", end) + 1 or len(raw)
 
     # parse column names
     info = dict()
     cols = []
-    for idx, line in enumerate(file):
+    for line in raw[:end].decode(errors="replace").splitlines():
         # get variable info
         if line.strip("# \n").startswith(("nquan", "nvalues", "units", "bad_flag")):
             k, v = line.strip("# \n").split("=")
@@ -36,29 +185,57 @@ def load_cnv(cnv_file: Union[str, Path]) -> pd.DataFrame:
             # expected format is:   # name 0 = col_name: long_description
             cols.append(line.split(":")[0].split("=")[-1].strip())
 
-        # last row before data begins
-        elif line.startswith("*END*"):
-            data_index = idx + 1
-            break
-
-        # anything else is a comment line
-        else:
-            continue  # pragma: no cover
-
     # read data
     return pd.read_csv(
-        cnv_file,
-        skiprows=range(0, data_index),
-        # delim_whitespace=True,
-        sep=r'\s+',
+        BytesIO(raw[data_start:]),
+        sep=r"\s+",
+        header=None,
         names=cols,
-        engine="python",
-        skipinitialspace=True,
+        usecols=usecols,
+        dtype=dtype,
         na_values=info["bad_flag"],
     )
 
 
-def load_exchange_btl(btl_file: Union[str, Path]) -> pd.DataFrame:
+def _parse_exchange_btl(text: str) -> pd.DataFrame:
+    """
+    Parse a WHP-exchange bottle file. The units row and END_DATA footer are
+    stripped before parsing so that the pandas C parser can type each column
+    directly. Units are kept in the DataFrame attrs["units"].
+    """
+    file = text.splitlines(keepends=True)
+
+    # find index of units row
+    for idx, line in enumerate(file):
+        # skip comment lines (which may reference EXPOCODE and break membership test)
+        if line.strip().startswith("#"):
+            continue
+
+        # find index of units row
+        if "EXPOCODE" in line:
+            columns = idx
+            units = idx + 1  # units row immediately follows column names
+            break
+
+    # data ends at END_DATA, or the last line if there isn't one
+    end = next(
+        (i for i in range(units + 1, len(file)) if file[i].startswith("END_DATA")),
+        len(file) - 1,
+    )
+
+    df = pd.read_csv(
+        StringIO("".join([file[columns]] + file[units + 1 : end])),
+        comment="#",
+        skipinitialspace=True,
+        float_precision="round_trip",
+    )
+    df.attrs["units"] = dict(
+        zip(df.columns, [u.strip() for u in file[units].strip("\r\n").split(",")])
+    )
+    return df
+
+
+def load_exchange_btl(btl_file: Union[str, Path], cache=None) -> pd.DataFrame:
     """
     Load WHP-exchange bottle file (_hy1.csv) into DataFrame. File can be on local
     file system or downloaded from an appropriate cchdo.ucsd.edu link
@@ -70,41 +247,71 @@ def load_exchange_btl(btl_file: Union[str, Path]) -> pd.DataFrame:
     ----------
     btl_file : str or Path
         Name or URL of file to be loaded
+    cache : HTTPCache, optional
+        Cache to load URLs through. Default downloads the file on every call.
 
     Returns
     -------
     df : DataFrame
-        Loaded bottle file
+        Loaded bottle file, with the units of each column in df.attrs["units"]
     """
     # read from url
     if isinstance(btl_file, (str, Path)) and str(btl_file).startswith("http"):
         log.info(f"Loading bottle file {Path(btl_file).name} from http link")
-        file = requests.get(btl_file).text.splitlines(keepends=True)
+        if cache is not None:
+            text = cache.get(str(btl_file)).decode("utf8")
+        else:
+            text = requests.get(btl_file).text
 
     # read from file
     elif isinstance(btl_file, (str, Path)):
         log.info(f"Loading bottle file {Path(btl_file).name} from local file")
         with open(btl_file) as f:
-            file = f.readlines()
+            text = f.read()
 
-    # find index of units row
+    return _parse_exchange_btl(text)
+
+
+def _parse_exchange_ctd(data: bytes):
+    """
+    Parse the header and data of a single WHP-exchange CTD file. The END_DATA
+    footer is stripped before parsing so that the pandas C parser can be used.
+    """
+    file = data.decode("utf8").splitlines(keepends=True)
+
+    # process metadata
     for idx, line in enumerate(file):
-        # skip comment lines (which may reference EXPOCODE and break membership test)
+        # skip comment lines (which may reference CTDPRS and break membership test)
         if line.strip().startswith("#"):
             continue
 
+        # find header info
+        if line.startswith("NUMBER_HEADERS"):
+            header_ind = idx
+
         # find index of units row
-        if "EXPOCODE" in line:
+        if "CTDPRS" in line:
+            columns = idx
             units = idx + 1  # units row immediately follows column names
             break
 
-    return pd.read_csv(
-        StringIO("".join(file)),
-        skiprows=[0, units],
-        skipfooter=1,
-        engine="python",
+    # break down header rows
+    header = {}
+    for line in file[header_ind:columns]:
+        k, v = line.strip("\n").split("=")
+        header[k.strip()] = v.strip()
+
+    # data ends at END_DATA, or the last line if there isn't one
+    end = next(
+        (i for i in range(units + 1, len(file)) if file[i].startswith("END_DATA")),
+        len(file) - 1,
+    )
+
+    return header, pd.read_csv(
+        StringIO("".join([file[columns]] + file[units + 1 : end])),
         comment="#",
         skipinitialspace=True,
+        float_precision="round_trip",
     )
 
 
@@ -112,6 +319,7 @@ def load_exchange_ctd(
     ctd_file: Union[str, Path, BufferedIOBase],
     n_files=None,
     recursed=False,
+    cache=None,
 ) -> pd.DataFrame:
     """
     Load WHP-exchange CTD file(s) (_ct1.csv) into DataFrame. File(s) can be on local
@@ -128,6 +336,9 @@ def load_exchange_ctd(
     n_files : int, optional
         Number of files to load from .zip archive
 
+    cache : HTTPCache, optional
+        Cache to load URLs through. Default downloads the file on every call.
+
     Returns
     -------
     header : dict or list of dict
@@ -138,7 +349,7 @@ def load_exchange_ctd(
     # read from url (.zip)
     if isinstance(ctd_file, (str, Path)) and str(ctd_file).startswith("http"):
         log.info(f"Loading CTD file {Path(ctd_file).name} from http link")
-        data_raw = BytesIO(requests.get(ctd_file).content)
+        data_raw = BytesIO(_get_url(str(ctd_file), cache))
 
     # read from file
     elif isinstance(ctd_file, (str, Path)):
@@ -159,47 +370,124 @@ def load_exchange_ctd(
             raise ZipImportError("Recursive .zip files encountered... exiting")
 
         data_raw.seek(0)  # is_zipfile moves cursor to EOF, reset to start
-        zip_contents = []
         with ZipFile(data_raw) as zf:
-            for zipinfo in zf.infolist():
-                zip_contents.append(BytesIO(zf.read(zipinfo)))
+            # members are only read as they are loaded
+            return zip(
+                *[
+                    load_exchange_ctd(BytesIO(zf.read(zipinfo)), recursed=True)
+                    for zipinfo in zf.infolist()[:n_files]
+                ]
+            )
 
-        # list comprehension is same as using functools.partial, just different syntax
-        return zip(
-            *[load_exchange_ctd(zc, recursed=True) for zc in zip_contents[:n_files]]
-        )
+    return _parse_exchange_ctd(data_raw.getvalue())
 
-    else:
-        data_raw.seek(0)  # is_zipfile moves cursor to EOF, reset to start
-        file = data_raw.read().decode("utf8").splitlines(keepends=True)
 
-    # process metadata
-    for idx, line in enumerate(file):
-        # skip comment lines (which may reference CTDPRS and break membership test)
-        if line.strip().startswith("#"):
-            continue
+def _exchange_ctd_members(ctd_file, n_files=None, cache=None):
+    """
+    Yield the raw contents of each CTD file in ctd_file (a single file or .zip),
+    reading .zip members one at a time.
+    """
+    # read from url (.zip)
+    if isinstance(ctd_file, (str, Path)) and str(ctd_file).startswith("http"):
+        log.info(f"Loading CTD file {Path(ctd_file).name} from http link")
+        f = BytesIO(_get_url(str(ctd_file), cache))
 
-        # find header info
-        if line.startswith("NUMBER_HEADERS"):
-            header_ind = idx
+    # read from file, without loading all of a .zip into memory
+    elif isinstance(ctd_file, (str, Path)):
+        log.info(f"Loading CTD file {Path(ctd_file).name} from local file")
+        f = open(ctd_file, "rb")
 
-        # find index of units row
-        if "CTDPRS" in line:
-            columns = idx
-            units = idx + 1  # units row immediately follows column names
-            break
+    # read from open file
+    elif isinstance(ctd_file, BufferedIOBase):
+        log.info("Loading open file object")
+        f = BytesIO(ctd_file.read())
 
-    # break down header rows
-    header = {}
-    for line in file[header_ind:columns]:
-        k, v = line.strip("\n").split("=")
-        header[k.strip()] = v.strip()
+    with f:
+        if not is_zipfile(f):
+            f.seek(0)  # is_zipfile moves cursor to EOF, reset to start
+            yield f.read()
+            return
 
-    return header, pd.read_csv(
-        StringIO("".join(file)),
-        skiprows=list(range(0, columns)) + [units],  # skip up to column names (+ units)
-        skipfooter=1,
-        engine="python",
-        comment="#",
-        skipinitialspace=True,
-    )
+        log.info("Loading CTD files from .zip")
+        f.seek(0)
+        with ZipFile(f) as zf:
+            for zipinfo in zf.infolist()[:n_files]:
+                data = zf.read(zipinfo)
+                if is_zipfile(BytesIO(data)):
+                    raise ZipImportError("Recursive .zip files encountered... exiting")
+                yield data
+
+
+def iter_exchange_ctd(
+    ctd_file: Union[str, Path, BufferedIOBase], n_files=None, cache=None
+):
+    """
+    Load WHP-exchange CTD file(s) (_ct1.csv) one at a time. Unlike
+    load_exchange_ctd, only one file from a .zip archive is held in memory at a
+    time.
+
+    Parameters
+    ----------
+    ctd_file : str, Path or open binary file
+        Name or URL of file to be loaded
+    n_files : int, optional
+        Number of files to load from .zip archive
+    cache : HTTPCache, optional
+        Cache to load URLs through. Default downloads the file on every call.
+
+    Yields
+    ------
+    header : dict
+        File metadata from header (e.g., EXPOCODE, STNNBR, CASTNO)
+    df : DataFrame
+        Loaded CTD file
+    """
+    for data in _exchange_ctd_members(ctd_file, n_files, cache):
+        yield _parse_exchange_ctd(data)
+
+
+def load_exchange_ctd_cruise(
+    ctd_file: Union[str, Path, BufferedIOBase],
+    n_files=None,
+    max_workers=1,
+    cast_col="SSSCC",
+    cache=None,
+):
+    """
+    Load WHP-exchange CTD file(s) (_ct1.csv) into a single DataFrame, with a
+    column identifying the cast of each row.
+
+    Parameters
+    ----------
+    ctd_file : str, Path or open binary file
+        Name or URL of file (usually a .zip archive) to be loaded
+    n_files : int, optional
+        Number of files to load from .zip archive
+    max_workers : int, optional
+        Number of files to parse at once. The default (1) streams files from the
+        archive one at a time; otherwise all files are read before parsing.
+    cast_col : str, optional
+        Name of the cast column, made from the STNNBR and CASTNO headers as SSSCC
+    cache : HTTPCache, optional
+        Cache to load URLs through. Default downloads the file on every call.
+
+    Returns
+    -------
+    headers : DataFrame
+        File metadata from each header, one row per cast
+    df : DataFrame
+        Loaded CTD files
+    """
+    members = _exchange_ctd_members(ctd_file, n_files, cache)
+    if max_workers == 1:
+        casts = map(_parse_exchange_ctd, members)
+    else:
+        casts = parallel_map(_parse_exchange_ctd, members, max_workers=max_workers)
+
+    headers, dfs = [], []
+    for header, df in casts:
+        ssscc = header["STNNBR"].zfill(3) + header["CASTNO"].zfill(2)
+        headers.append({cast_col: ssscc, **header})
+        dfs.append(df.assign(**{cast_col: ssscc}))
+
+    return pd.DataFrame(headers), pd.concat(dfs, ignore_index=True)
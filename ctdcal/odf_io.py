@@ -12,7 +12,7 @@ import numpy as np
 import pandas as pd
 
 from ctdcal import get_ctdcal_config
-from ctdcal.common import validate_file
+from ctdcal.common import parallel_map, validate_file
 from ctdcal.fitting.common import (
     NodeNotFoundError,
     df_node_to_BottleFlags,
@@ -125,30 +125,48 @@ def _salt_loader(filename):
     return saltDF, refDF, questionable
 
 
-def remove_autosal_drift(saltDF, refDF):
-    """Calculate linear CR drift between reference values"""
+def _autosal_drift_rate(saltDF, refDF):
+    """
+    Calculate the linear CR drift rate (per second) between reference values.
+
+    Returns None if the start/end reference readings could not be found.
+    """
     if refDF.shape != (2, 2):
         ssscc = f"{saltDF['STNNBR'].unique()[0]:03d}{saltDF['CASTNO'].unique()[0]:02d}"
         log.warning(
             f"Failed to find start/end reference readings for {ssscc}, check salt file"
         )
-    else:
-        # find rate of drift
-        diff = refDF.diff(axis="index").dropna()
-
-        if any(abs(diff["CRavg"] > 0.0001)):
-            #   Warn analyst that the standard drifted by a lot (precise to within 5 decimal places)
-            log.warning(f"Salt run at station {saltDF['STNNBR'].iloc[0]} had a CR drift in excess of 0.0001.")
-        if any(diff["IndexTime"] > 43200):
-            #   Warn analyst that over 12 hours passed between standardizations
-            log.warning(f"Salt run at station {saltDF['STNNBR'].iloc[0]} had >12 hours between standardizations.")
-        if any(saltDF["IndexTime"].diff().sum() > (diff["IndexTime"])):
-            #   Warn analyst that standardization and sample timestamps may not be aligned
-            #   Standards should always bookend the samples
-            log.warning(f"Salt run at station {saltDF['STNNBR'].iloc[0]} has misaligned standards and samples.")
-
-        time_coef = (diff["CRavg"] / diff["IndexTime"]).iloc[0]
+        return None
+
+    # find rate of drift
+    diff = refDF.diff(axis="index").dropna()
 
+    station = saltDF["STNNBR"].iloc[0]
+    if any(abs(diff["CRavg"] > 0.0001)):
+        #   Warn analyst that the standard drifted by a lot (precise to within 5
+        #   decimal places)
+        log.warning(
+            f"Salt run at station {station} had a CR drift in excess of 0.0001."
+        )
+    if any(diff["IndexTime"] > 43200):
+        #   Warn analyst that over 12 hours passed between standardizations
+        log.warning(
+            f"Salt run at station {station} had >12 hours between standardizations."
+        )
+    if any(saltDF["IndexTime"].diff().sum() > (diff["IndexTime"])):
+        #   Warn analyst that standardization and sample timestamps may not be aligned
+        #   Standards should always bookend the samples
+        log.warning(
+            f"Salt run at station {station} has misaligned standards and samples."
+        )
+
+    return (diff["CRavg"] / diff["IndexTime"]).iloc[0]
+
+
+def remove_autosal_drift(saltDF, refDF):
+    """Calculate linear CR drift between reference values"""
+    time_coef = _autosal_drift_rate(saltDF, refDF)
+    if time_coef is not None:
         # apply offset as a linear function of time
         saltDF = saltDF.copy(deep=True)  # avoid modifying input dataframe
         saltDF["CRavg"] += saltDF["IndexTime"] * time_coef
@@ -157,35 +175,76 @@ def remove_autosal_drift(saltDF, refDF):
     return saltDF.drop(labels="IndexTime", axis="columns")
 
 
+def _write_salt_csv(stn_cast_salts, outfile):
+    """Write one station/cast's salts, skipping existing files."""
+    if outfile.exists():
+        log.info(str(outfile) + " already exists...skipping")
+        return
+    stn_cast_salts = stn_cast_salts.dropna(axis=1, how="all")  # drop empty columns
+    stn_cast_salts.to_csv(outfile, index=False)
+
+
 def _salt_exporter(
-    saltDF, outdir=cfg.dirs["salt"], stn_col="STNNBR", cast_col="CASTNO"
+    saltDF,
+    outdir=cfg.dirs["salt"],
+    stn_col="STNNBR",
+    cast_col="CASTNO",
+    max_workers=None,
 ):
     """
     Export salt DataFrame to .csv file. Extra logic is included in the event that
     multiple stations and/or casts are included in a single raw salt file.
     """
-    stations = saltDF[stn_col].unique()
-    if len(stations) > 1:
-        log.info("Multiple stations found in salt source file. Writing out .CSVs seperately.")
-
-    for station in stations:
-        stn_salts = saltDF[saltDF[stn_col] == station]
-        casts = stn_salts[cast_col].unique()
-        for cast in casts:
-            stn_cast_salts = stn_salts[stn_salts[cast_col] == cast].copy()
-            stn_cast_salts.dropna(axis=1, how="all", inplace=True)  # drop empty columns
-            outfile = Path(outdir) / f"{station:03.0f}{cast:02.0f}_salts.csv"  # SSSCC_*
-            if outfile.exists():
-                log.info(str(outfile) + " already exists...skipping")
-                continue
-            stn_cast_salts.to_csv(outfile, index=False)
-
-
-def process_salts(ssscc_list, user_cfg=None, salt_dir=cfg.dirs["salt"]):
+    _check_multiple_stations(saltDF, stn_col)
+    _write_salt_casts(saltDF, outdir, stn_col, cast_col, max_workers)
+
+
+def _check_multiple_stations(saltDF, stn_col="STNNBR"):
+    """Note when a single raw salt file holds samples from more than one station."""
+    if saltDF[stn_col].nunique() > 1:
+        log.info(
+            "Multiple stations found in salt source file. "
+            "Writing out .CSVs seperately."
+        )
+
+
+def _write_salt_casts(saltDF, outdir, stn_col, cast_col, max_workers=None):
+    """Write each station/cast in saltDF to its own .csv file concurrently."""
+    casts = list(saltDF.groupby([stn_col, cast_col], sort=False))
+    parallel_map(
+        _write_salt_csv,
+        [stn_cast_salts for _, stn_cast_salts in casts],
+        [
+            Path(outdir) / f"{station:03.0f}{cast:02.0f}_salts.csv"  # SSSCC_*
+            for (station, cast), _ in casts
+        ],
+        max_workers=max_workers,
+    )
+
+
+def _load_salt_file(ssscc, salt_dir):
+    """Load one raw salt file, returning None if it is missing or already exported."""
+    if (Path(salt_dir) / f"{ssscc}_salts.csv").exists():
+        log.info(f"{ssscc}_salts.csv already exists in {salt_dir}... skipping")
+        return None
+    try:
+        return _salt_loader(Path(salt_dir) / ssscc)
+    except FileNotFoundError:
+        log.warning(f"Salt file for cast {ssscc} does not exist... skipping")
+        return None
+
+
+def process_salts(
+    ssscc_list, user_cfg=None, salt_dir=cfg.dirs["salt"], max_workers=None
+):
     """
     Master salt processing function. Load in salt files for given station/cast list,
     calculate salinity, and export to .csv files.
 
+    Salt files are read and .csv files written concurrently. Autosal drift and
+    salinity are calculated for all casts at once, and questionable samples are
+    saved to the flag file in a single update.
+
     Parameters
     ----------
     ssscc_list : list of str
@@ -194,48 +253,68 @@ def process_salts(ssscc_list, user_cfg=None, salt_dir=cfg.dirs["salt"]):
         Dictionary of user configuration parameters
     salt_dir : str, optional
         Path to folder containing raw salt files (defaults to data/salt/)
+    max_workers : int, optional
+        Maximum number of files to read or write at once. Use 1 to process files
+        sequentially.
 
     """
-    flags_df = None
-    for ssscc in ssscc_list:
-        if (Path(salt_dir) / f"{ssscc}_salts.csv").exists():
-            log.info(f"{ssscc}_salts.csv already exists in {salt_dir}... skipping")
-            continue
-        else:
-            try:
-                saltDF, refDF, questionable = _salt_loader(Path(salt_dir) / ssscc)
-            except FileNotFoundError:
-                log.warning(f"Salt file for cast {ssscc} does not exist... skipping")
-                continue
-            saltDF = remove_autosal_drift(saltDF, refDF)
-            saltDF["SALNTY"] = gsw.SP_salinometer(
-                (saltDF["CRavg"] / 2.0), saltDF["BathTEMP"]
-            )  # .round(4)
-            _salt_exporter(saltDF, salt_dir)
-
-            # compile flags
-            if questionable is not None:
-                if flags_df is None:
-                    flags_df = questionable
-                else:
-                    flags_df = pd.concat([flags_df, questionable], ignore_index=True)
-
-
+    loaded = parallel_map(
+        _load_salt_file,
+        ssscc_list,
+        [salt_dir] * len(ssscc_list),
+        max_workers=max_workers,
+    )
+    loaded = [salts for salts in loaded if salts is not None]
+    if not loaded:
+        return
+
+    # remove drift from each run, then calculate salinity for every cast at once
+    saltDFs, drift = [], []
+    claimed = set()
+    for saltDF, refDF, _ in loaded:
+        _check_multiple_stations(saltDF)
+        time_coef = _autosal_drift_rate(saltDF, refDF)
+        # a station/cast found in more than one file is taken from the first
+        ssscc = list(zip(saltDF["STNNBR"], saltDF["CASTNO"]))
+        keep = np.array([cast not in claimed for cast in ssscc], dtype=bool)
+        claimed.update(ssscc)
+        saltDFs.append(saltDF[keep])
+        drift.append(np.full(keep.sum(), np.nan if time_coef is None else time_coef))
+    saltDF = pd.concat(saltDFs, ignore_index=True)
+    drift = np.concatenate(drift)
+    has_drift = ~np.isnan(drift)
+    saltDF["CRavg"] = np.where(
+        has_drift,
+        (saltDF["CRavg"] + saltDF["IndexTime"] * np.nan_to_num(drift)).round(5),
+        saltDF["CRavg"],
+    )  # match initial precision
+    saltDF = saltDF.drop(labels="IndexTime", axis="columns")
+    saltDF["SALNTY"] = gsw.SP_salinometer(
+        (saltDF["CRavg"] / 2.0), saltDF["BathTEMP"]
+    )  # .round(4)
+    _write_salt_casts(saltDF, salt_dir, "STNNBR", "CASTNO", max_workers)
+
+    # compile flags
+    questionable = [q for _, _, q in loaded if q is not None]
+    if not questionable:
+        return
+    flags_df = pd.concat(questionable, ignore_index=True)
 
     # save flags
-    if flags_df is not None:
-        if user_cfg is not None:
-            flag_path = Path(user_cfg.datadir, 'flag', user_cfg.bottleflags_man)
-        else:   #   No user_cfg, use get_ctdcal_config TODO: Remember to remove all the old cfg calls
-            flag_path = Path(cfg.dirs('flags'), "bottleflags_man.csv")
-        flag_file = validate_file(flag_path, create=True)
-        try:
-            salt = pd.DataFrame.from_dict(get_node(flag_file, 'salt'))
-        except NodeNotFoundError:
-            salt = None
-        flags_df = pd.concat([flags_df, salt], ignore_index=True)
-        new_flags = df_node_to_BottleFlags(flags_df)
-        save_node(flag_file, new_flags, 'salt', create_new=True)
+    if user_cfg is not None:
+        flag_path = Path(user_cfg.datadir, 'flag', user_cfg.bottleflags_man)
+    else:
+        #   No user_cfg, use get_ctdcal_config
+        #   TODO: Remember to remove all the old cfg calls
+        flag_path = Path(cfg.dirs["flags"], "bottleflags_man.csv")
+    flag_file = validate_file(flag_path, create=True)
+    try:
+        salt = pd.DataFrame.from_dict(get_node(flag_file, 'salt'))
+    except NodeNotFoundError:
+        salt = None
+    flags_df = pd.concat([flags_df, salt], ignore_index=True)
+    new_flags = df_node_to_BottleFlags(flags_df)
+    save_node(flag_file, new_flags, 'salt', create_new=True)
 
 
 def print_progress_bar(
@@ -4,21 +4,27 @@ Module for processing oxygen from CTD and bottle samples.
 
 import csv
 import logging
-import xml.etree.cElementTree as ET
 from collections import OrderedDict
+from itertools import repeat
 from pathlib import Path
 
 import gsw
 import numpy as np
 import pandas as pd
-import scipy
 
-from ctdcal.fitting.common import NodeNotFoundError, get_node
+from ctdcal.fitting.common import (
+    NodeNotFoundError,
+    get_node,
+    robust_fit,
+    weighted_least_squares,
+)
 
 from . import ctd_plots as ctd_plots
 from . import flagging as flagging
 from . import get_ctdcal_config
 from . import process_ctd as process_ctd
+from . import sbe_reader as sbe_rd
+from .common import parallel_map
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -412,26 +418,32 @@ def calculate_dV_dt(oxy_volts, time, nan_replace=True):
 
 def _get_sbe_coef(idx=0):
     """
-    Get SBE oxygen coefficients from raw .xmlcon files.
+    Get SBE oxygen coefficients for a station's .XMLCON file.
     Defaults to using first station in ssscc.csv file.
 
+    Coefficients are read from the registry saved alongside the converted data
+    (see sbe_reader.read_sensor_coefs), so the raw .XMLCON is only parsed once.
+
     Returns the following tuple of coefficients: Soc, offset, Tau20, Tcor, E
     """
     station = process_ctd.get_ssscc_list()[idx]
-    xmlfile = cfg.dirs["raw"] + station + ".XMLCON"
+    sensors = sbe_rd.read_sensor_coefs(
+        cfg.dirs["raw"] + station + ".XMLCON",
+        cache_file=cfg.dirs["converted"] + station + "_coefs.json",
+    )
+    oxy_sensor = next(s for s in sensors if s["type"] == "OxygenSensor")
+    eq0 = oxy_sensor["equations"]["0"]  # Owens-Millard
+    eq1 = oxy_sensor["equations"]["1"]  # SBE equation
 
-    tree = ET.parse(xmlfile)
-    root_eq0 = tree.find(".//CalibrationCoefficients[@equation='0']")  # Owens-Millard
-    root_eq1 = tree.find(".//CalibrationCoefficients[@equation='1']")  # SBE equation
+    # only Tcor needed from eq0
+    return eq1["Soc"], eq1["offset"], eq1["Tau20"], eq0["Tcor"], eq1["E"]
 
-    coefs = {c.tag: float(c.text) for c in root_eq1}
-    coefs["Tcor"] = float(root_eq0.find("Tcor").text)  # only coef needed from eq0
-    keep_keys = ["Soc", "offset", "Tau20", "Tcor", "E"]
 
-    return tuple(coefs[key] for key in keep_keys)
+# default pressure bin edges [dbar] and weight within each bin
+WEIGHT_BINS = ([100, 300, 500, 1200, 2000], [20, 25, 50, 100, 200, 500])
 
 
-def calculate_weights(pressure):
+def calculate_weights(pressure, weight_bins=None):
     """
     Calculate weights (as a function of pressure) for weighted least squares fitting.
     Deep measurements are weighted higher than shallow.
@@ -440,35 +452,24 @@ def calculate_weights(pressure):
     ----------
     presssure : array-like
         Pressure values of oxygen measurements [dbar]
+    weight_bins : tuple of list, optional
+        Pressure bin edges [dbar] and the weight for each bin (one more than the
+        number of edges). Pressures equal to an edge fall in the shallower bin.
+        Defaults to WEIGHT_BINS.
 
     Returns
     -------
     weights : array-like
         Weight factor for each pressure value
     """
-    epsilon = 1e-5  # small offset to avoid interpolation issues
-
-    # define piecewise weight function dependent on pressure
-    p_bins = [
-        0,
-        100,
-        100 + epsilon,
-        300,
-        300 + epsilon,
-        500,
-        500 + epsilon,
-        1200,
-        1200 + epsilon,
-        2000,
-        2000 + epsilon,
-        7000,
-    ]
-    w_bins = [20, 20, 25, 25, 50, 50, 100, 100, 200, 200, 500, 500]
-    wgt = scipy.interpolate.interp1d(p_bins, w_bins)
+    p_edges, w_bins = WEIGHT_BINS if weight_bins is None else weight_bins
+    if len(w_bins) != len(p_edges) + 1:
+        raise ValueError("weight_bins must have one more weight than bin edges")
 
-    weights = wgt(pressure)  # get weights from piecewise function
+    pressure = np.asarray(pressure, dtype=float)
+    weights = np.asarray(w_bins, dtype=float)[np.searchsorted(p_edges, pressure)]
 
-    return weights
+    return np.where(np.isnan(pressure), np.nan, weights)
 
 
 """code_pruning: should this be here or in equations_sbe? somewhere else?"""
@@ -500,6 +501,78 @@ def _PMEL_oxy_eq(coefs, inputs, cc=[1.92634e-4, -4.64803e-2]):
     return o2
 
 
+def _PMEL_oxy_jac(coefs, inputs, cc=[1.92634e-4, -4.64803e-2]):
+    """
+    Jacobian of the PMEL SBE 43 oxygen equation with respect to its coefficients.
+
+    Parameters
+    ----------
+    coefs : array-like
+        Soc, Voffset, Tau20, Tcorr, E (see _PMEL_oxy_eq)
+    inputs : tuple of array-like
+        Oxygen volts, pressure, temperature, dV/dt, oxygen solubility
+
+    Returns
+    -------
+    jac : ndarray
+        Partial derivatives of oxygen for each data point (rows) and
+        coefficient (columns)
+    """
+    Soc, Voff, Tau20, Tcorr, E = coefs
+    oxyvolts, pressure, temp, dvdt, os = (np.asarray(x, dtype=float) for x in inputs)
+    tau = np.exp(cc[0] * pressure + cc[1] * (temp - 20)) * dvdt
+    scale = os * np.exp(Tcorr * temp) * np.exp((E * pressure) / (temp + 273.15))
+    o2 = Soc * (oxyvolts + Voff + Tau20 * tau) * scale
+
+    return np.column_stack(
+        (
+            (oxyvolts + Voff + Tau20 * tau) * scale,  # d/dSoc
+            Soc * scale,  # d/dVoffset
+            Soc * tau * scale,  # d/dTau20
+            o2 * temp,  # d/dTcorr
+            o2 * pressure / (temp + 273.15),  # d/dE
+        )
+    )
+
+
+_PMEL_oxy_bounds = ([-np.inf, -np.inf, 0, -np.inf, -np.inf], np.inf)  # Tau20 >= 0
+
+
+def _PMEL_oxy_fit(coefs0, weights, inputs, refoxy):
+    """
+    Weighted least squares fit of the PMEL SBE 43 oxygen equation.
+
+    Minimizes the same weighted sum of squares as PMEL_oxy_weighted_residual
+    (whose normalization does not depend on the coefficients) using the
+    analytic Jacobian. Tau20 is constrained to be non-negative.
+
+    Parameters
+    ----------
+    coefs0 : array-like
+        Initial coefficient guess
+    weights : array-like
+        Weight for each data point
+    inputs : tuple of array-like
+        Oxygen volts, pressure, temperature, dV/dt, oxygen solubility
+    refoxy : array-like
+        Reference (bottle) oxygen
+
+    Returns
+    -------
+    coefs : ndarray
+        Fitted coefficients
+    """
+    return weighted_least_squares(
+        _PMEL_oxy_eq,
+        coefs0,
+        inputs,
+        refoxy,
+        jac=_PMEL_oxy_jac,
+        weights=weights,
+        bounds=_PMEL_oxy_bounds,
+    )
+
+
 def PMEL_oxy_weighted_residual(coefs, weights, inputs, refoxy, L_norm=2):
     """
     Do a weighted oxygen residual fit using PMEL's SBE43 equation.
@@ -529,77 +602,86 @@ def match_sigmas(
     ctd_SA,
     ctd_oxyvolts,
     ctd_time,
+    sbe_coef0=None,
 ):
     """
     Density match time/btl oxy dataframes between up/downcasts.
-    """
-
-    # Construct Dataframe from bottle and ctd values for merging
-    btl_data = pd.DataFrame(
-        data={"CTDPRS": btl_prs, "REFOXY": btl_oxy, "CTDTMP": btl_tmp, "SA": btl_SA},
-        index=btl_idx,
-    )
-    time_data = pd.DataFrame(
-        data={
-            "CTDPRS": ctd_prs,
-            "OS": ctd_os,
-            "CTDTMP": ctd_tmp,
-            "SA": ctd_SA,
-            "CTDOXYVOLTS": ctd_oxyvolts,
-            "CTDTIME": ctd_time,
-        }
-    )
-    time_data["dv_dt"] = calculate_dV_dt(time_data["CTDOXYVOLTS"], time_data["CTDTIME"])
-
-    # Merge DF
-    merged_df = pd.DataFrame(
-        columns=["CTDPRS", "CTDOXYVOLTS", "CTDTMP", "dv_dt", "OS"], dtype=float
-    )
-    merged_df["REFOXY"] = btl_data["REFOXY"].copy()
 
-    # calculate sigma referenced to multiple depths
-    for idx, p_ref in enumerate([0, 1000, 2000, 3000, 4000, 5000, 6000]):
+    Each bottle is matched using potential density referenced to the nearest of
+    0, 1000, ..., 6000 dbar (bottles within 500 dbar of a reference pressure).
+    Continuous data are sorted by density once per reference pressure and all
+    variables are interpolated to the bottle densities together.
 
-        # pandas 1.2.1 ufunc issue workaround
-        btl_inputs = np.broadcast_arrays(
-            btl_data["SA"], btl_data["CTDTMP"], btl_data["CTDPRS"], p_ref
-        )
-        time_inputs = np.broadcast_arrays(
-            time_data["SA"], time_data["CTDTMP"], time_data["CTDPRS"], p_ref
-        )
+    sbe_coef0 is used to calculate CTDOXY for the matched data; if not given it is
+    read from the instrument configuration (see _get_sbe_coef).
+    """
+    p_refs = np.array([0, 1000, 2000, 3000, 4000, 5000, 6000])
+    cols = ["CTDPRS", "CTDOXYVOLTS", "CTDTMP", "dv_dt", "OS"]
 
-        btl_data[f"sigma{idx}"] = (
-            gsw.pot_rho_t_exact(*btl_inputs)
-            - 1000  # subtract 1000 to get potential density *anomaly*
-        ) + 1e-8 * np.random.standard_normal(btl_data["SA"].size)
-        time_data[f"sigma{idx}"] = (
-            gsw.pot_rho_t_exact(*time_inputs)
-            - 1000  # subtract 1000 to get potential density *anomaly*
-        ) + 1e-8 * np.random.standard_normal(time_data["SA"].size)
-        rows = (btl_data["CTDPRS"] > (p_ref - 500)) & (
-            btl_data["CTDPRS"] < (p_ref + 500)
+    btl_prs = np.asarray(btl_prs, dtype=float)
+    ctd_prs = np.asarray(ctd_prs, dtype=float)
+    ctd_vars = np.column_stack(
+        (
+            ctd_prs,
+            ctd_oxyvolts,
+            ctd_tmp,
+            calculate_dV_dt(
+                np.asarray(ctd_oxyvolts, dtype=float), np.asarray(ctd_time, dtype=float)
+            ),
+            ctd_os,
         )
+    ).astype(float)
 
-        time_sigma_sorted = time_data[f"sigma{idx}"].sort_values().to_numpy()
-        sigma_min = np.min(
-            [np.min(btl_data.loc[rows, f"sigma{idx}"]), np.min(time_sigma_sorted)]
-        )
-        sigma_max = np.max(
-            [np.max(btl_data.loc[rows, f"sigma{idx}"]), np.max(time_sigma_sorted)]
+    # find reference pressure (if any) for each bottle
+    in_window = (btl_prs[:, np.newaxis] > (p_refs - 500)) & (
+        btl_prs[:, np.newaxis] < (p_refs + 500)
+    )
+    has_ref = in_window.any(axis=1)
+    btl_ref = in_window.argmax(axis=1)
+    used_refs = np.unique(btl_ref[has_ref])
+
+    # sigma for bottles at their own reference, and for time data at each reference
+    # (jitter breaks ties so sorted sigma is strictly increasing)
+    btl_sigma = (
+        gsw.pot_rho_t_exact(btl_SA, btl_tmp, btl_prs, p_refs[btl_ref])
+        - 1000  # subtract 1000 to get potential density *anomaly*
+    ) + 1e-8 * np.random.standard_normal(btl_prs.size)
+    time_sigma = (
+        gsw.pot_rho_t_exact(
+            np.asarray(ctd_SA, dtype=float)[:, np.newaxis],
+            np.asarray(ctd_tmp, dtype=float)[:, np.newaxis],
+            ctd_prs[:, np.newaxis],
+            p_refs[used_refs],
         )
-        time_sigma_sorted = np.insert(time_sigma_sorted, 0, sigma_min - 1e-4)
-        time_sigma_sorted = np.append(time_sigma_sorted, sigma_max + 1e-4)
-        cols = ["CTDPRS", "CTDOXYVOLTS", "CTDTMP", "dv_dt", "OS"]
-        inds = np.concatenate(([0], np.arange(0, len(time_data)), [len(time_data) - 1]))
-        for col in cols:
-            merged_df.loc[rows, col] = np.interp(
-                btl_data.loc[rows, f"sigma{idx}"],
-                time_sigma_sorted,
-                time_data[col].iloc[inds],
-            )
+        - 1000
+    ) + 1e-8 * np.random.standard_normal((ctd_prs.size, used_refs.size))
+
+    matched = np.full((btl_prs.size, len(cols)), np.nan)
+    for time_col, ref in enumerate(used_refs):
+        rows = has_ref & (btl_ref == ref)
+        order = np.argsort(time_sigma[:, time_col])
+        sigma_sorted = time_sigma[order, time_col]
+        values_sorted = ctd_vars[order]
+
+        # pad ends so bottles outside the time data range take the end values
+        sigma_min = min(btl_sigma[rows].min(), sigma_sorted[0])
+        sigma_max = max(btl_sigma[rows].max(), sigma_sorted[-1])
+        xp = np.concatenate(([sigma_min - 1e-4], sigma_sorted, [sigma_max + 1e-4]))
+        fp = np.vstack((values_sorted[:1], values_sorted, values_sorted[-1:]))
+
+        # linear interpolation of all variables at once
+        x = btl_sigma[rows]
+        j = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, len(xp) - 2)
+        dx = xp[j + 1] - xp[j]
+        w = np.divide(x - xp[j], dx, out=np.zeros_like(x), where=dx > 0)
+        matched[rows] = fp[j] * (1 - w[:, np.newaxis]) + fp[j + 1] * w[:, np.newaxis]
+
+    merged_df = pd.DataFrame(matched, columns=cols, index=btl_idx)
+    merged_df["REFOXY"] = np.asarray(btl_oxy)
 
     # Apply coef and calculate CTDOXY
-    sbe_coef0 = _get_sbe_coef()  # initial coefficient guess
+    if sbe_coef0 is None:
+        sbe_coef0 = _get_sbe_coef()  # initial coefficient guess
     merged_df["CTDOXY"] = _PMEL_oxy_eq(
         sbe_coef0,
         (
@@ -614,9 +696,11 @@ def match_sigmas(
     return merged_df
 
 
-def sbe43_oxy_fit(merged_df, sbe_coef0=None, f_suffix=None):
+def sbe43_oxy_fit(merged_df, sbe_coef0=None, f_suffix=None, weight_bins=None):
     """
     Fit weighted oxygen data following match_sigmas with the option for initial coefficients.
+
+    weight_bins sets the pressure-dependent fit weights (see calculate_weights).
     """
 
     # Plot data to be fit together
@@ -630,67 +714,41 @@ def sbe43_oxy_fit(merged_df, sbe_coef0=None, f_suffix=None):
         xlim=(-10, 10),
     )
 
-    bad_df = pd.DataFrame()  # initialize DF for questionable values
-
     if sbe_coef0 is None:
         sbe_coef0 = _get_sbe_coef()  # load initial coefficient guess
 
-    # Curve fit (weighted)
-    weights = calculate_weights(merged_df["CTDPRS"])
+    # Curve fit (weighted), rejecting values beyond 2.8 sigma each pass
+    weights = calculate_weights(merged_df["CTDPRS"], weight_bins)
     fit_vars = ["CTDOXYVOLTS", "CTDPRS", "CTDTMP", "dv_dt", "OS"]
-    fit_data = tuple(merged_df[v] for v in fit_vars)
-    res = scipy.optimize.minimize(
-        PMEL_oxy_weighted_residual,
-        x0=sbe_coef0,
-        args=(weights, fit_data, merged_df["REFOXY"]),
-        bounds=[(None, None), (None, None), (0, None), (None, None), (None, None)],
+    fit_data = tuple(merged_df[v].to_numpy(dtype=float) for v in fit_vars)
+    cfw_coefs, keep, _ = robust_fit(
+        _PMEL_oxy_eq,
+        sbe_coef0,
+        fit_data,
+        merged_df["REFOXY"],
+        jac=_PMEL_oxy_jac,
+        weights=weights,
+        bounds=_PMEL_oxy_bounds,
+        n_sigma=2.8,
     )
-
-    cfw_coefs = res.x
     merged_df["CTDOXY"] = _PMEL_oxy_eq(cfw_coefs, fit_data)
     merged_df["residual"] = merged_df["REFOXY"] - merged_df["CTDOXY"]
-    cutoff = 2.8 * np.std(merged_df["residual"])
-    thrown_values = merged_df[np.abs(merged_df["residual"]) > cutoff]
-    bad_df = pd.concat([bad_df, thrown_values])
-    merged_df = merged_df[np.abs(merged_df["residual"]) <= cutoff].copy()
-
-    while not thrown_values.empty:  # runs as long as there are thrown_values
-
-        p0 = tuple(cfw_coefs)  # initialize coefficients with previous results
-        weights = calculate_weights(merged_df["CTDPRS"])
-        fit_data = tuple(merged_df[v] for v in fit_vars)  # merged_df changes each loop
-        res = scipy.optimize.minimize(
-            PMEL_oxy_weighted_residual,
-            x0=p0,
-            args=(weights, fit_data, merged_df["REFOXY"]),
-            bounds=[(None, None), (None, None), (0, None), (None, None), (None, None)],
-        )
-
-        cfw_coefs = res.x
-        merged_df["CTDOXY"] = _PMEL_oxy_eq(cfw_coefs, fit_data)
-        merged_df["residual"] = merged_df["REFOXY"] - merged_df["CTDOXY"]
-        cutoff = 2.8 * np.std(merged_df["residual"])
-        thrown_values = merged_df[np.abs(merged_df["residual"]) > cutoff]
-        bad_df = pd.concat([bad_df, thrown_values])
-        merged_df = merged_df[np.abs(merged_df["residual"]) <= cutoff].copy()
 
     # intermediate plots to diagnose data chunks goodness
     if f_suffix is not None:
         f_out = f"{cfg.fig_dirs['ox']}sbe43_residual{f_suffix}.pdf"
         ctd_plots._intermediate_residual_plot(
-            merged_df["residual"],
-            merged_df["CTDPRS"],
-            merged_df["SSSCC"],
+            merged_df.loc[keep, "residual"],
+            merged_df.loc[keep, "CTDPRS"],
+            merged_df.loc[keep, "SSSCC"],
             xlabel="CTDOXY Residual (umol/kg)",
             f_out=f_out,
             xlim=(-10, 10),
         )
 
-    merged_df["CTDOXY_FLAG_W"] = 2
-    bad_df["CTDOXY_FLAG_W"] = 3
-    df = pd.concat([merged_df, bad_df])
+    merged_df["CTDOXY_FLAG_W"] = np.where(keep, 2, 3)
 
-    return cfw_coefs, df
+    return cfw_coefs, merged_df
 
 
 def prepare_oxy(btl_df, time_df, ssscc_list, user_cfg, ref_node):
@@ -803,10 +861,45 @@ def prepare_oxy(btl_df, time_df, ssscc_list, user_cfg, ref_node):
     return True
 
 
-def calibrate_oxy(btl_df, time_df, ssscc_list):
+def _sbe43_match_cast(btl_data, time_data, sbe_coef0=None):
+    """
+    Density match bottle and continuous data from a single cast for SBE43 fitting.
+    """
+    sbe43_merged = match_sigmas(
+        btl_data[cfg.column["p"]],
+        btl_data[cfg.column["refO"]],
+        btl_data["CTDTMP1"],
+        btl_data["SA"],
+        btl_data.index,
+        time_data["OS"],
+        time_data[cfg.column["p"]],
+        time_data[cfg.column["t1"]],
+        time_data["SA"],
+        time_data[cfg.column["oxyvolts"]],
+        time_data["scan_datetime"],
+        sbe_coef0=sbe_coef0,
+    )
+
+    return sbe43_merged.reindex(btl_data.index)  # add nan rows back in
+
+
+def _sbe43_fit_cast(merged_df, ssscc, sbe_coef0, weight_bins=None):
+    """
+    Fit SBE43 coefficients for a single cast, starting from sbe_coef0.
+    """
+    return sbe43_oxy_fit(
+        merged_df, sbe_coef0=sbe_coef0, f_suffix=f"_{ssscc}", weight_bins=weight_bins
+    )
+
+
+def calibrate_oxy(btl_df, time_df, ssscc_list, max_workers=1, weight_bins=None):
     """
     Non-linear least squares fit chemical sensor oxygen against bottle oxygen.
 
+    Casts are density matched and fit independently of one another, which can
+    be run in a pool of processes by setting max_workers. Results are combined
+    in ssscc_list order regardless of the number of workers.
+
     Parameters
     ----------
     btl_df : DataFrame
@@ -815,6 +908,11 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
         Continuous CTD data
     ssscc_list : list of str
         List of stations to process
+    max_workers : int, optional
+        Number of processes for per-cast matching and fitting. Default (1) runs
+        casts sequentially; None uses all available CPUs.
+    weight_bins : tuple of list, optional
+        Pressure bin edges and fit weights (see calculate_weights)
 
     Returns
     -------
@@ -832,95 +930,106 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
         xlim=(-10, 10),
     )
     # Prep vars, dfs, etc.
-    all_sbe43_merged = pd.DataFrame()
     sbe43_dict = {}
-    all_sbe43_fit = pd.DataFrame()
 
     btl_df.set_index("master_index", inplace=True)
 
     btl_df["dv_dt"] = np.nan  # initialize column
+    btl_index = process_ctd.get_cast_index(btl_df)
+    time_index = process_ctd.get_cast_index(time_df)
+    merged_cols = ["CTDOXYVOLTS", "dv_dt", "OS"]
     # Density match time/btl oxy dataframes
+    matched_list = []
     for ssscc in ssscc_list:
-        time_data = time_df[time_df["SSSCC"] == ssscc].copy()
-        btl_data = btl_df[btl_df["SSSCC"] == ssscc].copy()
         # can't calibrate without bottle oxygen ("OXYGEN")
-        if (btl_data["OXYGEN_FLAG_W"] == 9).all():
+        if (btl_df.iloc[btl_index[ssscc]]["OXYGEN_FLAG_W"] == 9).all():
             sbe43_dict[ssscc] = np.full(5, np.nan)
             log.warning(ssscc + " skipped, all oxy data is NaN")
-            continue
-        sbe43_merged = match_sigmas(
-            btl_data[cfg.column["p"]],
-            btl_data[cfg.column["refO"]],
-            btl_data["CTDTMP1"],
-            btl_data["SA"],
-            btl_data.index,
-            time_data["OS"],
-            time_data[cfg.column["p"]],
-            time_data[cfg.column["t1"]],
-            time_data["SA"],
-            time_data[cfg.column["oxyvolts"]],
-            time_data["scan_datetime"],
-        )
-        sbe43_merged = sbe43_merged.reindex(btl_data.index)  # add nan rows back in
-        btl_df.loc[btl_df["SSSCC"] == ssscc, ["CTDOXYVOLTS", "dv_dt", "OS"]] = (
-            sbe43_merged[["CTDOXYVOLTS", "dv_dt", "OS"]]
+        else:
+            matched_list.append(ssscc)
+    all_sbe43_merged = parallel_map(
+        _sbe43_match_cast,
+        (btl_df.iloc[btl_index[ssscc]].copy() for ssscc in matched_list),
+        (time_df.iloc[time_index[ssscc]].copy() for ssscc in matched_list),
+        repeat(_get_sbe_coef()),
+        max_workers=max_workers,
+        processes=True,
+    )
+    for ssscc, sbe43_merged in zip(matched_list, all_sbe43_merged):
+        btl_df.iloc[btl_index[ssscc], btl_df.columns.get_indexer(merged_cols)] = (
+            sbe43_merged[merged_cols].to_numpy()
         )
         sbe43_merged["SSSCC"] = ssscc
-        all_sbe43_merged = pd.concat([all_sbe43_merged, sbe43_merged])
         log.info(ssscc + " density matching done")
+    all_sbe43_merged = pd.concat(all_sbe43_merged)
 
     # Only fit using OXYGEN flagged good (2)
     all_sbe43_merged = all_sbe43_merged.loc[btl_df["OXYGEN_FLAG_W"] == 2].copy()
 
     # Fit ALL oxygen stations together to get initial coefficient guess
-    (sbe_coef0, _) = sbe43_oxy_fit(all_sbe43_merged, f_suffix="_ox0")
+    (sbe_coef0, _) = sbe43_oxy_fit(
+        all_sbe43_merged, f_suffix="_ox0", weight_bins=weight_bins
+    )
     sbe43_dict["ox0"] = sbe_coef0
 
     # Fit each cast individually
-    for ssscc in ssscc_list:
-        sbe_coef, sbe_df = sbe43_oxy_fit(
-            all_sbe43_merged.loc[all_sbe43_merged["SSSCC"] == ssscc].copy(),
-            sbe_coef0=sbe_coef0,
-            f_suffix=f"_{ssscc}",
-        )
+    merged_index = process_ctd.get_cast_index(all_sbe43_merged)
+    cast_fits = parallel_map(
+        _sbe43_fit_cast,
+        (all_sbe43_merged.iloc[merged_index[ssscc]].copy() for ssscc in ssscc_list),
+        ssscc_list,
+        repeat(sbe_coef0),
+        repeat(weight_bins),
+        max_workers=max_workers,
+        processes=True,
+    )
+    for ssscc, (sbe_coef, _) in zip(ssscc_list, cast_fits):
         # build coef dictionary
         if ssscc not in sbe43_dict.keys():  # don't overwrite NaN'd stations
             sbe43_dict[ssscc] = sbe_coef
-        # all non-NaN oxygen data with flags
-        all_sbe43_fit = pd.concat([all_sbe43_fit, sbe_df])
 
     # apply coefs
     time_df["CTDOXY"] = np.nan
+    if "CTDOXY_FLAG_W" not in time_df.columns:
+        time_df["CTDOXY_FLAG_W"] = np.nan
     for ssscc in ssscc_list:
         if np.isnan(sbe43_dict[ssscc]).all():
             log.warning(
                 f"{ssscc} missing oxy data, leaving nan values and flagging as 9"
             )
-            time_df.loc[time_df["SSSCC"] == ssscc, "CTDOXY_FLAG_W"] = 9
+            time_df.iloc[
+                time_index[ssscc], time_df.columns.get_loc("CTDOXY_FLAG_W")
+            ] = 9
             continue
-        btl_rows = (btl_df["SSSCC"] == ssscc).values
-        time_rows = (time_df["SSSCC"] == ssscc).values
-        btl_df.loc[btl_rows, "CTDOXY"] = _PMEL_oxy_eq(
+        btl_rows = btl_index[ssscc]
+        time_rows = time_index[ssscc]
+        btl_data = btl_df.iloc[btl_rows]
+        time_data = time_df.iloc[time_rows]
+        btl_oxy = _PMEL_oxy_eq(
             sbe43_dict[ssscc],
             (
-                btl_df.loc[btl_rows, cfg.column["oxyvolts"]],
-                btl_df.loc[btl_rows, cfg.column["p"]],
-                btl_df.loc[btl_rows, cfg.column["t1"]],
-                btl_df.loc[btl_rows, "dv_dt"],
-                btl_df.loc[btl_rows, "OS"],
+                btl_data[cfg.column["oxyvolts"]],
+                btl_data[cfg.column["p"]],
+                btl_data[cfg.column["t1"]],
+                btl_data["dv_dt"],
+                btl_data["OS"],
             ),
         )
+        btl_df.iloc[btl_rows, btl_df.columns.get_loc("CTDOXY")] = np.asarray(btl_oxy)
         log.info(ssscc + " btl data fitting done")
-        time_df.loc[time_rows, "CTDOXY"] = _PMEL_oxy_eq(
+        time_oxy = _PMEL_oxy_eq(
             sbe43_dict[ssscc],
             (
-                time_df.loc[time_rows, cfg.column["oxyvolts"]],
-                time_df.loc[time_rows, cfg.column["p"]],
-                time_df.loc[time_rows, cfg.column["t1"]],
-                time_df.loc[time_rows, "dv_dt"],
-                time_df.loc[time_rows, "OS"],
+                time_data[cfg.column["oxyvolts"]],
+                time_data[cfg.column["p"]],
+                time_data[cfg.column["t1"]],
+                time_data["dv_dt"],
+                time_data["OS"],
             ),
         )
+        time_df.iloc[time_rows, time_df.columns.get_loc("CTDOXY")] = np.asarray(
+            time_oxy
+        )
         log.info(ssscc + " time data fitting done")
 
     # flag CTDOXY with more than 1% difference
@@ -4,9 +4,10 @@ Joseph Gum SIO/ODF
 Nov 7, 2016
 """
 
-import csv
 import logging
+import re
 from collections import OrderedDict
+from contextlib import ExitStack
 from datetime import datetime
 from pathlib import Path
 
@@ -15,7 +16,9 @@ import pandas as pd
 
 from . import flagging as flagging
 from . import get_ctdcal_config
+from . import io as io
 from . import oxy_fitting as oxy_fitting
+from .common import parallel_map
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -23,6 +26,12 @@ log = logging.getLogger(__name__)
 BOTTLE_FIRE_COL = "btl_fire"
 BOTTLE_FIRE_NUM_COL = "btl_fire_num"
 
+_REFT_LINE = re.compile(
+    r"\s*(\d+)\s+(\d+)\s+(\w+)\s+(\d+)\s+(\d+:\d+:\d+)"
+    r"\s+bn\s*=\s*(\d+)\s+diff\s*=\s*(-?\d+)"
+    r"\s+val\s*=\s*(-?[\d.]+)\s+t90\s*=\s*(-?[\d.]+)\s*$"
+)
+
 
 def retrieveBottleDataFromFile(converted_file):
     """
@@ -40,62 +49,161 @@ def retrieveBottleData(converted_df):
     Looks for changes in the BOTTLE_FIRE_COL column, ready to be averaged in making the CTD bottle file.
     """
     if BOTTLE_FIRE_COL in converted_df.columns:
-        converted_df[BOTTLE_FIRE_NUM_COL] = (
-            (
-                (converted_df[BOTTLE_FIRE_COL])
-                & (
-                    converted_df[BOTTLE_FIRE_COL]
-                    != converted_df[BOTTLE_FIRE_COL].shift(1)
-                )
-            )
-            .astype(int)
-            .cumsum()
-        )
+        fire = converted_df[BOTTLE_FIRE_COL].astype(bool)
+        fire_num = (fire & (fire != fire.shift(1))).astype(int).cumsum()
         # converted_df['bottle_fire_num'] = ((converted_df[BOTTLE_FIRE_COL] == False)).astype(int).cumsum()
-        return converted_df.loc[converted_df[BOTTLE_FIRE_COL]]
-        # return converted_df
+        return converted_df.loc[fire].assign(**{BOTTLE_FIRE_NUM_COL: fire_num[fire]})
     else:
-        log.error("Bottle fire column:", BOTTLE_FIRE_COL, "not found")
+        log.error(f"Bottle fire column: {BOTTLE_FIRE_COL} not found")
 
     return pd.DataFrame()  # empty dataframe
 
 
-def bottle_mean(btl_df):
-    """Compute the mean for each bottle from a dataframe."""
-    btl_max = int(btl_df[BOTTLE_FIRE_NUM_COL].tail(n=1))
-    i = 1
-    output = pd.DataFrame()
-    while i <= btl_max:
-        output = pd.concat(
-            (
-                output,
-                btl_df[btl_df[BOTTLE_FIRE_NUM_COL] == i]
-                .mean()
-                .to_frame(name=i)
-                .transpose(),
-            )
-        )
-        i += 1
-    return output
-
-
-def bottle_median(btl_df):
-    """Compute the median for each bottle from a dataframe."""
-    btl_max = int(btl_df[BOTTLE_FIRE_NUM_COL].tail(n=1))
-    i = 1
-    output = pd.DataFrame()
-    while i <= btl_max:
-        output = pd.concat(
-            (
-                output,
-                btl_df[btl_df[BOTTLE_FIRE_NUM_COL] == i]
-                .median()
-                .to_frame(name=i)
-                .transpose(),
-            )
-        )
-        i += 1
-    return output
+def bottle_stats(btl_df, how="mean", proportiontocut=0.1, std=False, count=False):
+    """
+    Reduce the scans of each bottle to one row in a single grouped pass.
+
+    Scans are sorted into one segment per bottle (retrieveBottleData output is
+    already in order) and every column is reduced at once with segment reductions.
+    NaNs are skipped. Rows are indexed by bottle number, from 1 to the last bottle;
+    bottles without scans are all NaN.
+
+    Parameters
+    ----------
+    btl_df : DataFrame
+        Bottle fire scans with bottle numbers, as returned by retrieveBottleData
+    how : {"mean", "median", "trim_mean"}, optional
+        Statistic used for the bottle values
+    proportiontocut : float, optional
+        Fraction of scans cut from each end of the sorted bottle data for "trim_mean"
+        (as scipy.stats.trim_mean)
+    std : bool or list of str, optional
+        Add the standard deviation of the scans of all (True) or the listed columns,
+        as "<column>_STD"
+    count : bool, optional
+        Add the number of scans of each bottle as "n_scans"
+
+    Returns
+    -------
+    DataFrame
+        Bottle statistics
+    """
+    if how not in ["mean", "median", "trim_mean"]:
+        raise ValueError(f"Unknown bottle statistic '{how}'")
+
+    fire_num = btl_df[BOTTLE_FIRE_NUM_COL].to_numpy()
+    data = btl_df.to_numpy(dtype=float)
+    if np.any(np.diff(fire_num) < 0):
+        order = np.argsort(fire_num, kind="stable")
+        fire_num, data = fire_num[order], data[order]
+
+    return _reduce_bottles(
+        data, fire_num, list(btl_df.columns), how, proportiontocut, std, count
+    )
+
+
+def _reduce_bottles(data, fire_num, columns, how, proportiontocut, std, count):
+    """Reduce scan data sorted by bottle number (see bottle_stats)."""
+    # one contiguous segment per bottle
+    starts = np.flatnonzero(np.diff(fire_num, prepend=np.nan) != 0)
+    bottles, n_scans = fire_num[starts], np.diff(starts, append=len(fire_num))
+    finite = np.isfinite(data)
+    n_finite = np.add.reduceat(finite, starts, axis=0) if len(starts) else finite[:0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(np.where(finite, data, 0), starts, axis=0) / n_finite
+
+    if how == "mean":
+        values = mean
+    else:
+        # pad segments into (bottle, scan, column) to sort each bottle's scans
+        seg = np.repeat(np.arange(len(bottles)), n_scans)
+        padded = np.full((len(bottles), n_scans.max(initial=0), data.shape[1]), np.nan)
+        padded[seg, np.arange(len(fire_num)) - starts[seg]] = data
+        padded.sort(axis=1)  # NaNs last
+        if how == "median":
+            lo = np.take_along_axis(padded, ((n_finite - 1) // 2)[:, None, :], axis=1)
+            hi = np.take_along_axis(padded, (n_finite // 2)[:, None, :], axis=1)
+            values = ((lo + hi) / 2)[:, 0, :]  # NaN for bottles without data
+        else:
+            cut = (proportiontocut * n_finite).astype(int)
+            keep = np.arange(padded.shape[1])[None, :, None]
+            keep = (keep >= cut[:, None, :]) & (keep < (n_finite - cut)[:, None, :])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = np.where(keep, padded, 0).sum(axis=1) / (n_finite - 2 * cut)
+
+    output = pd.DataFrame(values, index=bottles, columns=columns)
+
+    if std is not False:
+        std_cols = columns if std is True else list(std)
+        idx = [columns.index(col) for col in std_cols]
+        seg = np.repeat(np.arange(len(bottles)), n_scans)
+        dev = np.where(finite[:, idx], data[:, idx] - mean[seg][:, idx], 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = np.add.reduceat(dev**2, starts, axis=0) / (n_finite[:, idx] - 1)
+        var[n_finite[:, idx] < 2] = np.nan
+        output[[f"{col}_STD" for col in std_cols]] = np.sqrt(var)
+    if count:
+        output["n_scans"] = n_scans
+
+    btl_max = int(fire_num[-1]) if len(fire_num) else 0
+    return output.reindex(pd.RangeIndex(1, btl_max + 1)).rename_axis(None)
+
+
+def _fire_segments(fire):
+    """Find the first and last (exclusive) scan of each bottle fire in the fire bits."""
+    edges = np.diff(np.asarray(fire, dtype=np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def extract_bottle_stats(
+    converted_df, how="mean", proportiontocut=0.1, std=False, count=False
+):
+    """
+    Compute bottle statistics straight from converted cast data.
+
+    Equivalent to bottle_stats(retrieveBottleData(converted_df)). Bottle fire
+    segments are found from the BOTTLE_FIRE_COL bits and only those scans are
+    reduced, without adding columns to or copying the full cast data.
+
+    Parameters
+    ----------
+    converted_df : DataFrame
+        Converted cast data
+    how, proportiontocut, std, count
+        See bottle_stats
+
+    Returns
+    -------
+    DataFrame
+        Bottle statistics (empty if the cast has no bottle fire column)
+    """
+    if BOTTLE_FIRE_COL not in converted_df.columns:
+        log.error(f"Bottle fire column: {BOTTLE_FIRE_COL} not found")
+        return pd.DataFrame()
+    if how not in ["mean", "median", "trim_mean"]:
+        raise ValueError(f"Unknown bottle statistic '{how}'")
+
+    starts, ends = _fire_segments(converted_df[BOTTLE_FIRE_COL])
+    n_scans = ends - starts
+    offsets = n_scans.cumsum() - n_scans  # first row of each bottle in the output
+    rows = np.repeat(starts - offsets, n_scans) + np.arange(n_scans.sum())
+    fire_num = np.repeat(np.arange(1, len(starts) + 1), n_scans)
+
+    scans = converted_df.iloc[rows].drop(columns=BOTTLE_FIRE_NUM_COL, errors="ignore")
+    data = np.column_stack([scans.to_numpy(dtype=float), fire_num])
+    columns = list(scans.columns) + [BOTTLE_FIRE_NUM_COL]
+
+    return _reduce_bottles(data, fire_num, columns, how, proportiontocut, std, count)
+
+
+def bottle_mean(btl_df, **kwargs):
+    """Compute the mean for each bottle from a dataframe (see bottle_stats)."""
+    return bottle_stats(btl_df, how="mean", **kwargs)
+
+
+def bottle_median(btl_df, **kwargs):
+    """Compute the median for each bottle from a dataframe (see bottle_stats)."""
+    return bottle_stats(btl_df, how="median", **kwargs)
 
 
 def _load_btl_data(btl_file, cols=None):
@@ -138,15 +246,20 @@ def _load_salt_data(salt_file, index_name="SAMPNO"):
     return salt_data
 
 
-def _add_btl_bottom_data(df, cast, lat_col="LATITUDE", lon_col="LONGITUDE", decimals=4):
+def _add_btl_bottom_data(
+    df, cast, lat_col="LATITUDE", lon_col="LONGITUDE", decimals=4, cast_details=None
+):
     """
     Adds lat/lon, date, and time to dataframe based on the values in the bottom_bottle_details.csv
+
+    cast_details can be given to use already loaded bottom bottle details.
     """
-    cast_details = pd.read_csv(
-        # cfg.dirs["logs"] + "cast_details.csv", dtype={"SSSCC": str}
-        cfg.dirs["logs"] + "bottom_bottle_details.csv",
-        dtype={"SSSCC": str},
-    )
+    if cast_details is None:
+        cast_details = pd.read_csv(
+            # cfg.dirs["logs"] + "cast_details.csv", dtype={"SSSCC": str}
+            cfg.dirs["logs"] + "bottom_bottle_details.csv",
+            dtype={"SSSCC": str},
+        )
     cast_details = cast_details[cast_details["SSSCC"] == cast]
     # df[lat_col] = np.round(cast_details["latitude"].iat[0], decimals)
     # df[lon_col] = np.round(cast_details["longitude"].iat[0], decimals)
@@ -161,17 +274,116 @@ def _add_btl_bottom_data(df, cast, lat_col="LATITUDE", lon_col="LONGITUDE", deci
     return df
 
 
-def load_all_btl_files(ssscc_list, cols=None):
+def _load_cast_btl_files(ssscc, cols=None, cast_details=None):
+    """
+    Load the bottle file of one cast and join its secondary (reference temperature,
+    bottle salts, bottle oxygen) data on bottle number.
+    """
+    log.info("Loading BTL data for station: " + ssscc + "...")
+    btl_file = cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl"
+    btl_data = _load_btl_data(btl_file, cols)
+
+    ### load REFT data
+    reft_file = cfg.dirs["reft"] + ssscc + "_reft.csv"
+    try:
+        reft_data = _load_reft_data(reft_file)
+        if len(reft_data) > 36:
+            log.error(f"len(reft_data) > 36 for {ssscc}, check reftmp file")
+    except FileNotFoundError:
+        log.warning(
+            "Missing (or misnamed) REFT Data Station: "
+            + ssscc
+            + "...filling with NaNs"
+        )
+        reft_data = pd.DataFrame(index=btl_data.index, columns=["T90"], dtype=float)
+        reft_data["btl_fire_num"] = btl_data["btl_fire_num"].astype(int)
+        reft_data["SSSCC_TEMP"] = ssscc
+
+    ### load REFC data
+    refc_file = cfg.dirs["salt"] + ssscc + "_salts.csv"
+    try:
+        refc_data = _load_salt_data(refc_file, index_name="SAMPNO")
+        if len(refc_data) > 36:
+            log.error(f"len(refc_data) > 36 for {ssscc}, check autosal file")
+    except FileNotFoundError:
+        log.warning(
+            "Missing (or misnamed) REFC Data Station: "
+            + ssscc
+            + "...filling with NaNs"
+        )
+        refc_data = pd.DataFrame(
+            index=btl_data.index,
+            columns=["CRavg", "BathTEMP", "BTLCOND"],
+            dtype=float,
+        )
+        refc_data["SAMPNO_SALT"] = btl_data["btl_fire_num"].astype(int)
+
+    ### load OXY data
+    oxy_file = Path(cfg.dirs["oxygen"] + ssscc)
+    try:
+        oxy_data, params = oxy_fitting.load_winkler_oxy(oxy_file)
+        if len(oxy_data) > 36:
+            log.error(f"len(oxy_data) > 36 for {ssscc}, check oxygen file")
+    except FileNotFoundError:
+        log.warning(
+            "Missing (or misnamed) REFO Data Station: "
+            + ssscc
+            + "...filling with NaNs"
+        )
+        oxy_data = pd.DataFrame(
+            index=btl_data.index,
+            columns=[
+                "FLASKNO",
+                "TITR_VOL",
+                "TITR_TEMP",
+                "DRAW_TEMP",
+                "TITR_TIME",
+                "END_VOLTS",
+            ],
+            dtype=float,
+        )
+        oxy_data["STNNO_OXY"] = ssscc[:3]
+        oxy_data["CASTNO_OXY"] = ssscc[3:]
+        oxy_data["BOTTLENO_OXY"] = btl_data["btl_fire_num"].astype(int)
+
+    ### join all data on bottle number
+    # bottle numbers found in any file are kept; btl_fire_num is filled in for
+    # bottles with CTD or reference temperature data (as an outer merge would)
+    btl_data = btl_data.set_index(btl_data["btl_fire_num"].rename(None))
+    reft_data = reft_data.set_index(reft_data.pop("btl_fire_num").rename(None))
+    refc_data = refc_data.set_index(refc_data["SAMPNO_SALT"].rename(None))
+    oxy_data = oxy_data.set_index(oxy_data["BOTTLENO_OXY"].rename(None))
+    btl_data = btl_data.join([reft_data, refc_data, oxy_data], how="outer")
+    btl_data = btl_data.sort_index(kind="stable")
+
+    in_btl_or_reft = btl_data.index.isin(reft_data.index) | btl_data.index.isin(
+        btl_data["btl_fire_num"].dropna()
+    )
+    btl_data["btl_fire_num"] = btl_data.index.where(in_btl_or_reft, np.nan)
+    btl_data = btl_data.reset_index(drop=True)
+
+    if len(btl_data) > 36:
+        log.error(f"len(btl_data) for {ssscc} > 36, check bottle file")
+
+    # Add bottom of cast information (date,time,lat,lon,etc.)
+    return _add_btl_bottom_data(btl_data, ssscc, cast_details=cast_details)
+
+
+def load_all_btl_files(ssscc_list, cols=None, max_workers=None):
     """
     Load bottle and secondary (e.g. reference temperature, bottle salts, bottle oxygen)
     files for station/cast list and merge into a dataframe.
 
+    Casts are read concurrently (in threads) and concatenated at once.
+
     Parameters
     ----------
     ssscc_list : list of str
         List of stations to load
     cols : list of str, optional
         Subset of columns to load, defaults to loading all
+    max_workers : int, optional
+        Maximum number of casts to read concurrently
 
     Returns
     -------
@@ -179,111 +391,19 @@ def load_all_btl_files(ssscc_list, cols=None):
         Merged dataframe containing all loaded data
 
     """
-    df_data_all = pd.DataFrame()
-
-    for ssscc in ssscc_list:
-        log.info("Loading BTL data for station: " + ssscc + "...")
-        btl_file = cfg.dirs["bottle"] + ssscc + "_btl_mean.pkl"
-        btl_data = _load_btl_data(btl_file, cols)
-
-        ### load REFT data
-        reft_file = cfg.dirs["reft"] + ssscc + "_reft.csv"
-        try:
-            reft_data = _load_reft_data(reft_file)
-            if len(reft_data) > 36:
-                log.error(f"len(reft_data) > 36 for {ssscc}, check reftmp file")
-        except FileNotFoundError:
-            log.warning(
-                "Missing (or misnamed) REFT Data Station: "
-                + ssscc
-                + "...filling with NaNs"
-            )
-            reft_data = pd.DataFrame(index=btl_data.index, columns=["T90"], dtype=float)
-            reft_data["btl_fire_num"] = btl_data["btl_fire_num"].astype(int)
-            reft_data["SSSCC_TEMP"] = ssscc
-
-        ### load REFC data
-        refc_file = cfg.dirs["salt"] + ssscc + "_salts.csv"
-        try:
-            refc_data = _load_salt_data(refc_file, index_name="SAMPNO")
-            if len(refc_data) > 36:
-                log.error(f"len(refc_data) > 36 for {ssscc}, check autosal file")
-        except FileNotFoundError:
-            log.warning(
-                "Missing (or misnamed) REFC Data Station: "
-                + ssscc
-                + "...filling with NaNs"
-            )
-            refc_data = pd.DataFrame(
-                index=btl_data.index,
-                columns=["CRavg", "BathTEMP", "BTLCOND"],
-                dtype=float,
-            )
-            refc_data["SAMPNO_SALT"] = btl_data["btl_fire_num"].astype(int)
-
-        ### load OXY data
-        oxy_file = Path(cfg.dirs["oxygen"] + ssscc)
-        try:
-            oxy_data, params = oxy_fitting.load_winkler_oxy(oxy_file)
-            if len(oxy_data) > 36:
-                log.error(f"len(oxy_data) > 36 for {ssscc}, check oxygen file")
-        except FileNotFoundError:
-            log.warning(
-                "Missing (or misnamed) REFO Data Station: "
-                + ssscc
-                + "...filling with NaNs"
-            )
-            oxy_data = pd.DataFrame(
-                index=btl_data.index,
-                columns=[
-                    "FLASKNO",
-                    "TITR_VOL",
-                    "TITR_TEMP",
-                    "DRAW_TEMP",
-                    "TITR_TIME",
-                    "END_VOLTS",
-                ],
-                dtype=float,
-            )
-            oxy_data["STNNO_OXY"] = ssscc[:3]
-            oxy_data["CASTNO_OXY"] = ssscc[3:]
-            oxy_data["BOTTLENO_OXY"] = btl_data["btl_fire_num"].astype(int)
-
-        ### clean up dataframe
-        # Horizontally concat DFs to have all data in one DF
-        btl_data = pd.merge(btl_data, reft_data, on="btl_fire_num", how="outer")
-        btl_data = pd.merge(
-            btl_data,
-            refc_data,
-            left_on="btl_fire_num",
-            right_on="SAMPNO_SALT",
-            how="outer",
-        )
-        btl_data = pd.merge(
-            btl_data,
-            oxy_data,
-            left_on="btl_fire_num",
-            right_on="BOTTLENO_OXY",
-            how="outer",
-        )
-
-        if len(btl_data) > 36:
-            log.error(f"len(btl_data) for {ssscc} > 36, check bottle file")
-
-        # Add bottom of cast information (date,time,lat,lon,etc.)
-        btl_data = _add_btl_bottom_data(btl_data, ssscc)
-
-        # Merge cast into df_data_all
-        try:
-            df_data_all = pd.concat([df_data_all, btl_data], sort=False)
-        except AssertionError:
-            raise AssertionError(
-                "Columns of " + ssscc + " do not match those of previous columns"
-            )
-        # print("* Finished BTL data station: " + ssscc + " *")
+    cast_details = pd.read_csv(
+        cfg.dirs["logs"] + "bottom_bottle_details.csv", dtype={"SSSCC": str}
+    )
+    casts = parallel_map(
+        lambda ssscc: _load_cast_btl_files(ssscc, cols, cast_details),
+        ssscc_list,
+        max_workers=max_workers,
+    )
+    df_data_all = pd.concat(casts, sort=False) if casts else pd.DataFrame()
 
     # Drop duplicated columns generated by concatenation
-    df_data_all = df_data_all.loc[:, ~df_data_all.columns.duplicated()]
+    if df_data_all.columns.duplicated().any():
+        df_data_all = df_data_all.loc[:, ~df_data_all.columns.duplicated()]
 
     df_data_all["master_index"] = range(len(df_data_all))
 
@@ -313,34 +433,25 @@ def _reft_loader(ssscc, reft_dir=cfg.dirs["reft"]):
     except IndexError:
         raise FileNotFoundError
 
-    # this works better than pd.read_csv as format is semi-inconsistent (cf .cap files)
-    with open(reft_path, "r", newline="") as f:
-        reftF = csv.reader(
-            f, delimiter=" ", quoting=csv.QUOTE_NONE, skipinitialspace="True"
-        )
-        reftArray = []
-        for row in reftF:
-            if len(row) != 17:  # skip over 'bad' rows (empty lines, comments, etc.)
-                if len(row) > 17:
-                    log.warning(f"Raw REFT for {ssscc} includes line with abnormally large number of columns. Check .CAP file.")
-                else:
-                    continue
-            reftArray.append(row)
-    if len(reftArray)>36:
-        log.warning("Raw REFT file for {ssscc} exceeds 36 entries. Check .CAP file.")
-
-    reftDF = pd.DataFrame.from_records(reftArray)
-    pd.set_option('future.no_silent_downcasting', True) #   Opt in to future downcasting
-    reftDF = reftDF.replace(
-        to_replace=["bn", "diff", "val", "t90", "="], value=np.nan
-    )
-    reftDF = reftDF.dropna(axis=1)
-    reftDF.loc[:, 1] = reftDF[[1, 2, 3, 4]].agg(" ".join, axis=1)  # dd/mm/yy/time cols are
-    reftDF = reftDF.drop(columns=[2, 3, 4])  # read separately; combine into one
-
-    if len(reftDF.columns) != 6:
-        log.warning("Raw REFT file for {ssscc} has the incorrect number of columns. Check .CAP file.")
-        #   Code will break below
+    with open(reft_path, "r") as f:
+        lines = f.read().splitlines()
+
+    # fixed .cap layout, e.g.:
+    # "  1 27 Feb 2019 13:17:34 bn =  1 diff =    13 val = 275218.0 t90 =  21.6553"
+    reftArray = []
+    for line in lines:
+        match = _REFT_LINE.match(line)
+        if match is not None:
+            reftArray.append(match.groups())
+        elif len(line.split()) >= 17:  # skip over 'bad' rows (empty lines, comments)
+            log.warning(
+                f"Raw REFT for {ssscc} includes line with abnormally large number of "
+                "columns. Check .CAP file."
+            )
+    if len(reftArray) > 36:
+        log.warning(f"Raw REFT file for {ssscc} exceeds 36 entries. Check .CAP file.")
+    if not reftArray:
+        log.warning(f"Raw REFT file for {ssscc} has no readable measurements.")
 
     columns = OrderedDict(  # having this as a dict streamlines next steps
         [
@@ -352,9 +463,21 @@ def _reft_loader(ssscc, reft_dir=cfg.dirs["reft"]):
             ("T90", float),
         ]
     )
-    reftDF.columns = list(columns.keys())  # name columns
-    reftDF = reftDF.astype(columns)  # force dtypes
-    reftDF["datetime"] = pd.to_datetime(reftDF['datetime'], format='%d %b %Y %H:%M:%S') #   Datetime checks, otherwise col is not used
+    fields = list(zip(*reftArray)) if reftArray else [()] * 9
+    reftDF = pd.DataFrame(
+        {
+            "index_memory": np.array(fields[0], dtype=int),
+            "datetime": pd.to_datetime(  # Datetime checks, otherwise col is not used
+                [" ".join(dt) for dt in zip(*fields[1:5])],
+                format="%d %b %Y %H:%M:%S",
+            ),
+            "btl_fire_num": np.array(fields[5], dtype=int),
+            "diff": np.array(fields[6], dtype=int),
+            "raw_value": np.array(fields[7], dtype=float),
+            "T90": np.array(fields[8], dtype=float),
+        },
+        columns=list(columns.keys()),
+    )
 
     #   Check contents of the file for stuff that the analyst should double-check (don't immediately flag)
     if any(((reftDF['datetime'] < pd.Timestamp('1985-01-01')) | (reftDF['datetime'] > pd.Timestamp.today()))):
@@ -377,10 +500,9 @@ def _reft_loader(ssscc, reft_dir=cfg.dirs["reft"]):
     reftDF["REFTMP_FLAG_W"] = 2
     reftDF.loc[reftDF["diff"].abs() >= 3000, "REFTMP_FLAG_W"] = 3
 
-    if any(reftDF["REFTMP_FLAG_W"] > 2):    #   Tell the user iteratively in the logs
-        for idx, row in reftDF.loc[reftDF["REFTMP_FLAG_W"] == 3].iterrows():
-            bad_point = row["index_memory"]
-            log.info(f"Measurement {bad_point} flagged questionable in SSSCC {ssscc}")
+    bad_points = reftDF.loc[reftDF["REFTMP_FLAG_W"] == 3, "index_memory"]
+    for bad_point in bad_points:  # Tell the user iteratively in the logs
+        log.info(f"Measurement {bad_point} flagged questionable in SSSCC {ssscc}")
 
     # add in STNNBR, CASTNO columns
     # string prob better for other sta/cast formats (names, letters, etc.)
@@ -391,29 +513,43 @@ def _reft_loader(ssscc, reft_dir=cfg.dirs["reft"]):
     return reftDF
 
 
-def process_reft(ssscc_list, reft_dir=cfg.dirs["reft"]):
+def _process_cast_reft(ssscc, reft_dir):
+    """Load one cast's .cap file and export it to .csv, unless already exported."""
+    if Path(reft_dir + ssscc + "_reft.csv").exists():
+        return
+    try:
+        reftDF = _reft_loader(ssscc, reft_dir)
+    except FileNotFoundError:
+        log.warning("refT file for cast " + ssscc + " does not exist... skipping")
+        return
+    reftDF.to_csv(reft_dir + ssscc + "_reft.csv", index=False)
+
+
+def process_reft(ssscc_list, reft_dir=cfg.dirs["reft"], max_workers=None):
     """
     SBE35 reference thermometer processing function. Load in .cap files for given
     station/cast list, perform basic flagging, and export to .csv files.
 
+    Casts are processed concurrently; casts which already have a _reft.csv file
+    are skipped.
+
     Parameters
     -------
     ssscc_list : list of str
         List of stations to process
     reft_dir : str, optional
         Path to folder containing raw salt files (defaults to data/reft/)
+    max_workers : int, optional
+        Maximum number of casts to process at once. Use 1 to process casts
+        sequentially.
 
     """
-    for ssscc in ssscc_list:
-        if not Path(reft_dir + ssscc + "_reft.csv").exists():
-            try:
-                reftDF = _reft_loader(ssscc, reft_dir)
-                reftDF.to_csv(reft_dir + ssscc + "_reft.csv", index=False)
-            except FileNotFoundError:
-                log.warning(
-                    "refT file for cast " + ssscc + " does not exist... skipping"
-                )
-                continue
+    parallel_map(
+        _process_cast_reft,
+        ssscc_list,
+        [reft_dir] * len(ssscc_list),
+        max_workers=max_workers,
+    )
 
 
 def add_btlnbr_cols(df, btl_num_col):
@@ -450,46 +586,57 @@ def load_hy_file(path_to_hyfile):
     Returns
     -------
     df : Pandas DataFrame
-        The bottle file without the lead/end rows, comments, or units
+        The bottle file without the lead/end rows, comments, or units. Units
+        are kept in df.attrs["units"].
     """
 
-    df = pd.read_csv(path_to_hyfile, comment="#", skiprows=[0])
-    df = df.drop(df.index[0])  #   Drop the units
-    df = df[df["EXPOCODE"] != "END_DATA"]  #   Drop the final row
-    return df
+    return io.load_exchange_btl(path_to_hyfile)
 
 
-def merge_hy1(
-    df1,
-    df2,
-):
+def _is_hy1_sorted(df):
     """
-    Merges two hy1 files, returning the combined Pandas DataFrame.
+    Check if a bottle DataFrame is ordered by increasing station and cast number
+    and decreasing sample number.
+    """
+    if not pd.api.types.is_numeric_dtype(df["SAMPNO"]):
+        return False
+    keys = pd.MultiIndex.from_arrays([df["STNNBR"], df["CASTNO"], -df["SAMPNO"]])
+    return keys.is_monotonic_increasing
+
+
+def merge_hy1(df1, df2, *dfs):
+    """
+    Merges two or more hy1 files, returning the combined Pandas DataFrame.
     If the hy1 file has not been loaded yet, use load_hy_file.
 
+    Files are only re-sorted if they are not already in order once combined.
+
     Inputs
     -------
     df1 : Pandas DataFrame
         First hy1 file for concatination
     df2 : Pandas DataFrame
         Second hy1 file for concatination
+    *dfs : Pandas DataFrame
+        Any further hy1 files for concatination
 
     Returns
     df: Pandas DataFrame
         Merged bottle file as a DataFrame
     """
 
-    if set(df1.columns) != set(df2.columns):
+    dfs = [df1, df2, *dfs]
+    if any(set(df.columns) != set(df1.columns) for df in dfs):
         print("Bottle file columns do not match. Concatenating with NaNs.")
 
-    df = pd.concat([df1, df2], axis=0, ignore_index=True)  #   Staple df2 onto there
+    df = pd.concat(dfs, axis=0, ignore_index=True)  #   Staple files together
 
     sorting_cols = {"STNNBR", "CASTNO", "SAMPNO"}
     if sorting_cols.issubset(df):
         if df[list(sorting_cols)].isna().any().any():
             print("NaNs found in station/cast/sample number. Check source files.")
 
-        else:
+        elif not _is_hy1_sorted(df):
             df = df.sort_values(
                 by=["STNNBR", "CASTNO", "SAMPNO"],
                 ascending=[True, True, False],
@@ -554,7 +701,34 @@ def export_report_data(df):
     return
 
 
-def export_hy1(df, out_dir=cfg.dirs["pressure"], org="ODF"):
+def _format_hy1_column(col, decimals=None):
+    """
+    Format one hy1 column for writing, replacing missing values with -999.
+
+    Parameters
+    ----------
+    col : Series
+        Column to format
+    decimals : int, optional
+        Number of decimal places to write floating point values with. Values
+        are written unchanged if None or if the column is not floating point.
+
+    Returns
+    -------
+    Series
+        Formatted column
+    """
+    missing = col.isna()
+    if decimals is None or not pd.api.types.is_float_dtype(col):
+        return col.where(~missing, -999) if missing.any() else col
+
+    text = np.char.mod(f"%.{decimals}f", col.to_numpy())
+    return pd.Series(np.where(missing, "-999", text), index=col.index)
+
+
+def export_hy1(
+    df, out_dir=cfg.dirs["pressure"], org="ODF", precision=None, chunksize=10000
+):
     """
     Write out the exchange-lite formatted hy1 bottle file.
 
@@ -564,14 +738,22 @@ def export_hy1(df, out_dir=cfg.dirs["pressure"], org="ODF"):
         Fit bottle data
     out_dir = String or Path object, optional
         The path for where to write the hy1 file
-    org : String, optional
-        The organization or group used to determine subroutines
+    org : String or list of String, optional
+        The organization or group used to determine subroutines. If a list is
+        given, one file per organization is written in a single pass and named
+        "{expocode}_{org}_hy1.csv".
+    precision : dict, optional
+        Number of decimal places to write for each parameter, e.g.
+        {"CTDPRS": 1, "CTDTMP": 4}. Parameters not listed are written as is.
+    chunksize : int, optional
+        Number of rows to format and write at a time
 
     """
     log.info("Exporting bottle file")
     btl_data = df.copy()
     now = datetime.now()
     file_datetime = now.strftime("%Y%m%d")
+    precision = {} if precision is None else precision
 
     btl_columns = {
         "EXPOCODE": "",
@@ -611,8 +793,8 @@ def export_hy1(df, out_dir=cfg.dirs["pressure"], org="ODF"):
 
     btl_data["EXPOCODE"] = cfg.expocode
     btl_data["SECT_ID"] = cfg.section_id
-    btl_data["STNNBR"] = [int(x[0:3]) for x in btl_data["SSSCC"]]
-    btl_data["CASTNO"] = [int(x[3:]) for x in btl_data["SSSCC"]]
+    btl_data["STNNBR"] = btl_data["SSSCC"].str[0:3].astype(int)
+    btl_data["CASTNO"] = btl_data["SSSCC"].str[3:].astype(int)
     btl_data["SAMPNO"] = btl_data["btl_fire_num"].astype(int)
     btl_data = add_btlnbr_cols(btl_data, btl_num_col="btl_fire_num")
 
@@ -625,12 +807,6 @@ def export_hy1(df, out_dir=cfg.dirs["pressure"], org="ODF"):
     btl_data["CTDOXY"] = btl_data.loc[:, "CTDRINKO"]
     btl_data["CTDOXY_FLAG_W"] = btl_data.loc[:, "CTDRINKO_FLAG_W"]
 
-    # round data
-    # for col in ["CTDTMP", "CTDSAL", "SALNTY", "REFTMP"]:
-    #     btl_data[col] = btl_data[col].round(4)
-    # for col in ["CTDPRS", "CTDOXY", "OXYGEN"]:
-    #     btl_data[col] = btl_data[col].round(1)
-
     # add depth
     depth_df = pd.read_csv(
         cfg.dirs["logs"] + "depth_log.csv", dtype={"SSSCC": str}, na_values=-999
@@ -640,38 +816,52 @@ def export_hy1(df, out_dir=cfg.dirs["pressure"], org="ODF"):
     )
     full_depth_df = pd.concat([depth_df, manual_depth_df])
     full_depth_df.drop_duplicates(subset="SSSCC", keep="first", inplace=True)
-    btl_data["DEPTH"] = -999
-    for index, row in full_depth_df.iterrows():
-        btl_data.loc[btl_data["SSSCC"] == row["SSSCC"], "DEPTH"] = int(row["DEPTH"])
+    depths = full_depth_df.set_index("SSSCC")["DEPTH"]
+    btl_data["DEPTH"] = btl_data["SSSCC"].map(depths).fillna(-999).astype(int)
 
     # deal with nans
     btl_data["REFTMP_FLAG_W"] = flagging.nan_values(
         btl_data["REFTMP_FLAG_W"], old_flags=btl_data["REFTMP_FLAG_W"]
     )
-    btl_data = btl_data.where(~btl_data.isnull(), -999)
 
     # check columns
-    try:
-        btl_data[btl_columns.keys()]
-        # this is lazy, do better
-    except KeyError as err:
+    bad_cols = [col for col in btl_columns.keys() if col not in btl_data.columns]
+    if bad_cols:
         log.info("Column names not configured properly... attempting to correct")
-        bad_cols = err.args[0].split("'")[1::2]  # every other str is a column name
-        for col in bad_cols:
-            if col.endswith("FLAG_W"):
-                log.warning(col + " missing, flagging with 9s")
-                btl_data[col] = 9
-            else:
-                log.warning(col + " missing, filling with -999s")
-                btl_data[col] = -999
+    for col in bad_cols:
+        if col.endswith("FLAG_W"):
+            log.warning(col + " missing, flagging with 9s")
+            btl_data[col] = 9
+        else:
+            log.warning(col + " missing, filling with -999s")
+            btl_data[col] = -999
 
     btl_data = btl_data[btl_columns.keys()]
-    time_stamp = file_datetime + org
-    with open(out_dir + cfg.expocode + "_hy1.csv", mode="w+") as f:
-        f.write("BOTTLE, %s\n" % (time_stamp))
-        f.write(",".join(btl_columns.keys()) + "\n")
-        f.write(",".join(btl_columns.values()) + "\n")
-        btl_data.to_csv(f, header=False, index=False)
-        f.write("\n" + "END_DATA")
+
+    if isinstance(org, str):
+        out_files = {org: Path(out_dir + cfg.expocode + "_hy1.csv")}
+    else:
+        out_files = {o: Path(out_dir + f"{cfg.expocode}_{o}_hy1.csv") for o in org}
+
+    # format and write rows in chunks, shared by each organization's file
+    with ExitStack() as stack:
+        files = [stack.enter_context(open(f, mode="w+")) for f in out_files.values()]
+        for f, o in zip(files, out_files.keys()):
+            f.write("BOTTLE, %s\n" % (file_datetime + o))
+            f.write(",".join(btl_columns.keys()) + "\n")
+            f.write(",".join(btl_columns.values()) + "\n")
+        for start in range(0, len(btl_data), chunksize):
+            chunk = btl_data.iloc[start : start + chunksize]
+            chunk = pd.DataFrame(
+                {
+                    col: _format_hy1_column(chunk[col], precision.get(col))
+                    for col in chunk.columns
+                }
+            )
+            rows = chunk.to_csv(header=False, index=False, lineterminator="\n")
+            for f in files:
+                f.write(rows)
+        for f in files:
+            f.write("\n" + "END_DATA")
 
     return
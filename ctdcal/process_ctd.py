@@ -4,6 +4,7 @@ A module for handling continuous CTD data processing, including file write-outs.
 
 import logging
 import warnings
+from collections import defaultdict
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -12,6 +13,7 @@ import numpy as np
 import pandas as pd
 
 from . import get_ctdcal_config, oxy_fitting
+from .common import parallel_map
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -378,7 +380,7 @@ def make_depth_log(time_df, threshold=80):
 
     """
     df = time_df[["SSSCC", "CTDPRS", "GPSLAT", "ALT"]].copy().reset_index()
-    df_group = df.groupby("SSSCC", sort=False)
+    df_group = df.groupby("SSSCC", sort=False, observed=True)
     idx_p_max = df_group["CTDPRS"].idxmax()
     bottom_df = pd.DataFrame(
         data={
@@ -441,14 +443,63 @@ def get_ssscc_list(fname="data/ssscc.csv"):
     return ssscc_list
 
 
-def load_all_ctd_files(ssscc_list):
+def _load_time_arrays(time_file, cols=None):
+    """
+    Load a single time file and break it down into column arrays, with the
+    oxygen voltage time derivative (dv_dt) added.
+    """
+    time_data = pd.read_pickle(time_file)
+    if {"CTDOXYVOLTS", "scan_datetime"}.issubset(time_data.columns):
+        time_data["dv_dt"] = oxy_fitting.calculate_dV_dt(
+            time_data["CTDOXYVOLTS"], time_data["scan_datetime"]
+        )
+    if cols is not None:
+        time_data = time_data[[c for c in cols if c in time_data.columns]]
+    arrays = {col: time_data[col].to_numpy() for col in time_data.columns}
+
+    return time_data.index.to_numpy(), arrays
+
+
+def _column_dtype(pieces):
+    """
+    Choose the output dtype and fill value for a column assembled from per-cast
+    arrays, where casts missing the column are given as None. Follows pd.concat:
+    datetimes are filled with NaT, integers and booleans are upcast to float.
+    """
+    dtypes = [piece.dtype for piece in pieces if piece is not None]
+    if len(set(dtypes)) == 1:
+        dtype = dtypes[0]
+    else:
+        try:
+            dtype = np.result_type(*dtypes)
+        except TypeError:
+            dtype = np.dtype(object)  # e.g. datetimes mixed with numbers
+    if all(piece is not None for piece in pieces):
+        return dtype, None
+    if dtype.kind in "mM":
+        return dtype, np.array("NaT", dtype=dtype)
+    if dtype.kind in "biu":
+        dtype = np.result_type(dtype, float)
+    return dtype, np.nan
+
+
+def load_all_ctd_files(ssscc_list, cols=None, max_workers=None):
     """
     Load CTD files for station/cast list and merge into a dataframe.
 
+    Casts are read concurrently and copied column by column into arrays
+    preallocated from the per-cast row counts. Columns missing from some casts are
+    filled with NaN (NaT for datetimes). Station/cast names are stored as a
+    categorical column.
+
     Parameters
     ----------
     ssscc_list : list of str
         List of stations to load
+    cols : list of str, optional
+        Subset of columns to load, defaults to loading all
+    max_workers : int, optional
+        Maximum number of threads used to read files
 
     Returns
     -------
@@ -456,24 +507,116 @@ def load_all_ctd_files(ssscc_list):
         Merged dataframe containing all loaded data
 
     """
-    df_list = []
-    for ssscc in ssscc_list:
-        log.info("Loading TIME data for station: " + ssscc + "...")
-        time_file = cfg.dirs["time"] + ssscc + "_time.pkl"
-        time_data = pd.read_pickle(time_file)
-        time_data["SSSCC"] = str(ssscc)
-        time_data["dv_dt"] = oxy_fitting.calculate_dV_dt(
-            time_data["CTDOXYVOLTS"], time_data["scan_datetime"]
-        )
-        df_list.append(time_data)
-        # print("** Finished TIME data station: " + ssscc + " **")
-    df_data_all = pd.concat(df_list, axis=0, sort=False)
+    ssscc_list = [str(ssscc) for ssscc in ssscc_list]
+    log.info("Loading TIME data for %s stations..." % len(ssscc_list))
+    time_files = [cfg.dirs["time"] + ssscc + "_time.pkl" for ssscc in ssscc_list]
+    loaded = parallel_map(
+        lambda f: _load_time_arrays(f, cols), time_files, max_workers=max_workers
+    )
+    indexes = [index for index, _ in loaded]
+    parts = [arrays for _, arrays in loaded]
+    del loaded
+
+    # column order follows first appearance (same as pd.concat)
+    columns = list(dict.fromkeys(col for arrays in parts for col in arrays))
+    lengths = np.array([len(index) for index in indexes])
+    bounds = np.concatenate(([0], np.cumsum(lengths)))
+
+    data = {}
+    for col in columns:
+        pieces = [arrays.get(col) for arrays in parts]
+        dtype, fill = _column_dtype(pieces)
+        out = np.empty(bounds[-1], dtype=dtype)
+        for i, piece in enumerate(pieces):
+            out[bounds[i] : bounds[i + 1]] = fill if piece is None else piece
+        data[col] = out
+    del parts
+
+    cast_codes = np.repeat(np.arange(len(ssscc_list)), lengths)
+    data["SSSCC"] = pd.Categorical.from_codes(cast_codes, categories=ssscc_list)
+    index = np.concatenate(indexes) if indexes else np.array([], dtype=int)
+    df_data_all = pd.DataFrame(data, index=index, copy=False)
 
     df_data_all["master_index"] = range(len(df_data_all))
 
     return df_data_all
 
 
+def _no_rows():
+    return slice(0, 0)
+
+
+def get_cast_index(df, cast_col="SSSCC"):
+    """
+    Find the rows belonging to each station/cast, as positional slices.
+
+    Rows of each cast must be contiguous (e.g. as loaded by load_all_ctd_files
+    or load_all_btl_files), which lets casts be selected with df.iloc[slice]
+    instead of comparing every row against the cast name. Categorical cast
+    columns are indexed by their integer codes; other columns are factorized
+    in a single pass.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Data for one or more casts
+    cast_col : str, optional
+        Name of station/cast column
+
+    Returns
+    -------
+    cast_index : defaultdict of slice
+        Slice of row positions for each cast. Casts not found in df map to an
+        empty slice.
+    """
+    keys = df[cast_col]
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        codes, labels = keys.cat.codes.to_numpy(), keys.cat.categories
+    else:
+        codes, labels = pd.factorize(keys)
+
+    starts = np.flatnonzero(np.diff(codes)) + 1
+    starts = np.concatenate(([0], starts)) if len(codes) else starts
+    stops = np.append(starts[1:], len(codes))
+    run_codes = codes[starts]
+    if len(np.unique(run_codes)) != len(run_codes):
+        raise ValueError(
+            f"Rows for each cast in '{cast_col}' must be contiguous, sort data first"
+        )
+
+    cast_index = defaultdict(_no_rows)
+    for code, start, stop in zip(run_codes, starts, stops):
+        if code >= 0:  # missing cast names are coded -1
+            cast_index[labels[code]] = slice(int(start), int(stop))
+
+    return cast_index
+
+
+def get_cast_rows(cast_index, casts, n_rows):
+    """
+    Build a boolean row mask for a group of casts from a cast index.
+
+    Parameters
+    ----------
+    cast_index : dict of slice
+        Row slices for each cast, from get_cast_index
+    casts : list of str
+        Casts to select
+    n_rows : int
+        Total number of rows in the indexed data
+
+    Returns
+    -------
+    rows : ndarray of bool
+        True for each row belonging to one of the casts
+    """
+    rows = np.zeros(n_rows, dtype=bool)
+    for cast in casts:
+        rows[cast_index[cast]] = True
+
+    return rows
+
+
 def manual_backfill(df, p_cutoff, p_col="CTDPRS", flag_suffix="_FLAG_W"):
     """
     Overwrite values below cutoff pressure by backfilling the first data point past
@@ -562,7 +705,7 @@ def export_ct1(df, ssscc_list):
                 log.warning(col + " missing, filling with -999s")
                 df[col] = -999
 
-    df["SSSCC"] = df["SSSCC"].astype(str).copy()
+    cast_index = get_cast_index(df)
     cast_details = pd.read_csv(
         # cfg.dirs["logs"] + "cast_details.csv", dtype={"SSSCC": str}
         cfg.dirs["logs"] + "bottom_bottle_details.csv",
@@ -584,7 +727,7 @@ def export_ct1(df, ssscc_list):
 
     for ssscc in ssscc_list:
 
-        time_data = df[df["SSSCC"] == ssscc].copy()
+        time_data = df.iloc[cast_index[ssscc]].copy()
         time_data = pressure_sequence(time_data)
         # switch oxygen primary sensor to rinko
         # if int(ssscc[:3]) > 35:
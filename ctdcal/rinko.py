@@ -4,13 +4,15 @@ A module for working with the RINKO analog optode.
 
 import logging
 from collections import namedtuple
+from itertools import repeat
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import scipy
 
 from . import ctd_plots, flagging, get_ctdcal_config, oxy_fitting, process_ctd
+from .common import parallel_map
+from .fitting.common import robust_fit, weighted_least_squares
 
 cfg = get_ctdcal_config()
 log = logging.getLogger(__name__)
@@ -140,6 +142,90 @@ def _Uchida_DO_eq(coefs, inputs):
     return DO_sc
 
 
+def _Uchida_DO_jac(coefs, inputs):
+    """
+    Jacobian of the Uchida et al. (2010) oxygen equation with respect to its
+    coefficients (see _Uchida_DO_eq).
+
+    Parameters
+    ----------
+    coefs : tuple
+        (c0, c1, c2, d0, d1, d2, cp)
+    inputs : tuple
+        (raw voltage, pressure, temperature, salinity, oxygen solubility)
+
+    Returns
+    -------
+    jac : ndarray
+        Partial derivatives of dissolved oxygen for each data point (rows) and
+        coefficient (columns)
+    """
+    c0, c1, c2, d0, d1, d2, cp = coefs
+    V_r, P, T, S, o2_sol = (np.asarray(x, dtype=float) for x in inputs)
+
+    K_sv = c0 + (c1 * T) + (c2 * T ** 2)
+    V0 = 1 + d0 * T
+    Vc = d1 + d2 * V_r
+    o2_sat = ((V0 / Vc) - 1) / K_sv
+    p_comp = 1 + cp * P / 1000
+    scale = salinity_correction(o2_sol * p_comp ** (1 / 3), T, S)  # DO_sc / o2_sat
+    DO_sc = o2_sat * scale
+
+    dK = -DO_sc / K_sv  # d/dK_sv
+    dVc = -scale * V0 / (Vc ** 2 * K_sv)  # d/dVc
+
+    return np.column_stack(
+        (
+            dK,  # d/dc0
+            dK * T,  # d/dc1
+            dK * T ** 2,  # d/dc2
+            scale * T / (Vc * K_sv),  # d/dd0
+            dVc,  # d/dd1
+            dVc * V_r,  # d/dd2
+            DO_sc * P / (3000 * p_comp),  # d/dcp
+        )
+    )
+
+
+# bounds need to be specified for all, can't just do cp (pressure compensation)
+_Uchida_DO_bounds = ([-np.inf] * 6 + [0], [np.inf] * 6 + [0.2])
+
+
+def _Uchida_DO_fit(coefs0, weights, inputs, refoxy):
+    """
+    Weighted least squares fit of the Uchida et al. (2010) oxygen equation.
+
+    Minimizes the same weighted sum of squares as oxy_weighted_residual using the
+    analytic Jacobian, with the pressure compensation coefficient cp bounded by
+    [0, 0.2].
+
+    Parameters
+    ----------
+    coefs0 : array-like
+        Initial coefficient guess
+    weights : array-like
+        Weight for each data point
+    inputs : tuple of array-like
+        Raw voltage, pressure, temperature, salinity, oxygen solubility
+    refoxy : array-like
+        Reference (bottle) oxygen
+
+    Returns
+    -------
+    coefs : ndarray
+        Fitted coefficients
+    """
+    return weighted_least_squares(
+        _Uchida_DO_eq,
+        coefs0,
+        inputs,
+        refoxy,
+        jac=_Uchida_DO_jac,
+        weights=weights,
+        bounds=_Uchida_DO_bounds,
+    )
+
+
 def oxy_weighted_residual(coefs, weights, inputs, refoxy, L_norm=2):
     """
     A weighted residual fit in a similar manner to that of the SBE43 method of oxy_fitting.py.
@@ -157,7 +243,16 @@ def oxy_weighted_residual(coefs, weights, inputs, refoxy, L_norm=2):
     return residuals
 
 
-def calibrate_oxy(btl_df, time_df, ssscc_list):
+def _rinko_fit_cast(btl_df, ssscc, rinko_coef0, weight_bins=None):
+    """
+    Fit Rinko coefficients for a single cast, starting from rinko_coef0.
+    """
+    return rinko_oxy_fit(
+        btl_df, rinko_coef0=rinko_coef0, f_suffix=f"_{ssscc}", weight_bins=weight_bins
+    )
+
+
+def calibrate_oxy(btl_df, time_df, ssscc_list, max_workers=1, weight_bins=None):
     """
     Non-linear least squares fit oxygen optode against bottle oxygen.
 
@@ -172,6 +267,11 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
         Continuous CTD data
     ssscc_list : list of str
         List of stations to process
+    max_workers : int, optional
+        Number of processes for fitting the casts of each group. Default (1) runs
+        casts sequentially; None uses all available CPUs.
+    weight_bins : tuple of list, optional
+        Pressure bin edges and fit weights (see oxy_fitting.calculate_weights)
 
     Returns
     -------
@@ -186,7 +286,9 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
     good_data = btl_df[btl_df["OXYGEN_FLAG_W"] == 2].copy()
 
     # Fit ALL oxygen stations together to get initial coefficient guess
-    (rinko_coefs0, _) = rinko_oxy_fit(good_data, f_suffix="_r0")
+    (rinko_coefs0, _) = rinko_oxy_fit(
+        good_data, f_suffix="_r0", weight_bins=weight_bins
+    )
     coefs_df.loc["r0"] = rinko_coefs0  # log for comparison
 
     # fit station groups, like T/C fitting (ssscc_r1, _r2, etc.)
@@ -200,55 +302,56 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
         ssscc_list = process_ctd.get_ssscc_list()
         ssscc_subsets = [Path(cfg.dirs["ssscc"] + "ssscc_r1.csv")]
         pd.Series(ssscc_list).to_csv(ssscc_subsets[0], header=None, index=False)
+    btl_index = process_ctd.get_cast_index(btl_df)
+    time_index = process_ctd.get_cast_index(time_df)
+    good_index = process_ctd.get_cast_index(good_data)
+    for df in (btl_df, time_df):
+        if "CTDRINKO" not in df.columns:
+            df["CTDRINKO"] = np.nan  # initialize column
     for f in ssscc_subsets:
         ssscc_sublist = pd.read_csv(f, header=None, dtype="str", comment='#').squeeze().to_list()
         f_stem = f.stem
+        group_rows = process_ctd.get_cast_rows(
+            good_index, ssscc_sublist, len(good_data)
+        )
         (rinko_coefs_group, _) = rinko_oxy_fit(
-            good_data.loc[good_data["SSSCC"].isin(ssscc_sublist)].copy(),
+            good_data.loc[group_rows].copy(),
             rinko_coef0=rinko_coefs0,
             f_suffix=f"_{f_stem}",
+            weight_bins=weight_bins,
         )
         coefs_df.loc[f_stem.split("_")[1]] = rinko_coefs_group  # log for comparison
 
         # deal with time dependent coefs by further fitting individual casts
         # NOTE (4/9/21): tried adding time drift term unsuccessfully
         # Uchida (2010) says fitting individual stations is the same (even preferred?)
-        for ssscc in ssscc_sublist:
-            (rinko_coefs_ssscc, _) = rinko_oxy_fit(
-                good_data.loc[good_data["SSSCC"] == ssscc].copy(),
-                rinko_coef0=rinko_coefs_group,
-                f_suffix=f"_{ssscc}",
-            )
-
+        # (casts within a group are independent, so can be fit concurrently)
+        cast_fits = parallel_map(
+            _rinko_fit_cast,
+            (good_data.iloc[good_index[ssscc]].copy() for ssscc in ssscc_sublist),
+            ssscc_sublist,
+            repeat(rinko_coefs_group),
+            repeat(weight_bins),
+            max_workers=max_workers,
+            processes=True,
+        )
+        for ssscc, (rinko_coefs_ssscc, _) in zip(ssscc_sublist, cast_fits):
             # check mean/stdev to see if new fit is better or worse
-            btl_rows = btl_df["SSSCC"] == ssscc
-            time_rows = time_df["SSSCC"] == ssscc
-            group_resid = (
-                _Uchida_DO_eq(
-                    rinko_coefs_group,
-                    (
-                        btl_df.loc[btl_rows, cfg.column["rinko_oxy"]],
-                        btl_df.loc[btl_rows, cfg.column["p"]],
-                        btl_df.loc[btl_rows, cfg.column["t1"]],
-                        btl_df.loc[btl_rows, cfg.column["sal"]],
-                        btl_df.loc[btl_rows, "OS"],
-                    ),
-                )
-                - btl_df.loc[btl_rows, "OXYGEN"]
-            )
-            ssscc_resid = (
-                _Uchida_DO_eq(
-                    rinko_coefs_ssscc,
-                    (
-                        btl_df.loc[btl_rows, cfg.column["rinko_oxy"]],
-                        btl_df.loc[btl_rows, cfg.column["p"]],
-                        btl_df.loc[btl_rows, cfg.column["t1"]],
-                        btl_df.loc[btl_rows, cfg.column["sal"]],
-                        btl_df.loc[btl_rows, "OS"],
-                    ),
-                )
-                - btl_df.loc[btl_rows, "OXYGEN"]
+            btl_rows = btl_index[ssscc]
+            time_rows = time_index[ssscc]
+            btl_data = btl_df.iloc[btl_rows]
+            time_data = time_df.iloc[time_rows]
+            btl_vars = (
+                btl_data[cfg.column["rinko_oxy"]],
+                btl_data[cfg.column["p"]],
+                btl_data[cfg.column["t1"]],
+                btl_data[cfg.column["sal"]],
+                btl_data["OS"],
             )
+            group_rinko = _Uchida_DO_eq(rinko_coefs_group, btl_vars)
+            btl_rinko = _Uchida_DO_eq(rinko_coefs_ssscc, btl_vars)
+            group_resid = group_rinko - btl_data["OXYGEN"]
+            ssscc_resid = btl_rinko - btl_data["OXYGEN"]
             worse_mean = np.abs(ssscc_resid.mean()) > np.abs(group_resid.mean())
             worse_stdev = ssscc_resid.std() > group_resid.std()
             if worse_mean and worse_stdev:
@@ -256,27 +359,24 @@ def calibrate_oxy(btl_df, time_df, ssscc_list):
                     f"{ssscc} fit parameters worse than {f_stem} group – reverting back"
                 )
                 rinko_coefs_ssscc = rinko_coefs_group
+                btl_rinko = group_rinko
 
             # apply coefficients
-            btl_df.loc[btl_rows, "CTDRINKO"] = _Uchida_DO_eq(
+            time_rinko = _Uchida_DO_eq(
                 rinko_coefs_ssscc,
                 (
-                    btl_df.loc[btl_rows, cfg.column["rinko_oxy"]],
-                    btl_df.loc[btl_rows, cfg.column["p"]],
-                    btl_df.loc[btl_rows, cfg.column["t1"]],
-                    btl_df.loc[btl_rows, cfg.column["sal"]],
-                    btl_df.loc[btl_rows, "OS"],
+                    time_data[cfg.column["rinko_oxy"]],
+                    time_data[cfg.column["p"]],
+                    time_data[cfg.column["t1"]],
+                    time_data[cfg.column["sal"]],
+                    time_data["OS"],
                 ),
             )
-            time_df.loc[time_rows, "CTDRINKO"] = _Uchida_DO_eq(
-                rinko_coefs_ssscc,
-                (
-                    time_df.loc[time_rows, cfg.column["rinko_oxy"]],
-                    time_df.loc[time_rows, cfg.column["p"]],
-                    time_df.loc[time_rows, cfg.column["t1"]],
-                    time_df.loc[time_rows, cfg.column["sal"]],
-                    time_df.loc[time_rows, "OS"],
-                ),
+            btl_df.iloc[btl_rows, btl_df.columns.get_loc("CTDRINKO")] = np.asarray(
+                btl_rinko
+            )
+            time_df.iloc[time_rows, time_df.columns.get_loc("CTDRINKO")] = np.asarray(
+                time_rinko
             )
 
             # save coefficients to dataframe
@@ -329,10 +429,14 @@ def rinko_oxy_fit(
         4.50828e-2,
     ),
     f_suffix=None,
+    weight_bins=None,
 ):
     """
     Iteratively fit Rinko DO data against bottle oxygen.
 
+    weight_bins sets the pressure-dependent fit weights (see
+    oxy_fitting.calculate_weights).
+
     Default coefficients come from an old cruise report:
     https://cchdo.ucsd.edu/data/2362/p09_49RY20100706do.txt
     (there's probably a better way – are there physical meanings?)
@@ -348,83 +452,45 @@ def rinko_oxy_fit(
     #     xlim=(-10, 10),
     # )
 
-    bad_df = pd.DataFrame()
-    weights = oxy_fitting.calculate_weights(btl_df["CTDPRS"])
-    fit_data = (
-        btl_df[cfg.column["rinko_oxy"]],
-        btl_df[cfg.column["p"]],
-        btl_df[cfg.column["t1"]],
-        btl_df[cfg.column["sal"]],
-        btl_df["OS"],
+    weights = oxy_fitting.calculate_weights(btl_df["CTDPRS"], weight_bins)
+    fit_data = tuple(
+        btl_df[col].to_numpy(dtype=float)
+        for col in (
+            cfg.column["rinko_oxy"],
+            cfg.column["p"],
+            cfg.column["t1"],
+            cfg.column["sal"],
+            "OS",
+        )
     )
-    # bounds need to be specified for all, can't just do cp...
-    coef_bounds = [
-        (None, None),  # c0,
-        (None, None),  # c1,
-        (None, None),  # c2,
-        (None, None),  # d0,
-        (None, None),  # d1,
-        (None, None),  # d2,
-        (0, 0.2),  # cp, pressure compensation
-    ]
-    res = scipy.optimize.minimize(
-        oxy_weighted_residual,
-        x0=rinko_coef0,
-        args=(weights, fit_data, btl_df[cfg.column["refO"]]),
-        bounds=coef_bounds,
+    cfw_coefs, keep, _ = robust_fit(
+        _Uchida_DO_eq,
+        rinko_coef0,
+        fit_data,
+        btl_df[cfg.column["refO"]],
+        jac=_Uchida_DO_jac,
+        weights=weights,
+        bounds=_Uchida_DO_bounds,
+        n_sigma=2.8,
     )
-
-    cfw_coefs = res.x
     btl_df["RINKO_OXY"] = _Uchida_DO_eq(cfw_coefs, fit_data)
     btl_df["residual"] = btl_df[cfg.column["refO"]] - btl_df["RINKO_OXY"]
 
-    cutoff = 2.8 * np.std(btl_df["residual"])
-    thrown_values = btl_df[np.abs(btl_df["residual"]) > cutoff]
-    bad_df = pd.concat([bad_df, thrown_values])
-    btl_df = btl_df[np.abs(btl_df["residual"]) <= cutoff].copy()
-
-    while not thrown_values.empty:
-
-        p0 = tuple(cfw_coefs)
-        weights = oxy_fitting.calculate_weights(btl_df["CTDPRS"])
-        fit_data = (
-            btl_df[cfg.column["rinko_oxy"]],
-            btl_df[cfg.column["p"]],
-            btl_df[cfg.column["t1"]],
-            btl_df[cfg.column["sal"]],
-            btl_df["OS"],
-        )
-        res = scipy.optimize.minimize(
-            oxy_weighted_residual,
-            x0=p0,
-            args=(weights, fit_data, btl_df[cfg.column["refO"]]),
-            bounds=coef_bounds,
-        )
-        cfw_coefs = res.x
-        btl_df["RINKO_OXY"] = _Uchida_DO_eq(cfw_coefs, fit_data)
-        btl_df["residual"] = btl_df[cfg.column["refO"]] - btl_df["RINKO_OXY"]
-        cutoff = 2.8 * np.std(btl_df["residual"])
-        thrown_values = btl_df[np.abs(btl_df["residual"]) > cutoff]
-        bad_df = pd.concat([bad_df, thrown_values])
-        btl_df = btl_df[np.abs(btl_df["residual"]) <= cutoff].copy()
-
     # intermediate plots to diagnose data chunks goodness
     if f_suffix is not None:
         f_out = f"{cfg.fig_dirs['rinko']}rinko_residual{f_suffix}.pdf"
         ctd_plots._intermediate_residual_plot(
-            btl_df["residual"],
-            btl_df["CTDPRS"],
-            btl_df["SSSCC"],
+            btl_df.loc[keep, "residual"],
+            btl_df.loc[keep, "CTDPRS"],
+            btl_df.loc[keep, "SSSCC"],
             xlabel="CTDRINKO Residual (umol/kg)",
             f_out=f_out,
             xlim=(-10, 10),
         )
 
-    btl_df["CTDRINKO_FLAG_W"] = 2
-    bad_df["CTDRINKO_FLAG_W"] = 3
-    df = pd.concat([btl_df, bad_df])
+    btl_df["CTDRINKO_FLAG_W"] = np.where(keep, 2, 3)
 
-    return cfw_coefs, df
+    return cfw_coefs, btl_df
 
     # from . import ctd_plots
     # diff = all_rinko_merged["REFOXY"] - all_rinko_merged["RINKO_OXY"]
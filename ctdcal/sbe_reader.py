@@ -6,9 +6,11 @@ and uses that to check and parse the hex file.
 """
 
 import datetime
+import json
 import re
 import struct
 import xml.etree.cElementTree as ET
+from pathlib import Path
 
 import numpy as np
 from pytz import timezone
@@ -601,6 +603,7 @@ class SBEReader:
                 sensors[int(x.attrib["index"])] = bulbasaur
         # sensors.append(pokedex)
         self.config["Sensors"] = sensors
+        self.sensor_coefs = _sensor_coefs(config)
 
     @classmethod
     def from_paths(cls, raw_hex_path, xml_config_path, encoding="cp437"):
@@ -668,3 +671,144 @@ class SBEReader:
         except KeyError:
             pass
         return instance
+
+
+# Calibration coefficient registry
+# --------------------------------
+# Parsed coefficients are memoized by (path, mtime, size) of the file they were read
+# from, so repeated lookups during fitting don't re-read .XMLCON files.
+_sensor_coefs_cache = {}
+
+
+def _file_key(path):
+    stat = Path(path).stat()
+    return str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size
+
+
+def _is_coefficient(tag):
+    """
+    Check if an XMLCON leaf is a calibration coefficient, rather than metadata
+    (serial numbers, calibration dates) or an equation switch (UseG_J etc.).
+    """
+    return not (tag.endswith(("SerialNumber", "Date")) or tag.startswith("Use"))
+
+
+def _xml_value(leaf):
+    """Coefficients are returned as floats, anything else as stripped text."""
+    text = (leaf.text or "").strip()
+    if not _is_coefficient(leaf.tag):
+        return text
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _collect_coefs(element, record):
+    for child in element:
+        if "equation" in child.attrib:
+            leaves = [leaf for leaf in child.iter() if not len(leaf)]
+            record["equations"][child.attrib["equation"]] = {
+                leaf.tag: _xml_value(leaf) for leaf in leaves
+            }
+        elif len(child):
+            _collect_coefs(child, record)
+        else:
+            record["values"][child.tag] = _xml_value(child)
+
+
+def _sensor_coefs(config):
+    """
+    Collect the calibration coefficients of each sensor in a parsed XMLCON.
+
+    Unlike SBEReader.config["Sensors"], coefficients belonging to different
+    equations (e.g. SBE43 Owens-Millard and Sea-Bird equations) are kept apart.
+    """
+    sensors = []
+    for sensor in config.iter("Sensor"):
+        for element in sensor:
+            record = {
+                "index": int(sensor.attrib["index"]),
+                "SensorID": sensor.attrib["SensorID"],
+                "type": element.tag,
+                "values": {},
+                "equations": {},
+            }
+            _collect_coefs(element, record)
+            sensors.append(record)
+
+    return sensors
+
+
+def save_sensor_coefs(sensors, xml_config_path, cache_file):
+    """
+    Register sensor calibration coefficients parsed from an .XMLCON file and save
+    them to a JSON file.
+
+    Parameters
+    ----------
+    sensors : list of dict
+        Sensor coefficients (e.g. SBEReader.sensor_coefs)
+    xml_config_path : path-like
+        .XMLCON file the coefficients were parsed from
+    cache_file : path-like
+        JSON file to write, typically next to the converted cast data
+    """
+    key = _file_key(xml_config_path)
+    _sensor_coefs_cache[key] = sensors
+    Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump(
+            {"xmlcon": key[0], "mtime_ns": key[1], "size": key[2], "sensors": sensors},
+            f,
+            indent=2,
+        )
+
+
+def read_sensor_coefs(xml_config_path, cache_file=None):
+    """
+    Get the calibration coefficients of every sensor in an .XMLCON file.
+
+    Coefficients are memoized per file. If cache_file is given, coefficients saved
+    there (see save_sensor_coefs) are used instead of parsing the .XMLCON as long as
+    they are up to date, or if the .XMLCON is no longer available; otherwise the
+    .XMLCON is parsed and cache_file is (re)written.
+
+    Parameters
+    ----------
+    xml_config_path : path-like
+        .XMLCON file
+    cache_file : path-like, optional
+        JSON file of previously saved coefficients
+
+    Returns
+    -------
+    sensors : list of dict
+        For each sensor: "index", "SensorID", "type" (e.g. "OxygenSensor"),
+        "values" (serial number, calibration date, coefficients) and "equations"
+        (coefficients for each numbered calibration equation)
+    """
+    raw_key = _file_key(xml_config_path) if Path(xml_config_path).exists() else None
+    if raw_key in _sensor_coefs_cache:
+        return _sensor_coefs_cache[raw_key]
+
+    if cache_file is not None and Path(cache_file).exists():
+        cache_key = _file_key(cache_file)
+        if raw_key is None and cache_key in _sensor_coefs_cache:
+            return _sensor_coefs_cache[cache_key]
+        with open(cache_file) as f:
+            saved = json.load(f)
+        if raw_key is None or [saved["mtime_ns"], saved["size"]] == list(raw_key[1:]):
+            _sensor_coefs_cache[raw_key or cache_key] = saved["sensors"]
+            return saved["sensors"]
+
+    if raw_key is None:
+        raise FileNotFoundError(f"Could not find {xml_config_path}")
+
+    sensors = _sensor_coefs(ET.parse(xml_config_path).getroot())
+    if cache_file is not None:
+        save_sensor_coefs(sensors, xml_config_path, cache_file)
+    else:
+        _sensor_coefs_cache[raw_key] = sensors
+
+    return sensors
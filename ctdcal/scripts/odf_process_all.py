@@ -86,8 +86,27 @@ def odf_process_all():
     oxy_fitting.prepare_oxy(btl_data_all, time_data_all, ssscc_list, user_cfg, 'oxygen')
 
     # calibrate oxygen against reference
-    oxy_fitting.calibrate_oxy(btl_data_all, time_data_all, ssscc_list)
-    rinko.calibrate_oxy(btl_data_all, time_data_all, ssscc_list)
+    max_workers = user_cfg.get("max_workers", 1)
+    weight_edges = user_cfg.get("oxy_weight_edges")
+    weights = user_cfg.get("oxy_weights")
+    if weight_edges is None or weights is None:
+        weight_bins = None  # fall back to oxy_fitting.WEIGHT_BINS
+    else:
+        weight_bins = (weight_edges, weights)
+    oxy_fitting.calibrate_oxy(
+        btl_data_all,
+        time_data_all,
+        ssscc_list,
+        max_workers=max_workers,
+        weight_bins=weight_bins,
+    )
+    rinko.calibrate_oxy(
+        btl_data_all,
+        time_data_all,
+        ssscc_list,
+        max_workers=max_workers,
+        weight_bins=weight_bins,
+    )
 
     #####
     # Step 3: export data
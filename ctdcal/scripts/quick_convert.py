@@ -2,16 +2,38 @@ import logging
 from pathlib import Path
 
 from ctdcal import flagging, get_ctdcal_config, io
+from ctdcal.common import parallel_map
 
 log = logging.getLogger(__name__)
 
 cfg = get_ctdcal_config()
 
 
-def cnv_to_ct1():
+def _cnv_file_to_ct1(cnv_file, sbe_to_woce):
+    """Convert one .cnv file to an uncalibrated Exchange CTD file."""
+    df = io.load_cnv(cnv_file, usecols=list(sbe_to_woce.keys()))
+    df = df.rename(mapper=sbe_to_woce, axis=1)
+    df = df[sbe_to_woce.values()]
+
+    # give everything WOCE-named uncalibrated flags
+    for idx, col in enumerate(df.columns):
+        flags = flagging.nan_values(df[col], flag_good=1, flag_nan=9)
+        df.insert(idx * 2 + 1, col + "_FLAG_W", flags)
+
+    # export to pressure folder
+    df.to_csv(f"{cfg.dirs['pressure']}{cnv_file.stem}_ct1.csv", na_rep="-999")
+
+
+def cnv_to_ct1(max_workers=None):
     """
     A script for converting Sea-Bird .cnv files to uncalibrated Exchange CTD files
     for plotting and QA/QC purposes (in ODV, etc.).
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of files to convert at once. Use 1 to convert files
+        sequentially.
     """
     cnv_files = list(Path(cfg.dirs["converted"]).glob("*.cnv"))
     log.info(f"Found {len(cnv_files)} .cnv files, attempting to convert")
@@ -30,17 +52,12 @@ def cnv_to_ct1():
         "flECO-AFL": "CTDFLUOR",
         "CStarTr0": "CTDXMISS",
     }
-    for f in cnv_files:
-        df = io.load_cnv(f).rename(mapper=sbe_to_woce, axis=1)
-        df = df[sbe_to_woce.values()]
-
-        # give everything WOCE-named uncalibrated flags
-        for idx, col in enumerate(df.columns):
-            flags = flagging.nan_values(df[col], flag_good=1, flag_nan=9)
-            df.insert(idx * 2 + 1, col + "_FLAG_W", flags)
-
-        # export to pressure folder
-        df.to_csv(f"{cfg.dirs['pressure']}{f.stem}_ct1.csv", na_rep="-999")
+    parallel_map(
+        _cnv_file_to_ct1,
+        cnv_files,
+        [sbe_to_woce] * len(cnv_files),
+        max_workers=max_workers,
+    )
 
 
 def cnv_to_hy1():
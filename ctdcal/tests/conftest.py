@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def synthetic_profile():
+    """
+    Make a synthetic profile of random pressures with an exponential temperature
+    profile, returning the seeded generator for drawing any other data.
+    """
+
+    def make(n=200, seed=0):
+        rng = np.random.default_rng(seed)
+        prs = rng.uniform(0, 5000, n)
+        tmp = 20 * np.exp(-prs / 800) + 1.5
+        return rng, prs, tmp
+
+    return make
+
+
+@pytest.fixture
+def assert_jac_close():
+    """Compare an analytic model Jacobian to central differences."""
+
+    def check(model, jac, coefs, inputs, rel_step=1e-6):
+        coefs = np.asarray(coefs, dtype=float)
+        analytic = jac(coefs, inputs)
+        assert analytic.shape == (len(inputs[0]), len(coefs))
+        for i, step in enumerate(np.abs(coefs) * rel_step):
+            dx = np.zeros(len(coefs))
+            dx[i] = step
+            numeric = (model(coefs + dx, inputs) - model(coefs - dx, inputs)) / (
+                2 * step
+            )
+            np.testing.assert_allclose(analytic[:, i], numeric, rtol=1e-5, atol=1e-5)
+
+    return check
@@ -4,7 +4,12 @@ from unittest.mock import patch
 import pytest
 import yaml
 
-from ctdcal.common import load_user_config, validate_dir, validate_file
+from ctdcal.common import (
+    load_user_config,
+    parallel_map,
+    validate_dir,
+    validate_file,
+)
 
 
 class TestUserConfig:
@@ -93,3 +98,15 @@ class TestPathValidation:
             validate_file(samename, create=False)
         with pytest.raises(FileExistsError):
             validate_file(samename, create=True)
+
+
+def _add(a, b):
+    return a + b
+
+
+@pytest.mark.parametrize("max_workers, processes", [(1, False), (2, False), (2, True)])
+def test_parallel_map(max_workers, processes):
+    result = parallel_map(
+        _add, range(10), range(10), max_workers=max_workers, processes=processes
+    )
+    assert result == [2 * n for n in range(10)]
@@ -333,4 +333,33 @@ def test_sbe_flntu_ntu(caplog):
     # error saying which keys are missing from coef dict
     with pytest.raises(KeyError, match="DarkVoltage"):
         eqs.sbe_flntu_ntu(volts, {"ScaleFactor":1, "dark_counts":1})
-        assert "dictionary missing keys" in caplog.records[-1].message
\ No newline at end of file
+        assert "dictionary missing keys" in caplog.records[-1].message
+
+
+def test_cell_therm_mass_corr():
+    rng = np.random.default_rng(0)
+    temp = 20 * np.exp(-np.linspace(0, 5, 1000)) + rng.normal(0, 0.01, 1000) + 2
+    cond = 30 + temp
+    temp[500] = np.nan
+
+    # explicit Lueck/SBE CellTM recursion
+    alpha, beta, sample_int = 0.03, 1 / 7, 1 / 24
+    a = 2 * alpha / (sample_int * beta + 2)
+    b = 1 - (2 * a / alpha)
+    CTM = np.zeros(1000)
+    for n in range(1, 1000):
+        forcing = a * 0.1 * (1 + 0.006 * (temp[n] - 20)) * (temp[n] - temp[n - 1])
+        CTM[n] = -b * CTM[n - 1] + (forcing if np.isfinite(forcing) else 0)
+
+    cond_corr = eqs.cell_therm_mass_corr(temp, cond)
+    np.testing.assert_allclose(cond_corr, cond + 10 * CTM, rtol=1e-12)
+
+    # chunked correction matches the whole cast
+    state = None
+    chunks = []
+    for sl in [slice(0, 333), slice(333, 500), slice(500, 501), slice(501, 1000)]:
+        corr, state = eqs.cell_therm_mass_corr(
+            temp[sl], cond[sl], state=state, return_state=True
+        )
+        chunks.append(corr)
+    np.testing.assert_allclose(np.concatenate(chunks), cond_corr, rtol=1e-12)
@@ -3,7 +3,7 @@ import pandas as pd
 import pytest
 import yaml
 
-from ctdcal import fit_ctd
+from ctdcal import fit_ctd, process_ctd
 
 
 @pytest.mark.parametrize("xN, yN", [(1, 0), (0, 1), (1, 1), (2, 1), (1, 2)])
@@ -56,6 +56,71 @@ def test_apply_polyfit():
     with pytest.raises(TypeError):
         fit_ctd.apply_polyfit(y, (0,), [y, (0,)])
 
+    # check higher orders match explicit powers (Series input, preallocated output)
+    rng = np.random.default_rng(0)
+    y, x = pd.Series(rng.uniform(0, 30, 50)), rng.uniform(0, 6000, 50)
+    y_coefs, x_coefs = (1e-3, 2e-4, -3e-6, 4e-8), (2e-7, -5e-11, 1e-15)
+    expected = y + sum(c * y ** n for n, c in enumerate(y_coefs))
+    expected += sum(c * x ** (n + 1) for n, c in enumerate(x_coefs))
+    out = np.empty(50)
+    fitted = fit_ctd.apply_polyfit(y, y_coefs, (x, x_coefs), out=out)
+    assert fitted is out
+    np.testing.assert_allclose(fitted, expected, rtol=1e-14)
+
+
+def test_batch_multivariate_fit():
+    rng = np.random.default_rng(0)
+    fit_vars = [("CTDPRS", "P_order", "cp"), ("CTDTMP", "T_order", "ct")]
+    fit_params = [{"P_order": 2, "T_order": 1}, {"P_order": 1, "T_order": 0}]
+    fit_frames = []
+    for n in [30, 20]:
+        df = pd.DataFrame(
+            {"CTDPRS": rng.uniform(0, 5000, n), "CTDTMP": rng.uniform(0, 20, n)}
+        )
+        df["Diff"] = 1e-3 + 2e-7 * df["CTDPRS"] + rng.normal(0, 1e-4, n)
+        fit_frames.append(df)
+
+    terms, coef_table, used = fit_ctd._batch_multivariate_fit(
+        fit_frames, fit_params, fit_vars
+    )
+    assert [name for _, _, name in terms] == ["cp2", "cp1", "ct1", "c0"]
+    assert used.tolist() == [[1, 1, 1, 1], [0, 1, 0, 1], [0, 0, 0, 0]]
+    np.testing.assert_array_equal(coef_table[-1], 0)
+
+    # each group matches its own fit
+    for df, params, coefs, group_used in zip(fit_frames, fit_params, coef_table, used):
+        expected = fit_ctd.multivariate_fit(
+            df["Diff"],
+            (df["CTDPRS"], params["P_order"]),
+            (df["CTDTMP"], params["T_order"]),
+        )
+        np.testing.assert_allclose(coefs[group_used], expected, rtol=1e-6)
+
+    # corrections applied by group, rows without a group are left as is
+    y = np.array([1.0, 2.0, 3.0, np.nan])
+    data = [np.array([100.0, 200.0, 300.0, 400.0]), np.array([5.0, np.nan, 5.0, 5.0])]
+    group_ids = np.array([0, 1, -1, 1])
+    fitted = fit_ctd._apply_batch_polyfit(y, data, terms, coef_table, used, group_ids)
+    cp2, cp1, ct1, c0 = coef_table[0]
+    assert fitted[0] == pytest.approx(1 + c0 + cp2 * 1e4 + cp1 * 100 + ct1 * 5)
+    _, cp1, _, c0 = coef_table[1]
+    assert fitted[1] == pytest.approx(2 + c0 + cp1 * 200)  # unused NaN term ignored
+    assert fitted[2] == 3
+    assert np.isnan(fitted[3])
+
+
+def test_group_ids():
+    df = pd.DataFrame({"SSSCC": ["00101"] * 2 + ["00201"] * 3 + ["00301"]})
+    cast_index = process_ctd.get_cast_index(df)
+    groups = [("ssscc_t1", ["00201"]), ("ssscc_t2", ["00101", "00401"])]
+    group_ids = fit_ctd._group_ids(cast_index, groups, len(df))
+    assert group_ids.tolist() == [1, 1, 0, 0, 0, -1]
+
+    # casts can only be fit in one group
+    with pytest.raises(ValueError, match="00201"):
+        fit_ctd._group_ids(cast_index, groups + [("ssscc_t3", ["00201"])], len(df))
+
+
 def test_generate_yaml(tmp_path):
     fname = str(tmp_path) + "filename.yaml"
     fit_ctd.generate_yaml("filename.yaml", str(tmp_path))
@@ -64,3 +129,76 @@ def test_generate_yaml(tmp_path):
 
     assert generated_data['t2']['ssscc_t1']['T_order'] == 0
     assert generated_data['c1']['ssscc_c1']['zRange'] == '1000:6000'
+
+
+@pytest.fixture
+def btl_data(synthetic_profile):
+    n_casts = 10
+    rng, prs, tmp = synthetic_profile(n=24 * n_casts)
+    return pd.DataFrame(
+        {
+            "SSSCC": np.repeat([f"{i:03d}01" for i in range(1, n_casts + 1)], 24),
+            "CTDPRS": prs,
+            "CTDTMP1": tmp + 2e-3 - 4e-7 * prs + rng.normal(0, 2e-4, len(prs)),
+            "CTDTMP2": tmp - 1e-3 + rng.normal(0, 2e-4, len(prs)),
+            "REFTMP": tmp,
+            "REFTMP_FLAG_W": 2,
+        }
+    )
+
+
+def test_score_fit_orders(btl_data):
+    df = btl_data
+    fit_vars = [("CTDPRS", "P_order", "cp"), ("CTDTMP1", "T_order", "ct")]
+    zRanges = ["500:6000", "1000:6000"]
+    scores = fit_ctd._score_fit_orders(df, "CTDTMP1", "REFTMP", fit_vars, zRanges)
+    assert len(scores) == 2 * 3 * 3
+    assert scores.columns.tolist() == [
+        "zRange",
+        "P_order",
+        "T_order",
+        "n_fit",
+        "cv_rmse",
+    ]
+
+    # matches refitting each fold from scratch
+    folds = np.random.default_rng(0).permutation(len(df)) % 5
+    df_fit, _ = fit_ctd._prepare_fit_data(df, "CTDTMP1", "REFTMP", zRange="500:6000")
+    df_eval, _ = fit_ctd._prepare_fit_data(df, "CTDTMP1", "REFTMP", zRange="1000:6000")
+    sq_resid = 0
+    for k in range(5):
+        train = df_fit[folds[df_fit.index] != k]
+        test = df_eval[folds[df_eval.index] == k]
+        coefs = fit_ctd.multivariate_fit(
+            train["Diff"], (train["CTDPRS"], 1), (train["CTDTMP1"], 0)
+        )
+        sq_resid += np.sum((test["Diff"] - coefs[0] * test["CTDPRS"] - coefs[1]) ** 2)
+    candidate = scores.query("zRange == '500:6000' and P_order == 1 and T_order == 0")
+    np.testing.assert_allclose(candidate["cv_rmse"], np.sqrt(sq_resid / len(df_eval)))
+
+    with pytest.raises(ValueError, match="overlap"):
+        fit_ctd._common_zrange(["0:500", "1000:6000"])
+
+
+def test_write_fit_yaml(btl_data, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fname = tmp_path / "fit_coefs.yaml"
+    fname.write_text(yaml.dump({"c1": {"ssscc_c1": {"P_order": 1}}}))
+    monkeypatch.setitem(fit_ctd.cfg.dirs, "logs", f"{tmp_path}/")
+
+    fit_yaml = fit_ctd.write_fit_yaml(btl_data, max_workers=1, fname=fname)
+    with open(fname, "r") as f:
+        assert yaml.safe_load(f) == fit_yaml
+
+    # offset + linear pressure term for t1, offset only for t2
+    assert fit_yaml["t1"]["ssscc_t1"]["P_order"] == 1
+    assert fit_yaml["t1"]["ssscc_t1"]["T_order"] == 0
+    assert fit_yaml["t2"]["ssscc_t1"]["P_order"] == 0
+    assert fit_yaml["t2"]["ssscc_t1"]["T_order"] == 0
+
+    # no conductivity reference, existing entries are kept
+    assert fit_yaml["c1"] == {"ssscc_c1": {"P_order": 1}}
+
+    scores = pd.read_csv(tmp_path / "fit_order_scores.csv")
+    assert scores["selected"].sum() == 2
+    assert set(scores["sensor"]) == {"t1", "t2"}
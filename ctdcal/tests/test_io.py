@@ -1,4 +1,5 @@
 import logging
+import os
 from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 from zipimport import ZipImportError
 
@@ -49,6 +50,21 @@ def test_load_cnv(tmp_path):
     assert check_type(cnv, float)
     assert cnv.columns.tolist() == ["prDM", "depSM", "t090C"]
 
+    # check column projection, dtype, and bad_flag values
+    content[-1] = "     10.000 -9.990e-29     8.9126\n"
+    with open(tmp_path / "test_2.cnv", "w+") as f:
+        f.writelines(content)
+    cnv = io.load_cnv(tmp_path / "test_2.cnv", usecols=["prDM", "depSM"], dtype="f4")
+    assert cnv.columns.tolist() == ["prDM", "depSM"]
+    assert all(cnv.dtypes == np.float32)
+    assert cnv["depSM"].isna().tolist() == [False, False, False, True]
+
+    # check error if header is never closed
+    with open(tmp_path / "test_3.cnv", "w+") as f:
+        f.writelines(content[:4])
+    with pytest.raises(ValueError, match="END"):
+        io.load_cnv(tmp_path / "test_3.cnv")
+
 
 def test_load_exchange_btl(caplog, tmp_path, monkeypatch):
     # make fake/empty Exchange file
@@ -205,3 +221,128 @@ def test_load_exchange_ctd(caplog, tmp_path, monkeypatch):
     # check error on recursive .zip
     with pytest.raises(ZipImportError, match="Recursive .zip files"):
         io.load_exchange_ctd(tmp_path / "level0.zip")
+
+
+def test_load_exchange_ctd_cruise(tmp_path):
+    def ct1(stn, n_rows):
+        rows = "".join(f"{2.0 * n},{stn + n / 10:.4f},2\n" for n in range(n_rows))
+        return (
+            "CTD,20210101ODFSIO\nNUMBER_HEADERS = 3\nEXPOCODE = 012345678910\n"
+            f"STNNBR = {stn}\nCASTNO = 1\nCTDPRS,CTDTMP,CTDTMP_FLAG_W\nDBAR,ITS-90,\n"
+            f"{rows}END_DATA\n"
+        )
+
+    zname = tmp_path / "test_ctd.zip"
+    with ZipFile(zname, "w") as zf:
+        for stn in [1, 2, 3]:
+            zf.writestr(f"CTD_{stn}_ct1.csv", ct1(stn, stn + 1))
+
+    # lazily loaded files match loading all at once
+    headers, dfs = io.load_exchange_ctd(zname)
+    casts = list(io.iter_exchange_ctd(zname))
+    assert [header for header, _ in casts] == list(headers)
+    assert all(df.equals(ct1_df) for (_, df), ct1_df in zip(casts, dfs))
+    assert len(list(io.iter_exchange_ctd(zname, n_files=2))) == 2
+
+    # single cruise DataFrame, streamed or parsed in parallel
+    for max_workers in [1, 2]:
+        header, df = io.load_exchange_ctd_cruise(zname, max_workers=max_workers)
+        assert header["SSSCC"].tolist() == ["00101", "00201", "00301"]
+        assert header["EXPOCODE"].eq("012345678910").all()
+        assert df.shape == (9, 4)
+        n_rows = df["SSSCC"].value_counts().to_dict()
+        assert n_rows == {"00101": 2, "00201": 3, "00301": 4}
+        assert df.loc[df["SSSCC"] == "00301", "CTDTMP"].tolist() == [3, 3.1, 3.2, 3.3]
+        assert check_type(df[["CTDTMP_FLAG_W"]], int)
+
+
+@pytest.fixture
+def http_server():
+    """Local stand-in for a file server, with ETag support."""
+    import hashlib
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    files, requests_seen = {}, []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.path)
+            if self.path not in files:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = files[self.path]
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield url, files, requests_seen, server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_cache(tmp_path, http_server, caplog):
+    url, files, requests_seen, server = http_server
+    hy1 = (
+        "BOTTLE,20210101ODFSIO\nEXPOCODE,STNNBR,CASTNO,SAMPNO,CTDPRS\n,,,,DBAR\n"
+        "1234,1,1,2,10.5\n1234,1,1,1,502.0\nEND_DATA\n"
+    )
+    files["/btl_hy1.csv"] = hy1.encode("utf8")
+    cache = io.HTTPCache(tmp_path / "cache")
+
+    # first load downloads, second is revalidated without downloading
+    btl = io.load_exchange_btl(f"{url}/btl_hy1.csv", cache=cache)
+    assert btl["CTDPRS"].tolist() == [10.5, 502.0]
+    with caplog.at_level(logging.INFO):
+        again = io.load_exchange_btl(f"{url}/btl_hy1.csv", cache=cache)
+    assert again.equals(btl)
+    assert "not modified" in caplog.text
+    assert len(requests_seen) == 2
+
+    # changed files are downloaded again
+    files["/btl_hy1.csv"] = hy1.replace("502.0", "503.0").encode("utf8")
+    btl = io.load_exchange_btl(f"{url}/btl_hy1.csv", cache=cache)
+    assert btl["CTDPRS"].tolist() == [10.5, 503.0]
+
+    # offline mode only uses the cache
+    offline = io.HTTPCache(tmp_path / "cache", offline=True)
+    assert offline.get(f"{url}/btl_hy1.csv") == files["/btl_hy1.csv"]
+    with pytest.raises(FileNotFoundError, match="offline"):
+        offline.get(f"{url}/other_hy1.csv")
+    assert len(requests_seen) == 3
+
+    # least recently used files are evicted
+    cache = io.HTTPCache(tmp_path / "lru", max_bytes=250)
+    for name in "abc":
+        files[f"/{name}"] = name.encode("utf8") * 100
+    cache.get(f"{url}/a")
+    cache.get(f"{url}/b")
+    os.utime(cache._paths(f"{url}/b")[0], (0, 0))  # b used long ago
+    cache.get(f"{url}/c")
+    cached = {f.name for f in (tmp_path / "lru").iterdir()}
+    for name, kept in [("a", True), ("b", False), ("c", True)]:
+        body, meta = cache._paths(f"{url}/{name}")
+        assert (body.name in cached) is kept
+        assert (meta.name in cached) is kept
+
+    # cached copy is used if the server can't be reached
+    server.shutdown()
+    server.server_close()
+    assert cache.get(f"{url}/c") == files["/c"]
+    with pytest.raises(requests.ConnectionError):
+        cache.get(f"{url}/b")
@@ -259,3 +259,35 @@ def test_process_salts(tmp_path, caplog):
 
         # Check if the actual output matches the expected output
         assert actual_output == expected_output
+
+
+def test_process_salts_batch(tmp_path):
+    from munch import Munch
+
+    for stn in [1, 2, 3]:
+        make_salt_file(
+            stn=stn, cast=1, flag=(stn != 2), to_file=tmp_path / f"{stn:03d}01"
+        )
+    flag_file = tmp_path / "flag" / "flags.json"
+    flag_file.parent.mkdir()
+    flag_file.write_text("{}")
+    user_cfg = Munch(datadir=str(tmp_path), bottleflags_man="flags.json")
+
+    ssscc_list = ["00101", "00201", "00301"]
+    odf_io.process_salts(ssscc_list, user_cfg, salt_dir=str(tmp_path), max_workers=3)
+
+    # each cast matches processing its file on its own
+    for ssscc in ssscc_list:
+        saltDF, refDF, _ = odf_io._salt_loader(tmp_path / ssscc)
+        saltDF = odf_io.remove_autosal_drift(saltDF, refDF)
+        saltDF["SALNTY"] = odf_io.gsw.SP_salinometer(
+            saltDF["CRavg"] / 2.0, saltDF["BathTEMP"]
+        )
+        batch = pd.read_csv(tmp_path / f"{ssscc}_salts.csv")
+        np.testing.assert_allclose(batch["SALNTY"], saltDF["SALNTY"])
+        np.testing.assert_array_equal(batch["CRavg"], saltDF["CRavg"])
+
+    # questionable samples from both flagged files saved together
+    salt_flags = pd.DataFrame.from_dict(odf_io.get_node(flag_file, "salt"))
+    assert set(salt_flags["cast_id"]) == {"00101", "00301"}
+    assert (salt_flags["value"] == 3).all()
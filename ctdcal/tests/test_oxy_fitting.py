@@ -2,6 +2,7 @@ import logging
 from pathlib import Path
 
 import numpy as np
+import pytest
 import scipy
 
 from ctdcal import oxy_fitting
@@ -39,4 +40,123 @@ def test_calculate_weights():
 
     wgt = oxy_fitting.calculate_weights(pressure)
 
-    assert np.array_equal(wgt, wgt_manual)
\ No newline at end of file
+    assert np.array_equal(wgt, wgt_manual)
+
+
+@pytest.fixture
+def sbe43_data(synthetic_profile):
+    rng, pressure, temp = synthetic_profile()
+    inputs = (
+        rng.uniform(1, 3, 200),  # oxyvolts
+        pressure,
+        temp,
+        rng.normal(0, 0.01, 200),  # dv_dt
+        rng.uniform(250, 350, 200),  # OS
+    )
+    coefs = np.array([0.45, -0.5, 1.2, 0.0017, 0.036])
+    refoxy = oxy_fitting._PMEL_oxy_eq(coefs, inputs) + rng.normal(0, 0.5, 200)
+    return coefs, inputs, refoxy
+
+
+def test_PMEL_oxy_jac(sbe43_data, assert_jac_close):
+    coefs, inputs, _ = sbe43_data
+    assert_jac_close(
+        oxy_fitting._PMEL_oxy_eq,
+        oxy_fitting._PMEL_oxy_jac,
+        coefs,
+        inputs,
+        rel_step=1e-7,
+    )
+
+
+def test_PMEL_oxy_fit(sbe43_data):
+    coefs, inputs, refoxy = sbe43_data
+    weights = oxy_fitting.calculate_weights(inputs[1])
+    coefs0 = [0.5, -0.48, 1.0, 0.0015, 0.035]
+    fit = oxy_fitting._PMEL_oxy_fit(coefs0, weights, inputs, refoxy)
+
+    # minimizes the weighted residual at least as well as the generic optimizer
+    bounds = [(None, None), (None, None), (0, None), (None, None), (None, None)]
+    res = scipy.optimize.minimize(
+        oxy_fitting.PMEL_oxy_weighted_residual,
+        x0=coefs0,
+        args=(weights, inputs, refoxy),
+        bounds=bounds,
+    )
+    resid = oxy_fitting.PMEL_oxy_weighted_residual(fit, weights, inputs, refoxy)
+    assert resid <= res.fun * (1 + 1e-6)
+    np.testing.assert_allclose(fit, res.x, rtol=1e-3)
+
+    # Tau20 stays non-negative
+    fit = oxy_fitting._PMEL_oxy_fit(coefs0, weights, inputs, refoxy - 50 * inputs[3])
+    assert fit[2] >= 0
+
+
+def test_match_sigmas():
+    # monotonic downcast profile, bottles sampled from the same profile
+    prs = np.linspace(0, 5500, 5000)
+    tmp = 20 * np.exp(-prs / 800) + 1.5
+    SA = 34.5 + 0.3 * np.exp(-prs / 500)
+    oxyvolts = 2 + 0.3 * np.sin(prs / 300)
+    btl_prs = np.array([5.0, 250, 499, 500, 1200, 2600, 4100, 5450])
+    btl_tmp = np.interp(btl_prs, prs, tmp)
+    btl_SA = np.interp(btl_prs, prs, SA)
+    coefs = [0.45, -0.5, 1.2, 0.0017, 0.036]
+
+    df = oxy_fitting.match_sigmas(
+        btl_prs,
+        np.full(btl_prs.size, 200.0),
+        btl_tmp,
+        btl_SA,
+        np.arange(10, 18),
+        300 - prs / 100,
+        prs,
+        tmp,
+        SA,
+        oxyvolts,
+        np.arange(prs.size) / 24,
+        sbe_coef0=coefs,
+    )
+    assert df.index.tolist() == list(range(10, 18))
+    assert df.columns.tolist() == [
+        "CTDPRS", "CTDOXYVOLTS", "CTDTMP", "dv_dt", "OS", "REFOXY", "CTDOXY"
+    ]
+
+    # bottles exactly on a reference window edge are not matched
+    assert df.loc[13].drop("REFOXY").isna().all()
+
+    matched = df.drop(13)
+    np.testing.assert_allclose(matched["CTDPRS"], np.delete(btl_prs, 3), atol=1e-3)
+    np.testing.assert_allclose(
+        matched["CTDOXYVOLTS"],
+        np.interp(np.delete(btl_prs, 3), prs, oxyvolts),
+        atol=1e-6,
+    )
+
+
+def test_get_sbe_coef(tmp_path, monkeypatch):
+    from ctdcal import sbe_reader
+    from ctdcal.tests.test_sbe_reader import XMLCON
+
+    monkeypatch.chdir(tmp_path)
+    Path("data/raw").mkdir(parents=True)
+    Path("data/ssscc.csv").write_text("00101\n")
+    Path("data/raw/00101.XMLCON").write_text(XMLCON)
+    sbe_reader._sensor_coefs_cache.clear()
+
+    # Soc, offset, Tau20, E from SBE equation, Tcor from Owens-Millard equation
+    assert oxy_fitting._get_sbe_coef() == (0.45, -0.5, 1.2, 0.0017, 0.036)
+    assert Path("data/converted/00101_coefs.json").exists()
+
+
+def test_calculate_weights_bins():
+    pressure = np.array([-1, 0, 100, 100.5, 7500, np.nan])
+    wgt = oxy_fitting.calculate_weights(pressure)
+    np.testing.assert_array_equal(wgt, [20, 20, 20, 25, 500, np.nan])
+
+    # custom bins
+    wgt = oxy_fitting.calculate_weights(pressure, ([50, 1000], [1, 2, 3]))
+    np.testing.assert_array_equal(wgt, [1, 1, 2, 2, 3, np.nan])
+
+    with pytest.raises(ValueError):
+        oxy_fitting.calculate_weights(pressure, ([50, 1000], [1, 2]))
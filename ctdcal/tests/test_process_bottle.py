@@ -1,3 +1,6 @@
+import logging
+
+import numpy as np
 import pandas as pd
 import pytest
 
@@ -54,6 +57,12 @@ END_DATA
     #   Value check
     assert df["BTLNBR"].iloc[-1] == 34
 
+    #   Columns are typed on load, units kept as metadata
+    assert df["DEPTH"].dtype == np.int64
+    assert df["CTDPRS"].tolist() == [3.5, 4.4, 2.8]
+    assert df.attrs["units"]["CTDPRS"] == "DBAR"
+    assert df.attrs["units"]["EXPOCODE"] == ""
+
 
 def test_load_btl_data(tmp_path):
     fname = tmp_path / "90909_btl_mean.pkl"
@@ -165,8 +174,190 @@ def test_merge_hy1(df1, df2):
     assert merged_df["CASTNO"].is_monotonic_increasing
     #   Sample number can be anything in this case
 
+    #   Test merging several files, already in order or not
+    df3 = df2.assign(STNNBR=[105, 105], SAMPNO=[2, 1])
+    stations = [100, 101, 102, 103, 104, 105, 105]
+    merged_df = process_bottle.merge_hy1(df3, df1, df2)
+    assert merged_df["STNNBR"].tolist() == stations
+    assert process_bottle._is_hy1_sorted(merged_df)
+    df1_sorted = df1.sort_values("STNNBR", ignore_index=True)
+    merged_df = process_bottle.merge_hy1(df1_sorted, df2, df3)
+    pd.testing.assert_frame_equal(
+        merged_df, pd.concat([df1_sorted, df2, df3], ignore_index=True)
+    )
+    assert not process_bottle._is_hy1_sorted(df3.iloc[::-1])
+
     #   Test handling NaNs
     df1.loc[0, "STNNBR"] = None
     merged_df = process_bottle.merge_hy1(df1, df2)
     assert merged_df["STNNBR"].isna().sum() == 1
     assert merged_df["SAMPNO"].notna().all()  #   No NaNs introduced
+
+
+def test_bottle_stats():
+    btl_df = pd.DataFrame(
+        {
+            "CTDPRS": [10.0, 11.0, 12.0, 100.0, 101.0, 300.0, 301.0, 302.0, 1000.0],
+            "CTDTMP": [5.0, np.nan, 7.0, 3.0, 4.0, 2.0, 2.0, 2.0, 1.0],
+            "btl_fire_num": [1, 1, 1, 2, 2, 4, 4, 4, 4],
+        }
+    )
+    mean = process_bottle.bottle_mean(btl_df)
+    assert mean.index.tolist() == [1, 2, 3, 4]
+    assert mean["CTDPRS"].tolist()[:2] == [11.0, 100.5]
+    assert mean.loc[1, "CTDTMP"] == 6.0  # NaN skipped
+    assert mean.loc[3].isna().all()  # missing bottle
+    expected = btl_df.groupby("btl_fire_num").mean().rename_axis(None)
+    pd.testing.assert_frame_equal(
+        mean.drop(index=3, columns="btl_fire_num"), expected, check_index_type=False
+    )
+
+    median = process_bottle.bottle_median(btl_df)
+    assert median.loc[4, "CTDPRS"] == 301.5
+
+    # trimmed mean and variability statistics
+    stats = process_bottle.bottle_stats(
+        btl_df, how="trim_mean", proportiontocut=0.25, std=["CTDPRS"], count=True
+    )
+    assert stats.loc[4, "CTDPRS"] == 301.5
+    assert stats.loc[1, "CTDPRS"] == 11.0
+    assert stats.loc[2, "CTDPRS_STD"] == pytest.approx(np.std([100, 101], ddof=1))
+    assert stats["n_scans"].tolist()[:2] == [3, 2]
+    assert "CTDTMP_STD" not in stats.columns
+
+    # scans out of order
+    shuffled = btl_df.sample(frac=1, random_state=0)
+    pd.testing.assert_frame_equal(process_bottle.bottle_mean(shuffled), mean)
+
+    with pytest.raises(ValueError):
+        process_bottle.bottle_stats(btl_df, how="mode")
+
+
+def test_extract_bottle_stats():
+    rng = np.random.default_rng(0)
+    fire = np.zeros(100, dtype=bool)
+    fire[[*range(10, 20), *range(40, 45), 99]] = True
+    converted_df = pd.DataFrame(
+        {"CTDPRS": rng.uniform(0, 100, 100), "GPSLAT": 10.0, "btl_fire": fire}
+    )
+    original = converted_df.copy()
+
+    btl_df = process_bottle.retrieveBottleData(converted_df)
+    pd.testing.assert_frame_equal(converted_df, original)  # input is left as is
+    assert btl_df["btl_fire_num"].unique().tolist() == [1, 2, 3]
+
+    for how in ["mean", "median", "trim_mean"]:
+        pd.testing.assert_frame_equal(
+            process_bottle.extract_bottle_stats(converted_df, how=how, count=True),
+            process_bottle.bottle_stats(btl_df, how=how, count=True),
+        )
+    assert process_bottle.extract_bottle_stats(original.drop(columns="btl_fire")).empty
+
+
+def test_load_all_btl_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for sub_dir in ["bottle", "reft", "salt", "oxygen", "logs"]:
+        (tmp_path / "data" / sub_dir).mkdir(parents=True)
+    pd.DataFrame(
+        {
+            "SSSCC": ["00101", "00201"],
+            "bottom_time": [1e9, 1e9 + 3600],
+            "latitude": [10.0, 11.0],
+            "longitude": [-20.0, -21.0],
+        }
+    ).to_csv("data/logs/bottom_bottle_details.csv", index=False)
+    for ssscc in ["00101", "00201"]:
+        pd.DataFrame(
+            {"CTDPRS": [3000.0, 2000.0, 1000.0], "btl_fire_num": [1.0, 2.0, 3.0]},
+            index=[1, 2, 3],
+        ).to_pickle(f"data/bottle/{ssscc}_btl_mean.pkl")
+    # reference temperatures missing bottle 2, extra salt sample 4
+    pd.DataFrame(
+        {"btl_fire_num": [1, 3], "T90": [2.0, 4.0], "REFTMP_FLAG_W": [2, 2]}
+    ).to_csv("data/reft/00101_reft.csv", index=False)
+    pd.DataFrame(
+        {"SAMPNO": [1, 2, 4], "SALNTY": 35.0, "BathTEMP": 24, "CRavg": 1.95}
+    ).to_csv("data/salt/00101_salts.csv", index=False)
+
+    df = process_bottle.load_all_btl_files(["00101", "00201"], max_workers=2)
+    assert len(df) == 4 + 3
+    assert df["master_index"].tolist() == list(range(7))
+
+    # bottles from any file are kept, in order
+    cast = df.iloc[:4]
+    np.testing.assert_array_equal(cast["btl_fire_num"], [1, 2, 3, np.nan])
+    np.testing.assert_array_equal(cast["SAMPNO_SALT"], [1, 2, np.nan, 4])
+    np.testing.assert_array_equal(cast["REFTMP"], [2.0, np.nan, 4.0, np.nan])
+    assert (df["DATE"] == "20010909").all()
+    assert df.loc[df["SSSCC"] == "00201", "LATITUDE"].eq(11.0).all()
+
+
+def test_export_hy1(tmp_path, monkeypatch):
+    monkeypatch.setitem(process_bottle.cfg.dirs, "logs", f"{tmp_path}/")
+    pd.DataFrame({"SSSCC": ["00101", "00201"], "DEPTH": [4000.7, -999]}).to_csv(
+        tmp_path / "depth_log.csv", index=False
+    )
+    pd.DataFrame({"SSSCC": ["00201", "00101"], "DEPTH": [2500, 1]}).to_csv(
+        tmp_path / "manual_depth_log.csv", index=False
+    )
+    df = pd.DataFrame(
+        {
+            "SSSCC": ["00101", "00101", "00201", "00301"],
+            "btl_fire_num": [1.0, 2.0, 1.0, 1.0],
+            "CTDPRS": [1000.04, 10.0, 5.0, 5.0],
+            "CTDTMP1": [2.0, 10.0, 15.0, 15.0],
+            "SALNTY": [34.91234, np.nan, 35.0, 35.0],
+            "CTDRINKO": 200.0,
+            "CTDRINKO_FLAG_W": 2,
+            "REFTMP_FLAG_W": [2, 2, np.nan, 2],
+        }
+    )
+    process_bottle.export_hy1(
+        df, out_dir=f"{tmp_path}/", org=["ODF", "PMEL"], precision={"CTDPRS": 1}
+    )
+    expocode = process_bottle.cfg.expocode
+    odf = (tmp_path / f"{expocode}_ODF_hy1.csv").read_text().splitlines()
+    pmel = (tmp_path / f"{expocode}_PMEL_hy1.csv").read_text().splitlines()
+    assert odf[0].endswith("ODF") and pmel[0].endswith("PMEL")
+    assert odf[1:] == pmel[1:]
+    assert odf[-2:] == ["", "END_DATA"]
+
+    hy1 = pd.read_csv(tmp_path / f"{expocode}_ODF_hy1.csv", skiprows=[0, 2])
+    hy1 = hy1.iloc[:-1]
+    assert hy1["SAMPNO"].tolist() == [2, 1, 1, 1]  # deepest bottle last
+    assert hy1["DEPTH"].tolist() == [4000, 4000, 2500, -999]
+    assert hy1["CTDPRS"].tolist() == [10.0, 1000.0, 5.0, 5.0]
+    assert hy1["SALNTY"].tolist() == [-999, 34.91234, 35.0, 35.0]
+    assert hy1["REFTMP_FLAG_W"].tolist() == [2, 2, 9, 2]
+    assert (hy1["OXYGEN_FLAG_W"] == 9).all()
+
+
+def test_process_reft(tmp_path, caplog):
+    lines = ["*SBE35 V 2.0a SERIAL NO. 0011", ""]
+    for n, diff in enumerate([-12, 4000, 25], start=1):
+        lines.append(
+            f"{n:>4} 27 Feb 2019 13:0{n}:34 bn = {n:>2} diff = {diff:>5} "
+            f"val = 275218.{n} t90 = {21.6553 - n:>8.4f}"
+        )
+    (tmp_path / "CAP00101.cap").write_text("\r\n".join(lines) + "\r\n")
+
+    reft_dir = f"{tmp_path}/"
+    with caplog.at_level(logging.INFO):
+        reftDF = process_bottle._reft_loader("00101", reft_dir)
+    assert reftDF.columns.tolist() == [
+        "index_memory", "datetime", "btl_fire_num", "diff", "raw_value", "T90",
+        "REFTMP_FLAG_W", "STNNBR", "CASTNO",
+    ]
+    assert reftDF["datetime"].iloc[0] == pd.Timestamp("2019-02-27 13:01:34")
+    assert reftDF["diff"].tolist() == [-12, 4000, 25]
+    assert reftDF["T90"].tolist() == [20.6553, 19.6553, 18.6553]
+    assert reftDF["REFTMP_FLAG_W"].tolist() == [2, 3, 2]
+    assert "Measurement 2 flagged" in caplog.text
+
+    process_bottle.process_reft(["00101", "00201"], reft_dir, max_workers=2)
+    pd.testing.assert_frame_equal(
+        pd.read_csv(tmp_path / "00101_reft.csv", parse_dates=["datetime"]),
+        reftDF.astype({"STNNBR": int, "CASTNO": int}),
+    )
+    assert not (tmp_path / "00201_reft.csv").exists()
+    assert "refT file for cast 00201 does not exist" in caplog.text
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ctdcal import process_ctd
+
+
+@pytest.fixture
+def time_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    time_dir = tmp_path / "data" / "time"
+    time_dir.mkdir(parents=True)
+    ssscc_list = ["00101", "00201", "00301"]
+    for n, ssscc in enumerate(ssscc_list):
+        df = pd.DataFrame(
+            {
+                "CTDPRS": np.linspace(0, 100, 10 + n),
+                "CTDOXYVOLTS": np.linspace(2, 3, 10 + n),
+                "scan_datetime": np.arange(10 + n) / 24,
+                "pump_on": True,
+            }
+        )
+        if n == 1:
+            df["EXTRA"] = 1.0
+            df["COUNT"] = np.arange(11)
+            df["TIMESTAMP"] = pd.date_range("2021-01-01", periods=11, freq="s")
+        df.to_pickle(time_dir / f"{ssscc}_time.pkl")
+    return ssscc_list
+
+
+def test_load_all_ctd_files(time_files):
+    df = process_ctd.load_all_ctd_files(time_files)
+    assert len(df) == 10 + 11 + 12
+    assert isinstance(df["SSSCC"].dtype, pd.CategoricalDtype)
+    assert df["SSSCC"].cat.categories.tolist() == time_files
+    assert (df["SSSCC"] == "00201").sum() == 11
+    assert df["pump_on"].dtype == bool
+    assert df["master_index"].tolist() == list(range(len(df)))
+    assert "dv_dt" in df.columns
+
+    # columns missing from some casts are filled with NaN
+    assert df.loc[df["SSSCC"] == "00201", "EXTRA"].eq(1).all()
+    assert df.loc[df["SSSCC"] != "00201", "EXTRA"].isna().all()
+    assert df["COUNT"].dtype == float
+    assert df.loc[df["SSSCC"] == "00201", "COUNT"].tolist() == list(range(11))
+    assert df["TIMESTAMP"].dtype == "datetime64[ns]"
+    assert df.loc[df["SSSCC"] == "00201", "TIMESTAMP"].notna().all()
+    assert df.loc[df["SSSCC"] != "00201", "TIMESTAMP"].isna().all()
+
+    # match the per-cast data
+    cast = pd.read_pickle("data/time/00301_time.pkl")
+    np.testing.assert_array_equal(
+        df.loc[df["SSSCC"] == "00301", "CTDPRS"], cast["CTDPRS"]
+    )
+
+    # load column subset
+    df = process_ctd.load_all_ctd_files(time_files, cols=["CTDPRS"], max_workers=1)
+    assert df.columns.tolist() == ["CTDPRS", "SSSCC", "master_index"]
+
+
+@pytest.mark.parametrize("categorical", [True, False])
+def test_get_cast_index(categorical):
+    ssscc = pd.Series(["00101"] * 3 + ["00201"] * 2 + ["00301"] * 4)
+    if categorical:
+        ssscc = ssscc.astype(pd.CategoricalDtype(["00101", "00201", "00301", "00401"]))
+    df = pd.DataFrame({"SSSCC": ssscc, "CTDPRS": np.arange(9)})
+
+    cast_index = process_ctd.get_cast_index(df)
+    assert cast_index["00101"] == slice(0, 3)
+    assert cast_index["00201"] == slice(3, 5)
+    assert cast_index["00301"] == slice(5, 9)
+    assert df.iloc[cast_index["00201"]]["CTDPRS"].tolist() == [3, 4]
+
+    # casts without data select no rows
+    assert df.iloc[cast_index["00401"]].empty
+
+    # row mask for groups of casts
+    rows = process_ctd.get_cast_rows(cast_index, ["00101", "00301"], len(df))
+    assert rows.tolist() == [True] * 3 + [False] * 2 + [True] * 4
+
+    # casts must be contiguous
+    with pytest.raises(ValueError, match="contiguous"):
+        process_ctd.get_cast_index(df.iloc[[0, 3, 1]])
+
+    assert process_ctd.get_cast_index(df.iloc[:0]) == {}
@@ -1,5 +1,6 @@
 import numpy as np
 import pytest
+import scipy
 
 from ctdcal import oxy_fitting, rinko
 
@@ -97,4 +98,51 @@ def oxy_weighted_residual(coefs, weights, inputs, refoxy, pressure):
 
     residuals = oxy_weighted_residual(coefs, weights, inputs, refoxy, pressure)
 
-    assert np.allclose(residuals, residuals_manual)
\ No newline at end of file
+    assert np.allclose(residuals, residuals_manual)
+
+
+@pytest.fixture
+def rinko_data(synthetic_profile):
+    rng, P, T = synthetic_profile()
+    fit_inputs = (
+        rng.uniform(1.0, 2.5, 200),  # raw voltage
+        P,
+        T,
+        rng.uniform(34.0, 35.0, 200),  # salinity
+        rng.uniform(250, 350, 200),  # oxygen solubility
+    )
+    truth = np.array(coefs)
+    ref = rinko._Uchida_DO_eq(truth, fit_inputs) + rng.normal(0, 0.5, 200)
+    return truth, fit_inputs, ref
+
+
+def test_Uchida_DO_jac(rinko_data, assert_jac_close):
+    truth, fit_inputs, _ = rinko_data
+    assert_jac_close(rinko._Uchida_DO_eq, rinko._Uchida_DO_jac, truth, fit_inputs)
+
+
+def test_Uchida_DO_fit(rinko_data):
+    truth, fit_inputs, ref = rinko_data
+    weights = oxy_fitting.calculate_weights(fit_inputs[1])
+    coefs0 = (
+        1.89890,
+        1.71137e-2,
+        1.59838e-4,
+        -1.07941e-3,
+        -1.23152e-1,
+        3.06114e-1,
+        4.50828e-2,
+    )
+    fit = rinko._Uchida_DO_fit(coefs0, weights, fit_inputs, ref)
+
+    #   At least as good as the previous (finite difference) minimizer
+    bounds = [(None, None)] * 6 + [(0, 0.2)]
+    res = scipy.optimize.minimize(
+        rinko.oxy_weighted_residual,
+        x0=coefs0,
+        args=(weights, fit_inputs, ref),
+        bounds=bounds,
+    )
+    resid = rinko.oxy_weighted_residual(fit, weights, fit_inputs, ref)
+    assert resid <= res.fun * (1 + 1e-6)
+    assert 0 <= fit[6] <= 0.2
@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+from ctdcal import sbe_reader
+
+XMLCON = """<?xml version="1.0" encoding="UTF-8"?>
+<SBE_InstrumentConfiguration SB_ConfigCTD_FileVersion="7.26.7.0">
+  <Instrument Type="8">
+    <SensorArray Size="2">
+      <Sensor index="0" SensorID="55">
+        <TemperatureSensor SensorID="55">
+          <SerialNumber>1234</SerialNumber>
+          <G>4.3e-003</G>
+          <F0>1000.000</F0>
+        </TemperatureSensor>
+      </Sensor>
+      <Sensor index="1" SensorID="38">
+        <OxygenSensor SensorID="38">
+          <SerialNumber>0432</SerialNumber>
+          <CalibrationCoefficients equation="0">
+            <Soc>2.0</Soc>
+            <offset>-0.4</offset>
+            <Tcor>0.0017</Tcor>
+          </CalibrationCoefficients>
+          <Use2007Equation>1</Use2007Equation>
+          <CalibrationCoefficients equation="1">
+            <Soc>0.45</Soc>
+            <offset>-0.5</offset>
+            <Tau20>1.2</Tau20>
+            <E>0.036</E>
+          </CalibrationCoefficients>
+        </OxygenSensor>
+      </Sensor>
+    </SensorArray>
+  </Instrument>
+</SBE_InstrumentConfiguration>
+"""
+
+
+@pytest.fixture
+def xmlcon(tmp_path):
+    f_path = tmp_path / "00101.XMLCON"
+    f_path.write_text(XMLCON)
+    sbe_reader._sensor_coefs_cache.clear()
+    return f_path
+
+
+def test_read_sensor_coefs(xmlcon, tmp_path):
+    cache_file = tmp_path / "converted" / "00101_coefs.json"
+    sensors = sbe_reader.read_sensor_coefs(xmlcon, cache_file=cache_file)
+    assert [s["type"] for s in sensors] == ["TemperatureSensor", "OxygenSensor"]
+    assert sensors[0]["values"] == {"SerialNumber": "1234", "G": 4.3e-3, "F0": 1000.0}
+
+    # coefficients from each equation are kept separate
+    oxy = sensors[1]
+    assert oxy["index"] == 1 and oxy["SensorID"] == "38"
+    assert oxy["equations"]["0"]["Soc"] == 2.0
+    assert oxy["equations"]["1"] == {"Soc": 0.45, "offset": -0.5, "Tau20": 1.2, "E": 0.036}
+    # identifiers and switches are kept as written
+    assert oxy["values"] == {"SerialNumber": "0432", "Use2007Equation": "1"}
+
+    # saved alongside converted data and memoized
+    assert json.loads(cache_file.read_text())["sensors"] == sensors
+    assert sbe_reader.read_sensor_coefs(xmlcon, cache_file=cache_file) is sensors
+
+    # saved coefficients are used without the raw file
+    sbe_reader._sensor_coefs_cache.clear()
+    xmlcon.unlink()
+    assert sbe_reader.read_sensor_coefs(xmlcon, cache_file=cache_file) == sensors
+    with pytest.raises(FileNotFoundError):
+        sbe_reader.read_sensor_coefs(xmlcon)
+
+
+def test_read_sensor_coefs_stale(xmlcon, tmp_path):
+    cache_file = tmp_path / "00101_coefs.json"
+    sbe_reader.read_sensor_coefs(xmlcon, cache_file=cache_file)
+
+    # modified .XMLCON is parsed again
+    xmlcon.write_text(XMLCON.replace("<Tau20>1.2</Tau20>", "<Tau20>1.5</Tau20>"))
+    stat = xmlcon.stat()
+    os.utime(xmlcon, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    sensors = sbe_reader.read_sensor_coefs(xmlcon, cache_file=cache_file)
+    assert sensors[1]["equations"]["1"]["Tau20"] == 1.5
+    saved = json.loads(cache_file.read_text())
+    assert saved["sensors"][1]["equations"]["1"]["Tau20"] == 1.5
+
+
+def test_sbereader_sensor_coefs(xmlcon):
+    reader = sbe_reader.SBEReader.__new__(sbe_reader.SBEReader)  # skip .hex parsing
+    reader.xml_config = XMLCON.replace(
+        '<Instrument Type="8">',
+        '<Instrument Type="8">'
+        "<FrequencyChannelsSuppressed>0</FrequencyChannelsSuppressed>"
+        "<VoltageWordsSuppressed>0</VoltageWordsSuppressed>"
+        "<SurfaceParVoltageAdded>0</SurfaceParVoltageAdded>"
+        "<NmeaPositionDataAdded>0</NmeaPositionDataAdded>"
+        "<NmeaDepthDataAdded>0</NmeaDepthDataAdded>"
+        "<NmeaTimeAdded>0</NmeaTimeAdded>"
+        "<ScanTimeAdded>0</ScanTimeAdded>",
+    )
+    reader._parse_config()
+    assert reader.sensor_coefs == sbe_reader.read_sensor_coefs(xmlcon)
@@ -22,7 +22,7 @@ from bokeh.plotting import figure
 
 from ctdcal import get_ctdcal_config, io
 from ctdcal.common import load_user_config, validate_file
-from ctdcal.fitting.common import df_node_to_BottleFlags, get_node, save_node
+from ctdcal.fitting.common import append_flags, get_node
 
 cfg = get_ctdcal_config()
 USERCONFIG = "ctdcal/cfg.yaml"
@@ -91,6 +91,9 @@ if FLAGFILE.exists():
         columns={"New Flag_x": "New Flag", "Comments_x": "Comments"}
     ).drop(columns=["New Flag_y", "Comments_y"])
 
+# flags as last saved, so that only changes are written to the flag journal
+saved_flags = btl_data[["New Flag", "Comments"]].copy()
+
 # make downcast data point by interpolating bottle points on CTD data
 downcast_data = []
 for ssscc in ssscc_list:
@@ -430,23 +433,25 @@ def save_data():
 
     print("Saving flagged data...")
 
-    # get data from table
-    df_out = pd.DataFrame.from_dict(src_table_changes.data)
+    # get rows changed since the last save
+    current = btl_data[["New Flag", "Comments"]]
+    changed = (current.fillna("") != saved_flags.fillna("")).any(axis=1)
+    df_out = btl_data.loc[changed, ["SSSCC", "SAMPNO", "New Flag", "Comments"]]
 
     # minor changes to columns/names/etc.
     df_out = df_out.rename(
         columns={
-            "flag_new": "value",
+            "New Flag": "value",
             "SSSCC": "cast_id",
             "SAMPNO": "bottle_num",
             "Comments": "notes",
         }
-    ).drop(columns=["flag_old", "diff"])
+    )
 
-    # save it
-    salt = df_node_to_BottleFlags(df_out)
+    # append to the flag journal, so concurrent sessions don't overwrite each other
     flagfile = validate_file(FLAGFILE, create=True)
-    save_node(flagfile, salt, "salt", create_new=True)
+    append_flags(flagfile, df_out, "salt")
+    saved_flags.loc[changed] = current.loc[changed]
 
 
 def exit_bokeh():